@@ -1,84 +1,856 @@
 # FAISS索引构建示例
-import json
+import atexit
+import logging
 import os
-from typing import List, Dict
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Iterable
 
 import faiss
 import numpy as np
 from faiss import IndexIDMap
 
-from settings import INDEX_PATH, DATAMETA_PATH
+from core.metadata import MetaStore, to_face_record
+from core.metrics import metrics
+from core.shards import ShardSet, shard_root, merge_knn, search_params
+from core.utils import setup_logging, atomic_write
+from settings import INDEX_PATH, DATAMETA_PATH, META_DB_PATH, FLUSH_INTERVAL, SEGMENT_DIR, COMPACT_SEGMENT_COUNT, INDEX_TYPE, \
+    IVF_NLIST, PQ_M, HNSW_M, NPROBE, EF_SEARCH, TRAIN_SAMPLE_SIZE, EMBEDDING_NORMALIZE, RANGE_FALLBACK_K, REBUILD_DELETED_RATIO, \
+    SHARD_DIR, SHARD_SEAL_SIZE
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_DIM = 512
+
+# 可选的索引类型: 暴力检索 / 半精度暴力检索 / 8 bit 标量量化暴力检索 / 倒排 / 倒排 + 乘积量化 / HNSW 图
+INDEX_TYPES = ("flat", "flat_fp16", "flat_sq8", "ivf_flat", "ivf_pq", "hnsw")
+# flat_sq8 按样本统计每一维的取值范围, 样本太少时范围偏窄
+SQ8_MIN_TRAIN_SIZE = 1000
+# 标量量化索引的 range_search 逐条查询解码比较, 比批量的 k 近邻检索慢一个数量级, 阈值检索改用逐步扩大 k 的近邻检索
+KNN_RANGE_TYPES = ("flat_fp16", "flat_sq8")
+# 逐步扩大 k 时的初始值和倍数
+KNN_RANGE_START_K = 100
+KNN_RANGE_GROWTH = 4
 
 
 def save_faiss_index(index: IndexIDMap, filename=INDEX_PATH):
     faiss.write_index(index, filename)
-    print(f"已保存FAISS索引到 {filename}")
+    logger.info(f"已保存FAISS索引到 {filename}")
 
 
-def load_faiss_index(filename=INDEX_PATH, new_file=False) -> IndexIDMap:
+def load_faiss_index(filename=INDEX_PATH, new_file=False, index_type=INDEX_TYPE) -> IndexIDMap:
     if not os.path.exists(filename) or new_file:
-        index = faiss.IndexFlatIP(512)
-        index_with_ids = faiss.IndexIDMap(index)
-        print(f"{filename} 执行初始化 IndexFlatIP + IndexIDMap")
+        # 不需要训练的类型直接创建, 其余先用 flat, 向量数足够后再迁移
+        index_type = index_type if get_min_train_size(index_type) == 0 else "flat"
+        index_with_ids = create_index(index_type)
+        logger.debug(f"{filename} 执行初始化 {index_type} + IndexIDMap")
     else:
         index_with_ids = faiss.read_index(filename)
-        print(f"已从 {filename} 加载FAISS索引")
+        set_search_params(index_with_ids)
+        logger.info(f"已从 {filename} 加载FAISS索引, 类型: {get_index_type(index_with_ids)}")
     return index_with_ids
 
 
-def get_exist_keys(datameta_path=DATAMETA_PATH) -> List[str]:
-    if not os.path.exists(datameta_path):
-        return []
+def create_index(index_type=INDEX_TYPE, dim=EMBEDDING_DIM, nlist=IVF_NLIST, pq_m=PQ_M, hnsw_m=HNSW_M) -> IndexIDMap:
+    """
+    索引工厂, 返回带 id 映射的空索引, ivf 类型在加入向量前需要先 train_index
+    """
+    if index_type == "flat":
+        index = faiss.IndexFlatIP(dim)
+    elif index_type == "flat_fp16":
+        index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_INNER_PRODUCT)
+    elif index_type == "flat_sq8":
+        index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+    elif index_type == "ivf_flat":
+        index = faiss.IndexIVFFlat(faiss.IndexFlatIP(dim), dim, nlist, faiss.METRIC_INNER_PRODUCT)
+    elif index_type == "ivf_pq":
+        index = faiss.IndexIVFPQ(faiss.IndexFlatIP(dim), dim, nlist, pq_m, 8, faiss.METRIC_INNER_PRODUCT)
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, hnsw_m, faiss.METRIC_INNER_PRODUCT)
     else:
-        with open(datameta_path, 'r') as file:
-            datameta_dict = json.load(file)
-        return list(datameta_dict.keys())
+        raise ValueError(f"不支持的索引类型: {index_type}, 可选: {INDEX_TYPES}")
+    return faiss.IndexIDMap(index)
 
 
-def write_embedding(emb_dict: Dict[str, List[np.ndarray]], datameta_path=DATAMETA_PATH):
-    if not os.path.exists(datameta_path):
-        datameta_dict = {}
-    else:
-        with open(datameta_path, 'r') as file:
-            datameta_dict = json.load(file)
+def get_index_type(index: IndexIDMap) -> str:
+    sub_index = faiss.downcast_index(index.index)
+    if isinstance(sub_index, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    elif isinstance(sub_index, faiss.IndexIVFFlat):
+        return "ivf_flat"
+    elif isinstance(sub_index, faiss.IndexHNSW):
+        return "hnsw"
+    elif isinstance(sub_index, faiss.IndexScalarQuantizer):
+        return "flat_fp16" if sub_index.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else "flat_sq8"
+    return "flat"
+
+
+def get_min_train_size(index_type=INDEX_TYPE, nlist=IVF_NLIST) -> int:
+    """
+    训练所需的最少向量数, 每个聚类中心至少需要 39 个样本, pq 的每个子码本有 256 个中心
+    """
+    if index_type == "ivf_flat":
+        return 39 * nlist
+    elif index_type == "ivf_pq":
+        return 39 * max(nlist, 256)
+    elif index_type == "flat_sq8":
+        return SQ8_MIN_TRAIN_SIZE
+    return 0
+
+
+def train_index(index: IndexIDMap, vectors: np.ndarray, sample_size=TRAIN_SAMPLE_SIZE):
+    """
+    从已有向量中随机抽样训练索引
+    """
+    if index.is_trained:
+        return
+    if len(vectors) > sample_size:
+        vectors = vectors[np.random.choice(len(vectors), sample_size, replace=False)]
+    b = time.time()
+    index.train(np.ascontiguousarray(vectors, dtype=np.float32))
+    logger.info(f"索引训练完成, 样本数: {len(vectors)}, 耗时: {time.time() - b:.2f}s")
+
+
+def set_search_params(index: IndexIDMap, nprobe=NPROBE, ef_search=EF_SEARCH):
+    """
+    设置召回率和延迟的调节参数, nprobe 作用于 ivf, efSearch 作用于 hnsw, 值越大召回越高、越慢
+    """
+    sub_index = faiss.downcast_index(index.index)
+    if isinstance(sub_index, faiss.IndexIVF) and nprobe is not None:
+        sub_index.nprobe = nprobe
+    elif isinstance(sub_index, faiss.IndexHNSW) and ef_search is not None:
+        sub_index.hnsw.efSearch = ef_search
+
+
+def get_index_vectors(index: IndexIDMap):
+    """
+    取出索引中全部的 (ids, vectors), pq 索引取出的是量化后的近似值
+    """
+    ids = faiss.vector_to_array(index.id_map).astype(np.int64)
+    sub_index = faiss.downcast_index(index.index)
+    if isinstance(sub_index, faiss.IndexIVF):
+        sub_index.make_direct_map()
+    vectors = sub_index.reconstruct_n(0, index.ntotal) if index.ntotal else np.empty((0, index.d), np.float32)
+    return ids, vectors
+
+
+def build_index(ids: np.ndarray, vectors: np.ndarray, index_type=INDEX_TYPE) -> IndexIDMap:
+    """
+    用给定的向量创建并训练索引, 向量数不足以训练 index_type 时退回 flat
+    """
+    if len(vectors) < get_min_train_size(index_type):
+        index_type = "flat"
+    index = create_index(index_type, dim=EMBEDDING_DIM)
+    train_index(index, vectors)
+    if len(vectors):
+        index.add_with_ids(np.ascontiguousarray(vectors, dtype=np.float32), np.asarray(ids, dtype=np.int64))
+    set_search_params(index)
+    return index
+
+
+def normalize_embeddings(embs) -> np.ndarray:
+    """
+    L2 归一化, 内积即为余弦相似度
+    """
+    embs = np.array(embs, dtype=np.float32, copy=True).reshape(-1, EMBEDDING_DIM)
+    faiss.normalize_L2(embs)
+    return embs
+
+
+def is_normalized(index: IndexIDMap, sample_size=1000, tol=0.1) -> bool:
+    """
+    抽查索引开头的向量模长是否为 1, buffalo_l 原始 embedding 的模长在 20 左右, 量化误差远小于 tol
+    """
+    if index.ntotal == 0:
+        return True
+    sub_index = faiss.downcast_index(index.index)
+    if isinstance(sub_index, faiss.IndexIVF):
+        sub_index.make_direct_map()
+    vectors = sub_index.reconstruct_n(0, min(sample_size, index.ntotal))
+    return bool(np.all(np.abs(np.linalg.norm(vectors, axis=1) - 1) < tol))
+
+
+def migrate_index(index: IndexIDMap, index_type=INDEX_TYPE, normalize=False, **kwargs) -> IndexIDMap:
+    """
+    把已有索引中的向量迁移到新类型的索引, id 保持不变
+    :param normalize: 迁移时把向量归一化, 用于未归一化的旧索引
+    """
+    ids, vectors = get_index_vectors(index)
+    if normalize and len(vectors):
+        norms = np.linalg.norm(vectors, axis=1)
+        # 旧分数是未归一化的内积, 约等于 余弦相似度 * 模长的平方
+        logger.info(f"向量平均模长: {norms.mean():.2f}, 旧阈值 200 约相当于余弦相似度 {200 / norms.mean() ** 2:.3f}")
+        vectors = normalize_embeddings(vectors)
+    min_train_size = get_min_train_size(index_type, kwargs.get("nlist", IVF_NLIST))
+    if len(vectors) < min_train_size:
+        raise ValueError(f"向量数 {len(vectors)} 不足以训练 {index_type}, 至少需要 {min_train_size}")
+
+    new_index = create_index(index_type, dim=index.d, **kwargs)
+    train_index(new_index, vectors)
+    new_index.add_with_ids(vectors, ids)
+    set_search_params(new_index)
+    logger.info(f"索引已从 {get_index_type(index)} 迁移到 {index_type}, 向量数: {new_index.ntotal}, "
+                f"{'已归一化, ' if normalize else ''}编码后占用: {get_index_bytes(new_index) / 1024 ** 2:.1f}MB")
+    return new_index
+
+
+def get_index_bytes(index: IndexIDMap) -> int:
+    """
+    向量编码占用的内存, 不含 id 映射和图结构
+    """
+    sub_index = faiss.downcast_index(index.index)
+    if isinstance(sub_index, faiss.IndexHNSW):
+        sub_index = faiss.downcast_index(sub_index.storage)
+    return index.ntotal * sub_index.code_size
+
+
+def evaluate_recall(index: IndexIDMap, flat_index: IndexIDMap = None, queries: np.ndarray = None, k=10,
+                    n_queries=200) -> dict:
+    """
+    对比暴力检索评估近似索引的召回率和延迟
+    :param flat_index: 作为真值的暴力索引, 为空时由 index 中的向量重建(pq 索引下为量化后的近似值)
+    :param queries: 查询向量, 为空时从库中随机抽取
+    :return: {"recall": recall@k, "flat_ms": 单条查询耗时, "index_ms": 单条查询耗时}
+    """
+    if flat_index is None:
+        ids, vectors = get_index_vectors(index)
+        flat_index = create_index("flat", dim=index.d)
+        flat_index.add_with_ids(vectors, ids)
+    if queries is None:
+        _, vectors = get_index_vectors(flat_index)
+        queries = vectors[np.random.choice(len(vectors), min(n_queries, len(vectors)), replace=False)]
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+
+    b = time.time()
+    _, flat_ids = flat_index.search(queries, k)
+    flat_ms = (time.time() - b) * 1000 / len(queries)
+    b = time.time()
+    _, index_ids = index.search(queries, k)
+    index_ms = (time.time() - b) * 1000 / len(queries)
+
+    hits = sum(len(set(a[a >= 0]) & set(b[b >= 0])) for a, b in zip(flat_ids, index_ids))
+    total = int((flat_ids >= 0).sum())
+    return {"recall": hits / total if total else 1.0, "flat_ms": flat_ms, "index_ms": index_ms}
+
+
+class FaceStore:
+    """
+    常驻内存的索引与元数据会话
+    索引只在打开时从磁盘读取一次, 之后的检索和追加都在内存中完成,
+    修改只在显式调用 flush 或者距上次落盘超过 flush_interval 秒时写回磁盘
+
+    落盘采用追加写的段文件: 每次 flush 只把新增的向量和元数据写成一个新的段文件,
+    耗时与库的大小无关; 段文件积累到 compact_segment_count 个后由后台线程合并进主索引.
+    主索引先写临时文件再原子替换, 写到一半崩溃也不会损坏已有文件.
+    元数据存放在 SQLite 中, 在段文件落盘后才提交
+    """
+
+    def __init__(self, index_path=INDEX_PATH, meta_db_path=META_DB_PATH, flush_interval=FLUSH_INTERVAL,
+                 segment_dir=SEGMENT_DIR, compact_segment_count=COMPACT_SEGMENT_COUNT, index_type=INDEX_TYPE,
+                 datameta_path=DATAMETA_PATH, normalize=EMBEDDING_NORMALIZE, shard_dir=SHARD_DIR,
+                 shard_seal_size=SHARD_SEAL_SIZE):
+        self.index_path = index_path
+        self.flush_interval = flush_interval
+        self.segment_dir = segment_dir
+        self.compact_segment_count = compact_segment_count
+        self.index_type = index_type
+        self.normalize = normalize
+        self.shard_seal_size = shard_seal_size
+        self._lock = threading.RLock()
+
+        self.meta = MetaStore(meta_db_path)
+        self._recover_rebuild()
+        # 只读分片在第一次检索到时才映射
+        self.shards = ShardSet(shard_dir, generation=int(self.meta.get_state("shard_generation", "0")))
+        self.shards.remove_stale_generations()
+        self.shards.set_tombstones(self.meta.deleted_ids())
+        self.index = load_faiss_index(index_path, index_type=index_type)
+        if get_index_type(self.index) != index_type:
+            logger.info(f"当前索引类型为 {get_index_type(self.index)}, 合并段文件时会在向量数足够后迁移到 {index_type}")
+        # 旧版本的元数据保存在 datameta.json 中, 只导入一次; 数据库为空不代表没有导入过(可能已全部删除),
+        # 所以记录在 store_state 中, 且只在索引中有对应的向量时导入
+        if self.meta.get_state("json_migrated") != "1" and datameta_path and os.path.exists(datameta_path):
+            if self.meta.is_empty() and self.index.ntotal > 0:
+                self.meta.migrate_from_json(datameta_path)
+            self.meta.set_state("json_migrated", "1")
+            self.meta.commit()
+        self._replay_segments()
+        self.max_id = max(self.meta.max_face_id(), get_index_max_id(self.index), self.shards.max_id)
+
+        # 尚未写入段文件的新增数据
+        self._pending_ids: List[np.ndarray] = []
+        self._pending_embs: List[np.ndarray] = []
+        self._pending_paths: List[str] = []
+        self._pending_faces: List[dict] = []
+        self._last_flush = time.time()
+        self._compact_thread: threading.Thread | None = None
+
+        # 旧版本保存的是未归一化的 embedding, 分数没有固定范围, 打开时迁移为余弦相似度并立即落盘
+        if normalize and not is_normalized(self.index):
+            logger.info("索引中的向量未归一化, 开始迁移为余弦相似度")
+            self.index = migrate_index(self.index, get_index_type(self.index), normalize=True)
+            self._compact()
+
+    def _segment_files(self) -> List[str]:
+        if not os.path.isdir(self.segment_dir):
+            return []
+        return sorted(os.path.join(self.segment_dir, name) for name in os.listdir(self.segment_dir)
+                      if name.startswith("seg_") and name.endswith(".npz"))
+
+    def _replay_segments(self):
+        """
+        把主索引之后追加的段文件重新加载到内存
+        合并时可能在替换主索引之后、删除段文件之前崩溃, 所以只补充 id 大于主索引和分片最大 id 的向量;
+        段文件写入后、元数据提交前崩溃时, 由段文件中的元数据补齐数据库
+        """
+        index_max_id = max(get_index_max_id(self.index), self.shards.max_id)
+        deleted_ids = np.array(sorted(self.meta.deleted_ids()), dtype=np.int64)
+        for segment_file in self._segment_files():
+            with np.load(segment_file) as segment:
+                ids, embs, paths = segment["ids"], segment["embs"], segment["paths"]
+                faces = [{"bbox": bbox, "det_score": det_score, "frame_ts": frame_ts} for bbox, det_score, frame_ts
+                         in zip(segment["bboxes"], segment["det_scores"], segment["frame_ts"])]
+            # 已删除的人脸不再回放
+            alive = ~np.isin(ids, deleted_ids)
+            self.meta.add_faces(ids[alive].tolist(), paths[alive].tolist(), [f for f, a in zip(faces, alive) if a])
+            mask = (ids > index_max_id) & alive
+            if mask.any():
+                self.index.add_with_ids(embs[mask], ids[mask])
+            logger.debug(f"已回放段文件 {segment_file}, 向量数: {int(mask.sum())}")
+        self.meta.commit()
+
+    def exist_paths(self, paths: List[str]) -> set:
+        return self.meta.existing_paths(paths)
+
+    def update_manifest(self, entries):
+        """
+        记录已处理文件的 (path, size, mtime, hash), 与人脸数据一起在 flush 时提交
+        """
+        with self._lock, metrics.timer("metadata_write"):
+            self.meta.update_manifest(entries)
+
+    def update_dedup(self, links, hashes):
+        """
+        记录去重结果, 与人脸数据一起在 flush 时提交
+        :param links: 重复文件 [(FileEntry, 目标文件路径), ...], 不写入向量, 记入清单, 检索时随目标文件一起返回
+        :param hashes: 感知哈希 [(path, kind, code), ...]
+        """
+        with self._lock, metrics.timer("metadata_write", items=0):
+            self.meta.link_paths((entry.path, target) for entry, target in links)
+            self.meta.update_manifest(entry for entry, _ in links)
+            self.meta.update_perceptual_hashes((path, kind, np.asarray(code, dtype=np.uint8).tobytes())
+                                               for path, kind, code in hashes)
+
+    def rename_path(self, old_path, new_path):
+        with self._lock:
+            self.meta.rename_path(old_path, new_path)
+
+    def remove_paths(self, paths: List[str]) -> int:
+        """
+        删除文件对应的人脸, 索引类型不支持 remove_ids 时(如 hnsw)向量留在索引中,
+        检索时因为查不到元数据被过滤掉
+        :return: 删除的人脸数量
+        """
+        with self._lock:
+            ids = self.meta.delete_paths(paths)
+            if ids:
+                self.shards.set_tombstones(self.meta.deleted_ids())
+                try:
+                    self.index.remove_ids(np.array(ids, dtype=np.int64))
+                except RuntimeError:
+                    logger.warning(f"索引类型 {get_index_type(self.index)} 不支持删除向量, 已在元数据中删除 {len(ids)} 条")
+        return len(ids)
+
+    def remove_media(self, paths: Iterable[str]) -> int:
+        """
+        按文件或文件夹删除, 文件夹删除其下所有已入库的文件, 路径已不存在时同样有效
+        :return: 删除的人脸数量
+        """
+        targets = set()
+        for path in paths:
+            targets.add(path)
+            targets.update(self.meta.paths_under(path))
+        return self.remove_paths(sorted(targets))
+
+    def find_vanished_paths(self, workers=8) -> List[str]:
+        """
+        已入库或已记入清单、但磁盘上已经不存在的文件, 网络盘上逐个检查很慢, 用线程池并行
+        """
+        paths = sorted(set(self.meta.all_paths()) | set(self.meta.manifest_paths()))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            exists = list(pool.map(os.path.exists, paths, chunksize=256))
+        return [path for path, exist in zip(paths, exists) if not exist]
+
+    def purge_vanished(self) -> int:
+        """
+        删除磁盘上已经不存在的文件
+        :return: 删除的文件数量
+        """
+        vanished = self.find_vanished_paths()
+        if vanished:
+            face_count = self.remove_paths(vanished)
+            self.flush()
+            logger.info(f"已清理 {len(vanished)} 个不存在的文件, 人脸数: {face_count}")
+        return len(vanished)
+
+    def add(self, emb_dict: Dict[str, list]) -> int:
+        """
+        追加向量到内存索引, 已存在的文件跳过
+        整批向量拼成一个连续的 float32 矩阵, 只调用一次 add_with_ids
+        :param emb_dict: {file_path: [Face 或者 np.ndarray, ...]}, Face 中的 bbox、det_score、frame_ts 会写入元数据
+        :return: 新增的人脸数量
+        """
+        with self._lock:
+            exist_paths = self.meta.existing_paths(emb_dict.keys())
+            faces, paths = [], []
+            for file_path, file_faces in emb_dict.items():
+                if file_path in exist_paths:
+                    logger.debug(f"file_path: {file_path} exists database, continue")
+                    continue
+                faces.extend(to_face_record(face) for face in file_faces)
+                paths.extend([file_path] * len(file_faces))
+
+            if faces:
+                emb_matrix = np.ascontiguousarray(np.vstack([face["embedding"] for face in faces]), dtype=np.float32)
+                if self.normalize:
+                    emb_matrix = normalize_embeddings(emb_matrix)
+                ids = np.arange(self.max_id + 1, self.max_id + 1 + len(emb_matrix), dtype=np.int64)
+                with metrics.timer("index_add", items=len(ids)):
+                    self.index.add_with_ids(emb_matrix, ids)
+                with metrics.timer("metadata_write", items=len(ids)):
+                    self.meta.add_faces(ids.tolist(), paths, faces)
+                self.max_id = int(ids[-1])
+                self._pending_ids.append(ids)
+                self._pending_embs.append(emb_matrix)
+                self._pending_paths.extend(paths)
+                self._pending_faces.extend(faces)
+
+            self.maybe_flush()
+        return len(faces)
+
+    def _prepare_queries(self, queries: np.ndarray) -> np.ndarray:
+        queries = np.ascontiguousarray(queries, dtype=np.float32).reshape(-1, self.index.d)
+        if self.normalize and len(queries):
+            queries = normalize_embeddings(queries)
+        return queries
+
+    def search_ids(self, queries: np.ndarray, k=10, scope: List[str] = None) -> List[tuple]:
+        """
+        k 近邻检索, 只返回人脸 id, 不查询元数据
+        主索引和检索范围内的分片并行检索后合并
+        :param scope: 检索范围(文件夹列表), 只用于挑选分片, 主索引中的结果由调用方按路径过滤
+        :return: 每条查询对应的 (ids, scores), 已去掉不足 k 个时补的 -1
+        """
+        queries = self._prepare_queries(queries)
+        if len(queries) == 0:
+            return []
+
+        with self._lock:
+            # hnsw 不支持 remove_ids, 已删除的向量和分片中的一样在检索时排除
+            params = search_params(self.index, self.shards.tombstone_selector) \
+                if get_index_type(self.index) == "hnsw" else None
+            distances, indices = self.index.search(queries, k=k, params=params)
+            shard_results = self.shards.search(queries, k, scope)
+        results = [(row_indices[row_indices >= 0], row_distances[row_indices >= 0])
+                   for row_indices, row_distances in zip(indices, distances)]
+        if not shard_results:
+            return results
+        return [merge_knn([result] + [shard[i] for shard in shard_results], k) for i, result in enumerate(results)]
+
+    def range_search_ids(self, queries: np.ndarray, min_score, scope: List[str] = None) -> List[tuple]:
+        """
+        阈值检索, 返回分数不低于 min_score 的全部人脸, 数量不受 k 限制
+        主索引或分片是标量量化索引时用逐步扩大 k 的近邻检索代替;
+        索引类型不支持 range_search 时退化为 RANGE_FALLBACK_K 近邻检索后过滤
+        :return: 每条查询对应的 (ids, scores)
+        """
+        queries = self._prepare_queries(queries)
+        if len(queries) == 0:
+            return []
+        if get_index_type(self.index) in KNN_RANGE_TYPES or \
+                any(shard["type"] in KNN_RANGE_TYPES for shard in self.shards.shards.values()):
+            return self._expanding_knn_search(queries, min_score, scope)
+
+        # faiss 对内积返回分数严格大于 radius 的结果
+        radius = float(min_score) - 1e-6
+        with self._lock:
+            try:
+                lims, distances, indices = self.index.range_search(queries, radius)
+                shard_results = self.shards.range_search(queries, radius, scope)
+            except RuntimeError:
+                logger.warning(f"索引类型 {get_index_type(self.index)} 不支持 range_search, 使用 {RANGE_FALLBACK_K} 近邻检索")
+                lims = distances = indices = shard_results = None
+        if lims is None:
+            return [(ids[scores >= min_score], scores[scores >= min_score])
+                    for ids, scores in self.search_ids(queries, k=RANGE_FALLBACK_K, scope=scope)]
+        results = [(indices[lims[i]:lims[i + 1]], distances[lims[i]:lims[i + 1]]) for i in range(len(queries))]
+        if not shard_results:
+            return results
+        return [merge_knn([result] + [shard[i] for shard in shard_results], None) for i, result in enumerate(results)]
+
+    def _expanding_knn_search(self, queries: np.ndarray, min_score, scope: List[str] = None) -> List[tuple]:
+        """
+        结果与阈值检索相同: 第 k 个近邻的分数仍不低于 min_score 时, 这些查询扩大 k 重新检索, 直到 k 覆盖全部向量
+        """
+        total = self.index.ntotal + self.shards.ntotal
+        results, pending, k = [None] * len(queries), np.arange(len(queries)), KNN_RANGE_START_K
+        while len(pending):
+            k = max(1, min(k, total))
+            unfinished = []
+            for i, (ids, scores) in zip(pending, self.search_ids(queries[pending], k=k, scope=scope)):
+                # 与 range_search 相同的容差
+                keep = scores > float(min_score) - 1e-6
+                results[i] = (ids[keep], scores[keep])
+                if len(ids) and keep.all() and k < total:
+                    unfinished.append(i)
+            pending, k = np.array(unfinished, dtype=np.int64), k * KNN_RANGE_GROWTH
+        return results
+
+    def search_batch(self, queries: np.ndarray, k=10) -> List[List[tuple]]:
+        """
+        一次检索多条查询向量
+        :param queries: (n, 512) 的查询矩阵
+        :return: 每条查询对应的 [(score, file_path, frame_ts), ...], frame_ts 为命中人脸在视频中的时间(秒),
+                 normalize 为 True 时 score 为余弦相似度
+        """
+        results = self.search_ids(queries, k=k)
+        id_hits = self.meta.get_hits(np.concatenate([ids for ids, _ in results]).tolist() if results else [])
+        return [[(score, *id_hits[int(idx)]) for idx, score in zip(ids, scores) if int(idx) in id_hits]
+                for ids, scores in results]
+
+    def search(self, embs, k=10):
+        if embs is None or len(embs) == 0:
+            return []
+
+        return [hit for hits in self.search_batch(np.vstack(embs), k=k) for hit in hits]
+
+    def maybe_flush(self):
+        if self.flush_interval is not None and time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        把新增数据写成一个新的段文件, 段文件过多时触发后台合并
+        """
+        with self._lock:
+            if self._pending_ids:
+                self._write_segment()
+            self.meta.commit()
+            self._last_flush = time.time()
+            if len(self._segment_files()) >= self.compact_segment_count:
+                self.compact(background=True)
+
+    def _write_segment(self):
+        b = time.perf_counter()
+        os.makedirs(self.segment_dir, exist_ok=True)
+        segment_files = self._segment_files()
+        seq = int(os.path.basename(segment_files[-1])[4:-4]) + 1 if segment_files else 1
+        segment_file = os.path.join(self.segment_dir, f"seg_{seq:010d}.npz")
+        atomic_write(segment_file, lambda file: np.savez(
+            file,
+            ids=np.concatenate(self._pending_ids),
+            embs=np.vstack(self._pending_embs),
+            paths=np.array(self._pending_paths),
+            bboxes=np.array([np.full(4, np.nan) if face["bbox"] is None else face["bbox"]
+                             for face in self._pending_faces], dtype=np.float32).reshape(-1, 4),
+            det_scores=np.array([np.nan if face["det_score"] is None else face["det_score"]
+                                 for face in self._pending_faces], dtype=np.float32),
+            frame_ts=np.array([np.nan if face["frame_ts"] is None else face["frame_ts"]
+                               for face in self._pending_faces], dtype=np.float64),
+        ))
+        # 段文件落盘之后再提交元数据
+        self.meta.commit()
+        logger.info(f"已写入段文件 {segment_file}, 向量数: {len(self._pending_paths)}")
+        metrics.observe("segment_write", time.perf_counter() - b, len(self._pending_paths))
+        self._pending_ids, self._pending_embs, self._pending_paths, self._pending_faces = [], [], [], []
+
+    def compact(self, background=False):
+        """
+        把段文件合并进主索引
+        :param background: 是否在后台线程中执行
+        """
+        with self._lock:
+            if self._compact_thread is not None and self._compact_thread.is_alive():
+                return
+            if background:
+                self._compact_thread = threading.Thread(target=self._compact, daemon=True)
+                self._compact_thread.start()
+                return
+        self._compact()
+
+    def migrate(self, index_type=None, **kwargs):
+        """
+        把内存中的索引迁移到 index_type 类型并立即合并落盘
+        """
+        index_type = index_type or self.index_type
+        with self._lock:
+            self.index = migrate_index(self.index, index_type, **kwargs)
+            self.index_type = index_type
+        self.compact()
+
+    def _compact(self):
+        # 新建的库先用 flat, 向量数足够训练后再自动迁移到配置的索引类型
+        with self._lock:
+            if (self.index_type != get_index_type(self.index)
+                    and self.index.ntotal >= get_min_train_size(self.index_type)):
+                self.index = migrate_index(self.index, self.index_type)
+
+        # 只在锁内做内存快照, 写盘在锁外进行, 不阻塞检索和追加
+        with self._lock:
+            if self._pending_ids:
+                self._write_segment()
+            self.meta.commit()
+            segment_files = self._segment_files()
+            index_bytes = faiss.serialize_index(self.index)
+
+        atomic_write(self.index_path, lambda file: file.write(index_bytes.tobytes()))
+        for segment_file in segment_files:
+            os.remove(segment_file)
+        logger.info(f"已合并 {len(segment_files)} 个段文件到 {self.index_path}")
+
+        if self.index.ntotal >= self.shard_seal_size:
+            self.seal()
+
+        deleted_count = len(self.meta.deleted_ids())
+        if deleted_count and deleted_count >= REBUILD_DELETED_RATIO * max(self.meta.face_count(), 1):
+            self.rebuild()
+
+    def seal(self):
+        """
+        把主索引中的向量按根文件夹各写成一个新的只读分片, 之后主索引清空
+        已有的分片不读取也不改写, 耗时只与主索引的大小有关; 分片写完、主索引清空前崩溃时,
+        这些向量仍留在主索引中, 它们的 id 不大于分片的最大 id, 下次 seal 时跳过, 检索合并时也会去重
+        """
+        with self._lock:
+            if self._pending_ids:
+                self._write_segment()
+            if self._segment_files():
+                self._compact_segments_locked()
+
+            b = time.time()
+            ids, vectors = get_index_vectors(self.index)
+            paths = self.meta.get_paths(ids.tolist())
+            alive = np.array([int(face_id) in paths for face_id in ids], dtype=bool) & (ids > self.shards.max_id)
+            ids, vectors = ids[alive], vectors[alive]
+            roots = np.array([shard_root(paths[int(face_id)]) for face_id in ids], dtype=str)
+            for root in np.unique(roots):
+                mask = roots == root
+                self.shards.write_shard(str(root), build_index(ids[mask], vectors[mask], self.index_type))
+
+            self.index = load_faiss_index(self.index_path, new_file=True, index_type=self.index_type)
+            index_bytes = faiss.serialize_index(self.index)
+            atomic_write(self.index_path, lambda file: file.write(index_bytes.tobytes()))
+            logger.info(f"已写入 {len(np.unique(roots))} 个分片, 向量数: {len(ids)}, 分片总数: {len(self.shards.shards)}, "
+                        f"耗时: {time.time() - b:.2f}s")
+
+    def rebuild(self):
+        """
+        去掉已删除的人脸, 把 id 重新编号为 1..n 并重建索引和分片, 不支持 remove_ids 的索引(如 hnsw)
+        和只读分片中残留的向量也一并清除
+        逐个根文件夹读取它的分片和主索引中属于它的向量, 合并为新一代的一个分片并分配新 id,
+        内存中同时只有一个根文件夹的向量; 旧 id 到新 id 的映射分批写入元数据
+        新的分片写入先清空过的下一代目录, 新的主索引先写入 .rebuild 文件, 元数据的重新编号、分片代数和 rebuild_pending
+        标记在同一个事务中提交, 之后再替换主索引, 中途崩溃时打开时由 _recover_rebuild 补完或丢弃
+        重建期间持有锁, 检索和追加会等待
+        """
+        with self._lock:
+            if self._pending_ids:
+                self._write_segment()
+            if self._segment_files():
+                self._compact_segments_locked()
+
+            b = time.time()
+            total = self.index.ntotal + self.shards.ntotal
+            alive_ids = np.array(self.meta.face_ids(), dtype=np.int64)
+            # 主索引不超过 shard_seal_size 个向量, 整体读取; 不大于分片最大 id 的是 seal 中断时残留的重复向量
+            hot_ids, hot_vectors = get_index_vectors(self.index)
+            alive = np.isin(hot_ids, alive_ids) & (hot_ids > self.shards.max_id)
+            hot_ids, hot_vectors = hot_ids[alive], hot_vectors[alive]
+            # [(旧 id, 新 id), ...], 每个根文件夹一批
+            id_map = []
+
+            # 已经使用分片或者向量数超过分片阈值时, 全部写入新一代分片, 主索引为空
+            generation = self.shards.generation
+            if self.shards.shards or len(hot_ids) >= self.shard_seal_size:
+                generation += 1
+                self.shards.clear_generation(generation)
+                paths = self.meta.get_paths(hot_ids.tolist())
+                hot_roots = np.array([shard_root(paths[int(face_id)]) for face_id in hot_ids], dtype=str)
+                shard_roots = self.shards.roots()
+                next_id = 1
+                for root in sorted(set(shard_roots) | set(hot_roots.tolist())):
+                    parts = [self.shards.read_vectors(name) for name in shard_roots.get(root, [])]
+                    parts.append((hot_ids[hot_roots == root], hot_vectors[hot_roots == root]))
+                    ids = np.concatenate([part_ids for part_ids, _ in parts])
+                    vectors = np.vstack([part_vectors for _, part_vectors in parts])
+                    del parts
+                    ids, first = np.unique(ids, return_index=True)
+                    alive = np.isin(ids, alive_ids)
+                    old_ids, vectors = ids[alive], vectors[first[alive]]
+                    if len(old_ids) == 0:
+                        continue
+                    new_ids = np.arange(next_id, next_id + len(old_ids), dtype=np.int64)
+                    self.shards.write_shard(root, build_index(new_ids, vectors, self.index_type), generation=generation)
+                    id_map.append((old_ids, new_ids))
+                    next_id += len(old_ids)
+                    del vectors
+                new_index = load_faiss_index(self.index_path, new_file=True, index_type=self.index_type)
+                count = next_id - 1
+            else:
+                new_ids = np.arange(1, len(hot_ids) + 1, dtype=np.int64)
+                new_index = build_index(new_ids, hot_vectors, self.index_type)
+                id_map.append((hot_ids, new_ids))
+                count = len(new_ids)
+
+            rebuild_path = f"{self.index_path}.rebuild"
+            index_bytes = faiss.serialize_index(new_index)
+            atomic_write(rebuild_path, lambda file: file.write(index_bytes.tobytes()))
+            self.meta.renumber_faces(id_map)
+            self.meta.set_state("shard_generation", str(generation))
+            self.meta.set_state("rebuild_pending", "1")
+            self.meta.commit()
+            os.replace(rebuild_path, self.index_path)
+            self.meta.set_state("rebuild_pending", "0")
+            self.meta.commit()
+            if generation != self.shards.generation:
+                self.shards.switch_generation(generation)
+                self.shards.remove_stale_generations()
+            self.shards.set_tombstones([])
+
+            self.index = new_index
+            self.max_id = count
+            logger.info(f"索引已重建, 类型: {get_index_type(new_index)}, 人脸数: {count}, 分片数: "
+                        f"{len(self.shards.shards)}, 清除 {total - count} 个已删除的向量, 耗时: {time.time() - b:.2f}s")
+
+    def _compact_segments_locked(self):
+        """
+        在持有锁的情况下把段文件合并进主索引
+        """
+        self.meta.commit()
+        segment_files = self._segment_files()
+        index_bytes = faiss.serialize_index(self.index)
+        atomic_write(self.index_path, lambda file: file.write(index_bytes.tobytes()))
+        for segment_file in segment_files:
+            os.remove(segment_file)
+
+    def _recover_rebuild(self):
+        """
+        处理上次重建中途崩溃留下的 .rebuild 文件:
+        元数据已经提交时用它替换主索引, 否则元数据仍是旧编号, 直接丢弃
+        """
+        rebuild_path = f"{self.index_path}.rebuild"
+        if self.meta.get_state("rebuild_pending") == "1":
+            if os.path.exists(rebuild_path):
+                os.replace(rebuild_path, self.index_path)
+                logger.info(f"已完成上次中断的索引重建: {self.index_path}")
+            self.meta.set_state("rebuild_pending", "0")
+            self.meta.commit()
+        elif os.path.exists(rebuild_path):
+            os.remove(rebuild_path)
+
+    def close(self):
+        self.flush()
+        if self._compact_thread is not None:
+            self._compact_thread.join()
+        self.meta.commit()
+
+
+def get_index_max_id(index) -> int:
+    if index.ntotal == 0:
+        return 0
+    return int(faiss.vector_to_array(index.id_map).max())
+
+
+def get_index_min_id(index) -> int:
+    if index.ntotal == 0:
+        return 0
+    return int(faiss.vector_to_array(index.id_map).min())
+
+
+_face_store: FaceStore | None = None
+_face_store_lock = threading.Lock()
+
+
+def get_face_store() -> FaceStore:
+    """
+    进程内共享的 FaceStore, 第一次调用时打开, 退出时自动落盘
+    """
+    global _face_store
+    with _face_store_lock:
+        if _face_store is None:
+            _face_store = FaceStore()
+            atexit.register(_face_store.close)
+        return _face_store
+
+
+def get_exist_keys() -> List[str]:
+    """
+    已入库的文件路径
+    """
+    return get_face_store().meta.all_paths()
+
+
+def gen_remove_media(paths: List[str]):
+    """
+    从库中删除文件或文件夹
+    :return: 生成器, 每处理完一个路径返回一次 (当前数量, 总数)
+    """
+    store, total = get_face_store(), len(paths)
+    face_count = 0
+    for current, path in enumerate(paths, 1):
+        face_count += store.remove_media([path])
+        if current < total:
+            yield current, total
+    store.flush()
+    logger.info(f"已删除 {total} 个路径, 人脸数: {face_count}")
+    yield total, total
+
 
-    max_index = max((int(key) for key in datameta_dict.keys()), default=0)
-    file_paths = list(datameta_dict.values())
+def gen_purge_vanished(batch_size=100):
+    """
+    清理磁盘上已经不存在的文件
+    :return: 生成器, 检查完成后每删除 batch_size 个文件返回一次 (当前数量, 总数)
+    """
+    store = get_face_store()
+    yield 0, 0
+    vanished = store.find_vanished_paths()
+    for i in range(0, len(vanished), batch_size):
+        store.remove_paths(vanished[i:i + batch_size])
+        yield min(i + batch_size, len(vanished)), len(vanished)
+    store.flush()
+    logger.info(f"已清理 {len(vanished)} 个不存在的文件")
+    yield len(vanished), len(vanished)
 
-    index = load_faiss_index()
 
-    for file_path, embs in emb_dict.items():
-        if file_path in file_paths:
-            print(f"file_path: {file_path} exists database, continue")
-            continue
-        else:
-            file_paths.append(file_path)
+def write_embedding(emb_dict: Dict[str, List[np.ndarray]]):
+    get_face_store().add(emb_dict)
 
-        for emb in embs:
-            index.add_with_ids(emb.reshape(1, -1), max_index + 1)
-            datameta_dict[max_index + 1] = file_path
-            max_index += 1
 
-    with open(datameta_path, 'w') as file:
-        json.dump(datameta_dict, file)
+def query_embedding(embs, k=10):
+    return get_face_store().search(embs, k=k)
 
-    save_faiss_index(index)
 
+if __name__ == '__main__':
+    import argparse
 
-def query_embedding(embs, k=10, datameta_path=DATAMETA_PATH):
-    if embs is None:
-        return []
+    parser = argparse.ArgumentParser(description="索引迁移、召回率评估与库维护")
+    parser.add_argument("command", choices=["migrate", "recall", "purge", "rebuild"])
+    parser.add_argument("--index-type", default=INDEX_TYPE, choices=INDEX_TYPES)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--nprobe", type=int, default=NPROBE)
+    parser.add_argument("--ef-search", type=int, default=EF_SEARCH)
+    args = parser.parse_args()
+    setup_logging()
 
-    if not os.path.exists(datameta_path):
-        datameta_dict = {}
+    face_store = FaceStore(index_type=args.index_type)
+    if args.command == "migrate":
+        face_store.migrate(args.index_type)
+    elif args.command == "purge":
+        face_store.purge_vanished()
+        face_store.rebuild()
+    elif args.command == "rebuild":
+        face_store.rebuild()
     else:
-        with open(datameta_path, 'r') as file:
-            datameta_dict = json.load(file)
-
-    index = load_faiss_index()
-    file_paths = []
-    for emb in embs:
-        distances, indices = index.search(emb.reshape(1, -1), k=k)
-        file_paths.extend([(score, datameta_dict[str(int(idx))])
-                           for idx, score in zip(indices[0], distances[0]) if idx > 0])
-    return file_paths
+        set_search_params(face_store.index, nprobe=args.nprobe, ef_search=args.ef_search)
+        print(evaluate_recall(face_store.index, k=args.k))
@@ -0,0 +1,341 @@
+# 入库前去重: 内容哈希相同的文件和感知哈希相近、像素比较确认过的图片/视频不再识别, 直接关联到已入库文件的人脸
+# 用法: python -m core.dedup backfill  为去重功能加入之前导入的文件补算感知哈希
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Dict, NamedTuple, Generator
+
+import cv2
+import faiss
+import numpy as np
+from PIL import Image
+
+from core.manifest import FileEntry, is_sampled_hash, full_file_hash
+from core.metadata import MetaStore
+from settings import ALLOWED_IMG_TYPES, ALLOWED_VIDEO_TYPES, DEDUP_MAX_DISTANCE, INGEST_DECODE_WORKERS, \
+    DEDUP_VERIFY_SIZE, DEDUP_VERIFY_MAX_DIFF
+
+logger = logging.getLogger(__name__)
+
+# 每段哈希的位数, 图片为 pHash + dHash 两段, 视频为 3 帧的 pHash 共 3 段
+SEGMENT_BITS = 64
+# 视频在时长的这些位置各取一帧
+VIDEO_HASH_POSITIONS = (0.25, 0.5, 0.75)
+# 灰度标准差低于该值的画面(纯色、黑屏)哈希没有区分度, 不参与感知去重
+MIN_GRAY_STD = 3.0
+# 汉明距离索引每次取的候选数, 再逐段检查距离
+HASH_CANDIDATES = 4
+# 像素比较时每边分成的块数
+VERIFY_GRID = 16
+# 像素比较时允许的宽高比相对差异, 1/4 尺寸解码有取整误差
+VERIFY_ASPECT_TOL = 0.02
+
+
+class DedupResult(NamedTuple):
+    # 需要识别的文件
+    files: List[FileEntry]
+    # 与已入库文件重复, 可以直接关联 [(FileEntry, 目标文件路径)]
+    linked: List[tuple]
+    # 与本批中待识别的文件重复, 目标文件识别成功后再关联 {目标文件路径: [FileEntry, ...]}
+    pending: Dict[str, List[FileEntry]]
+    # 本批文件的感知哈希 {path: (kind, code)}, 写入元数据供以后的去重使用
+    hashes: Dict[str, tuple]
+
+
+def phash(gray: np.ndarray) -> np.ndarray:
+    """
+    32x32 DCT 左上角 8x8 低频系数与中位数比较
+    :return: 8 字节
+    """
+    image = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(image)[:8, :8].flatten()
+    # 中位数不含直流分量
+    return np.packbits(low > np.median(low[1:]))
+
+
+def dhash(gray: np.ndarray) -> np.ndarray:
+    """
+    9x8 缩略图中水平相邻像素的大小关系
+    :return: 8 字节
+    """
+    image = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA).astype(np.int16)
+    return np.packbits((image[:, 1:] > image[:, :-1]).flatten())
+
+
+def read_gray_reduced(file_path) -> np.ndarray:
+    """
+    以 1/4 尺寸解码为灰度图, JPEG 在解码时直接缩小, 比完整解码快得多
+    """
+    image = cv2.imdecode(np.fromfile(file_path, dtype=np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_4)
+    if image is None:
+        image = np.array(Image.open(file_path).convert("L"))
+    return image
+
+
+def read_video_gray_frames(file_path, positions=VIDEO_HASH_POSITIONS) -> List[np.ndarray] | None:
+    cap = cv2.VideoCapture(file_path)
+    if not cap.isOpened():
+        return None
+    try:
+        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        if total_frames <= 0:
+            return None
+        frames = []
+        for position in positions:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, int(total_frames * position))
+            ret, frame = cap.read()
+            if not ret:
+                return None
+            frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+        return frames
+    finally:
+        cap.release()
+
+
+def perceptual_hash(file_path, img_types=ALLOWED_IMG_TYPES, video_types=ALLOWED_VIDEO_TYPES) -> tuple | None:
+    """
+    :return: (kind, code), 图片为 ("image", pHash + dHash), 视频为 ("video", 3 帧的 pHash);
+             不支持的类型、无法解码或画面没有区分度时返回 None
+    """
+    suffix = Path(file_path).suffix.lower()
+    if suffix in img_types:
+        gray = read_gray_reduced(file_path)
+        if gray.std() < MIN_GRAY_STD:
+            return None
+        return "image", np.concatenate([phash(gray), dhash(gray)])
+    if suffix in video_types:
+        frames = read_video_gray_frames(file_path)
+        if frames is None or any(frame.std() < MIN_GRAY_STD for frame in frames):
+            return None
+        return "video", np.concatenate([phash(frame) for frame in frames])
+    return None
+
+
+def _safe_perceptual_hash(file_path) -> tuple | None:
+    try:
+        return perceptual_hash(file_path)
+    except Exception as e:
+        logger.warning(f"感知哈希计算失败: {file_path}, {e}")
+        return None
+
+
+def read_verify_frames(file_path, kind) -> List[np.ndarray] | None:
+    if kind == "image":
+        return [read_gray_reduced(file_path)]
+    return read_video_gray_frames(file_path)
+
+
+def frames_match(a: np.ndarray, b: np.ndarray, size=DEDUP_VERIFY_SIZE, max_diff=DEDUP_VERIFY_MAX_DIFF) -> bool:
+    """
+    两张灰度图缩放到 size 见方后分成 VERIFY_GRID x VERIFY_GRID 块, 每一块的平均灰度差都不超过 max_diff;
+    宽高比不同(裁剪过)的不算相同
+    """
+    aspect_a, aspect_b = a.shape[1] / a.shape[0], b.shape[1] / b.shape[0]
+    if abs(aspect_a - aspect_b) > VERIFY_ASPECT_TOL * aspect_a:
+        return False
+    size -= size % VERIFY_GRID
+    a = cv2.resize(a, (size, size), interpolation=cv2.INTER_AREA).astype(np.float32)
+    b = cv2.resize(b, (size, size), interpolation=cv2.INTER_AREA).astype(np.float32)
+    step = size // VERIFY_GRID
+    blocks = np.abs(a - b).reshape(VERIFY_GRID, step, VERIFY_GRID, step).mean(axis=(1, 3))
+    return bool(blocks.max() <= max_diff)
+
+
+def verify_duplicate(file_path, target, kind) -> bool:
+    """
+    感知哈希只比较低频的轮廓, 连拍、相同构图的不同照片也会相近, 关联前解码两个文件逐块比较像素确认
+    目标文件已不存在或无法解码时不关联, 文件照常识别
+    """
+    try:
+        frames, target_frames = read_verify_frames(file_path, kind), read_verify_frames(target, kind)
+    except Exception as e:
+        logger.warning(f"去重像素比较失败: {file_path}, 目标文件: {target}, {e}")
+        return False
+    if frames is None or target_frames is None or len(frames) != len(target_frames):
+        return False
+    return all(frames_match(a, b) for a, b in zip(frames, target_frames))
+
+
+def contents_equal(file_path, target, size, full_hashes: Dict[str, str]) -> bool:
+    """
+    快速哈希相同的两个文件内容是否完全一致: 快速哈希覆盖了全部内容的小文件直接认为一致,
+    大文件读取两者的完整内容比较, 目标文件已不存在或无法读取时不算一致
+    :param full_hashes: {path: 完整哈希}, 同一批中已经算过的文件不再读取
+    """
+    if not is_sampled_hash(size):
+        return True
+    try:
+        for path in (file_path, target):
+            if path not in full_hashes:
+                full_hashes[path] = full_file_hash(path)
+    except OSError as e:
+        logger.warning(f"完整哈希计算失败: {file_path}, 目标文件: {target}, {e}")
+        return False
+    return full_hashes[file_path] == full_hashes[target]
+
+
+def segment_distances(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """
+    两个哈希每 64 bit 一段的汉明距离
+    """
+    return np.unpackbits(np.bitwise_xor(a, b)).reshape(-1, SEGMENT_BITS).sum(axis=1)
+
+
+class HammingIndex:
+    """
+    同一种感知哈希的汉明距离索引, 基于 faiss.IndexBinaryFlat, 按总距离取候选后逐段检查,
+    每一段的距离都不超过 max_distance 才算重复
+    """
+
+    def __init__(self, nbytes):
+        self.index = faiss.IndexBinaryFlat(nbytes * 8)
+        self.paths: List[str] = []
+
+    def add(self, paths: List[str], codes: np.ndarray):
+        self.index.add(np.ascontiguousarray(codes, dtype=np.uint8).reshape(len(paths), -1))
+        self.paths.extend(paths)
+
+    def find(self, code: np.ndarray, max_distance=DEDUP_MAX_DISTANCE) -> List[str]:
+        """
+        :return: 哈希相近的文件路径, 按距离从近到远
+        """
+        if self.index.ntotal == 0:
+            return []
+        code = np.ascontiguousarray(code, dtype=np.uint8).reshape(1, -1)
+        distances, indices = self.index.search(code, min(HASH_CANDIDATES, self.index.ntotal))
+        n_segments = code.shape[1] * 8 // SEGMENT_BITS
+        paths = []
+        for distance, i in zip(distances[0], indices[0]):
+            if i < 0 or distance > max_distance * n_segments:
+                break
+            if segment_distances(code[0], self.index.reconstruct(int(i))).max() <= max_distance:
+                paths.append(self.paths[i])
+        return paths
+
+    @classmethod
+    def load(cls, meta: MetaStore, kind, nbytes):
+        index = cls(nbytes)
+        paths, codes = meta.get_perceptual_hashes(kind)
+        if paths:
+            index.add(paths, codes)
+        return index
+
+
+# 各种感知哈希的字节数
+HASH_KINDS = {"image": 16, "video": 8 * len(VIDEO_HASH_POSITIONS)}
+
+
+def iter_find_duplicates(entries: List[FileEntry], meta: MetaStore, max_distance=DEDUP_MAX_DISTANCE,
+                         workers=INGEST_DECODE_WORKERS) -> Generator[tuple, None, DedupResult]:
+    """
+    先按内容哈希查找完全相同的文件, 快速哈希只采样的大文件再比较完整内容;
+    其余文件并行计算感知哈希, 在已入库文件和本批先出现的文件中查找相近的, 像素比较确认后才算重复; 重复文件统一关联到目标文件, 目标文件本身是重复文件时关联到它的目标文件
+    :return: 生成器, 每算完一个文件的感知哈希返回一次 (已完成数, 需要计算感知哈希的文件数), 结束时返回 DedupResult
+    """
+    files, linked, pending, hashes = [], [], {}, {}
+    # 本批中内容哈希第一次出现的文件: 内容哈希 -> 路径, 及与其内容相同的文件 {路径: [FileEntry, ...]}
+    batch_hashes, same_content, rest = {}, {}, []
+    # 快速哈希只采样了部分内容, 相同时再比较完整哈希
+    full_hashes = {}
+    for entry in entries:
+        first = batch_hashes.get(entry.hash)
+        if first is not None and contents_equal(entry.path, first, entry.size, full_hashes):
+            same_content.setdefault(first, []).append(entry)
+            continue
+        target = next((path for path in meta.find_paths_by_hash(entry.hash)
+                       if path != entry.path and contents_equal(entry.path, path, entry.size, full_hashes)), None)
+        if target is not None:
+            linked.append((entry, meta.get_link_targets([target]).get(target, target)))
+        else:
+            batch_hashes.setdefault(entry.hash, entry.path)
+            rest.append(entry)
+
+    indexes = {kind: HammingIndex.load(meta, kind, nbytes) for kind, nbytes in HASH_KINDS.items()}
+    batch_paths = {entry.path for entry in rest}
+    rejected = 0
+    executor = ThreadPoolExecutor(max_workers=max(1, workers))
+    try:
+        codes = executor.map(_safe_perceptual_hash, [entry.path for entry in rest])
+        for i, (entry, code) in enumerate(zip(rest, codes), 1):
+            if code is None:
+                files.append(entry)
+                yield i, len(rest)
+                continue
+            hashes[entry.path] = code
+            kind, bits = code
+            candidates = indexes[kind].find(bits, max_distance)
+            target = next((path for path in candidates if verify_duplicate(entry.path, path, kind)), None)
+            rejected += bool(candidates) and target is None
+            if target is None:
+                indexes[kind].add([entry.path], bits)
+                files.append(entry)
+            elif target in batch_paths:
+                pending.setdefault(target, []).append(entry)
+            else:
+                linked.append((entry, meta.get_link_targets([target]).get(target, target)))
+            yield i, len(rest)
+    finally:
+        # 中途停止时不再计算剩下的文件
+        executor.shutdown(cancel_futures=True)
+
+    # 内容相同的文件跟随第一次出现的文件, 它本身是重复文件时关联到同一个目标文件
+    linked_targets = {entry.path: target for entry, target in linked}
+    pending_targets = {entry.path: target for target, duplicates in pending.items() for entry in duplicates}
+    for path, duplicates in same_content.items():
+        if path in linked_targets:
+            linked.extend((entry, linked_targets[path]) for entry in duplicates)
+        else:
+            pending.setdefault(pending_targets.get(path, path), []).extend(duplicates)
+
+    n_pending = sum(len(duplicates) for duplicates in pending.values())
+    logger.info(f"去重完成, 待识别: {len(files)}, 与已入库文件重复: {len(linked)}, 本批内重复: {n_pending}, "
+                f"哈希相近但像素不同: {rejected}")
+    return DedupResult(files, linked, pending, hashes)
+
+
+def find_duplicates(entries: List[FileEntry], meta: MetaStore, max_distance=DEDUP_MAX_DISTANCE,
+                    workers=INGEST_DECODE_WORKERS) -> DedupResult:
+    """
+    同 iter_find_duplicates, 不需要进度时使用
+    """
+    steps = iter_find_duplicates(entries, meta, max_distance, workers)
+    while True:
+        try:
+            next(steps)
+        except StopIteration as stop:
+            return stop.value
+
+
+def backfill_hashes(meta: MetaStore, workers=INGEST_DECODE_WORKERS, batch_size=1000) -> int:
+    """
+    为清单中还没有感知哈希的文件补算, 之后导入的相近文件才能与它们去重
+    :return: 写入的哈希数量
+    """
+    paths, count = meta.paths_without_perceptual_hash(), 0
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for i in range(0, len(paths), batch_size):
+            chunk = paths[i:i + batch_size]
+            rows = [(path, code[0], code[1].tobytes())
+                    for path, code in zip(chunk, executor.map(_safe_perceptual_hash, chunk)) if code is not None]
+            meta.update_perceptual_hashes(rows)
+            meta.commit()
+            count += len(rows)
+            logger.info(f"感知哈希补算进度: {min(i + batch_size, len(paths))}/{len(paths)}")
+    return count
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from core.database import get_face_store
+    from core.utils import setup_logging
+
+    parser = argparse.ArgumentParser(description="入库去重")
+    parser.add_argument("command", choices=["backfill"])
+    args = parser.parse_args()
+    setup_logging()
+
+    store = get_face_store()
+    if args.command == "backfill":
+        print(f"已补算 {backfill_hashes(store.meta)} 个文件的感知哈希")
+    store.close()
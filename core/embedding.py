@@ -1,17 +1,29 @@
+import logging
 import os.path
+import time
 from pathlib import Path
 from typing import List
 
 import cv2
 import numpy as np
 from PIL import Image
-from insightface.app.common import Face
 
-from core.database import write_embedding, get_exist_keys
-from core.face_analysis import buffalo_model
-from core.utils import get_files_from_list, exception_print
-from core.yolo import detect_faces_results
-from settings import FILE_MAX_BYTE_CNT, WRITE_BATCH_SIZE, ALLOWED_IMG_TYPES, ALLOWED_VIDEO_TYPES
+from core.database import get_face_store
+from core.dedup import iter_find_duplicates, DedupResult
+from core.face_analysis import Face, get_faces_batch, scrfd_detect_arrays
+from core.manifest import scan_files, FileEntry, ScanResult
+from core.metrics import metrics
+from core.pipeline import run_pipeline
+from core.thumbnails import get_thumbnail_cache
+from core.tracking import extract_video_face_tracks, select_track_representatives
+from core.utils import exception_print
+from core.video import iter_video_frames, iter_frame_batches
+from core.yolo import detect_faces_arrays, detect_faces_batch
+from settings import FILE_MAX_BYTE_CNT, WRITE_BATCH_SIZE, ALLOWED_IMG_TYPES, ALLOWED_VIDEO_TYPES, \
+    INGEST_DECODE_WORKERS, INGEST_INFER_WORKERS, INGEST_BATCH_SIZE, INGEST_QUEUE_SIZE, VIDEO_DETECTOR, IMAGE_DETECTOR, \
+    VIDEO_INGEST_MODE, YOLO_BATCH_SIZE, THUMBNAIL_ON_INGEST, DEDUP_ENABLED
+
+logger = logging.getLogger(__name__)
 
 
 def get_embeddings_by_media(file_path, img_types, video_types):
@@ -20,191 +32,274 @@ def get_embeddings_by_media(file_path, img_types, video_types):
     :param file_path: 文件路径
     :return:
     """
+    faces = get_faces_by_media(file_path, img_types, video_types)
+    if faces is None:
+        return
+    return [face["embedding"] for face in faces]
+
+
+def get_faces_by_media(file_path, img_types, video_types) -> List[Face] | None:
+    """
+    输入文件路径返回检测到的人脸, 包含 embedding、bbox、det_score, 视频中的人脸还有 frame_ts
+    :param file_path: 文件路径
+    :return:
+    """
     if not os.path.isfile(file_path):
         return
 
+    decoded = decode_media(file_path, img_types, video_types)
+    # 视频可能不存在人脸
+    if not decoded:
+        return
+    return infer_media([decoded])[0]
+
+
+def decode_media(file_path, img_types=ALLOWED_IMG_TYPES, video_types=ALLOWED_VIDEO_TYPES) -> List[tuple] | None:
+    """
+    读取待识别的画面
+    图片直接解码; 视频在 tracks 模式下返回每条人脸轨迹的候选帧, best_frame 模式下只返回人脸置信度最高的一帧
+    :return: [(BGR 图片, 检测结果 (boxes, scores, kpss) 或 None, 帧时间戳, 轨迹 id), ...],
+             不支持的类型返回 None, 视频中没有人脸时返回空列表
+    """
     suffix = Path(file_path).suffix.lower()
     try:
-        if suffix in img_types:
-            return get_img_embeddings(file_path)
-        elif suffix in video_types:
-            image = extract_video_face_return_image(file_path)
-            # 视频可能不存在人脸
-            if image is None:
-                return
-            return get_img_embeddings(image)
+        # 视频的解码耗时包含了抽帧时交替进行的人脸检测
+        with metrics.timer("decode"):
+            if suffix in img_types:
+                return [(read_image(file_path), None, None, None)]
+            elif suffix in video_types:
+                if VIDEO_INGEST_MODE == "tracks":
+                    return extract_video_face_tracks(file_path, get_video_detect_batch_func())
+                if VIDEO_DETECTOR == "yolo":
+                    result = extract_video_face_return_detections(file_path)
+                    return [] if result is None else [(result[0], result[1], None, None)]
+                image = extract_video_face_return_image(file_path)
+                return [] if image is None else [(image, None, None, None)]
     except Exception as e:
         raise Exception(f"file_path: {file_path}, suffix: {suffix}") from e
 
 
-def get_img_embeddings(image):
-    try:
-        results: List[Face] = buffalo_model.get(image)
-    except:
-        image = Image.open(image)
+def infer_media(decoded_list: List[List[tuple] | None]) -> List[List[Face]]:
+    """
+    对多个文件的 decode_media 结果批量检测和识别, 所有画面中的人脸合并为一个识别 batch
+    已有检测结果的画面只运行识别模型; 带轨迹 id 的视频人脸按轨迹挑选代表性的人脸
+    """
+    # 流水线中推理线程的顶层阶段, 检测和识别的耗时是它内部的步骤
+    with metrics.timer("infer", items=len(decoded_list)):
+        frames = [frame for decoded in decoded_list for frame in decoded or []]
+        images = [image for image, _, _, _ in frames]
+        # 跟踪得到的是人脸附近的裁剪区域, 检测结果带有裁剪区域在原画面中的偏移量
+        offsets = [detection[3] if detection is not None and len(detection) > 3 else None
+                   for _, detection, _, _ in frames]
+        detections = [None if detection is None else detection[:3] for _, detection, _, _ in frames]
+        if IMAGE_DETECTOR == "yolo":
+            # 需要检测的图片合并为一批
+            pending = [i for i, (image, detection) in enumerate(zip(images, detections))
+                       if detection is None and image is not None]
+            for i, detection in zip(pending, detect_faces_batch([images[i] for i in pending])):
+                detections[i] = detection
+        faces_list = get_faces_batch(images, detections)
+        for faces, offset in zip(faces_list, offsets):
+            if offset is None:
+                continue
+            for face in faces:
+                face.bbox = face.bbox + np.tile(offset, 2)
+                face.kps = face.kps + offset
+
+        results, offset = [], 0
+        for decoded in decoded_list:
+            decoded = decoded or []
+            faces, track_ids = [], []
+            for (_, _, frame_ts, track_id), frame_faces in zip(decoded, faces_list[offset:offset + len(decoded)]):
+                for face in frame_faces:
+                    face.frame_ts = frame_ts
+                    faces.append(face)
+                    track_ids.append(track_id)
+            offset += len(decoded)
+            if any(track_id is not None for track_id in track_ids):
+                faces = select_track_representatives(faces, track_ids)
+            results.append(faces)
+        return results
+
+
+def read_image(file_path) -> np.ndarray:
+    """
+    读取为 BGR 三通道图片, np.fromfile 兼容中文路径, OpenCV 解码失败时用 PIL 兜底
+    """
+    image = cv2.imdecode(np.fromfile(file_path, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        image = Image.open(file_path)
         # 转换为三通道, 有的为四通道
-        image = image.convert("RGB")
-        results: List[Face] = buffalo_model.get(np.array(image))
-
-    emb_list = []
-    for res in results:
-        emb_list.append(res["embedding"])
-    return emb_list
-
-
-def extract_video_face_return_image(video_path, fps=5, max_score=0.8) -> np.ndarray | None:
-    cap = cv2.VideoCapture(video_path)
-    frame_count, t_max_score, image = 0, 0, None
-    while True:
-        ret, frame = cap.read()
-        if not ret: break
-        if frame_count % int(cap.get(cv2.CAP_PROP_FPS) / fps) != 0:
-            frame_count += 1
-            continue
-        else:
-            frame_count += 1
+        image = cv2.cvtColor(np.array(image.convert("RGB")), cv2.COLOR_RGB2BGR)
+    return image
 
-        resized_frame = cv2.resize(frame, (640, 640))
-        confidence_list = get_face_confidence(resized_frame)
-        for confidence in confidence_list:
-            # 如果当前比率大于最大值，则返回当前帧
-            if confidence >= max_score:
-                return frame
 
-            if confidence <= t_max_score:
-                continue
-            else:
-                image = frame
-                t_max_score = confidence
+def get_img_embeddings(image):
+    return [res["embedding"] for res in get_img_faces(image)]
 
-    if image is not None:
-        return image
 
+def get_img_faces(image) -> List[Face]:
+    if isinstance(image, str):
+        image = read_image(image)
+    return infer_media([[(image, None, None, None)]])[0]
 
-def get_face_confidence(frame_buffer) -> List[float]:
-    confidence_list = []
-    results = detect_faces_results(frame_buffer)
-    for result in results:
-        summary = result.summary()
-        if not summary:
-            continue
 
-        confidence_list.append(summary[0]["confidence"])
+def get_video_detect_batch_func():
+    """
+    :return: 视频帧的批量检测函数 [frame, ...] -> [(boxes, scores, kpss), ...]
+    """
+    if VIDEO_DETECTOR == "yolo":
+        return detect_faces_batch
+    return lambda frames: [scrfd_detect_arrays(frame) for frame in frames]
 
-    return confidence_list
 
+def extract_video_face_return_detections(video_path, fps=5, max_score=0.8, batch_size=YOLO_BATCH_SIZE,
+                                         detect_batch_func=detect_faces_batch):
+    """
+    抽帧后每 batch_size 帧用 YOLO 批量检测一次, 返回人脸置信度最高的一帧及其检测结果,
+    某一批中出现置信度不低于 max_score 的人脸时提前结束
+    :return: (frame, (boxes, scores, kpss)), 没有人脸时返回 None
+    """
+    best = None
+    for batch in iter_frame_batches(iter_video_frames(video_path, sample_fps=fps), batch_size):
+        for (_, frame), (boxes, scores, kpss) in zip(batch, detect_batch_func([frame for _, frame in batch])):
+            if len(scores) == 0:
+                continue
+            confidence = float(scores.max())
+            if best is None or confidence > best[0]:
+                best = (confidence, frame, (boxes, scores, kpss))
 
-def extract_video_face_return_image1(video_path, fps=5, max_score=0.8, shape=(640, 640)) -> np.ndarray | None:
-    # 初始化视频捕获
-    cap = cv2.VideoCapture(video_path)
-    if not cap.isOpened():
-        print(f"无法打开视频文件, video_path: {video_path}")
-        return None
+        # 如果当前比率大于最大值，则返回当前帧
+        if best is not None and best[0] >= max_score:
+            break
 
-    # 获取视频基本信息
-    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    video_fps = cap.get(cv2.CAP_PROP_FPS)
-    frame_interval = max(1, int(video_fps / fps))
+    if best is not None:
+        return best[1], best[2]
 
-    # 预分配缓冲区
-    frame_buffer = np.empty((shape[0], shape[1], 3), dtype=np.uint8)
-    best_image, best_score = None, 0
 
-    # 使用多尺度采样策略
-    sampling_strategy = [
-        (0, min(100, total_frames // 10), 1),  # 开头部分密集采样
-        (total_frames - 100, total_frames, 1),  # 结尾部分密集采样
-        (100, total_frames - 100, frame_interval),  # 中间部分常规采样
-    ]
+def extract_video_face_return_image(video_path, fps=5, max_score=0.8) -> np.ndarray | None:
+    result = extract_video_face_return_detections(video_path, fps=fps, max_score=max_score)
+    if result is not None:
+        return result[0]
 
-    for start, end, interval in sampling_strategy:
-        if start >= end:
-            continue
 
-        # 跳转到起始帧
-        cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+def get_face_confidence(frame_buffer) -> List[float]:
+    return detect_faces_arrays(frame_buffer)[1].tolist()
 
-        frame_cnt = start
-        for frame_pos in range(start, end, 1):
-            ret, frame = cap.read()
-            if not ret:
-                break
-            else:
-                frame_cnt += 1
 
-            if frame_cnt % interval != 0:
-                continue
+def check_file_size(file_path):
+    if os.path.getsize(file_path) > FILE_MAX_BYTE_CNT:
+        logger.warning(f"file_path: {file_path} too large, continue")
+        return False
+    return True
 
-            # 快速人脸检测预处理
-            cv2.resize(frame, shape, frame_buffer)
 
-            # 完整人脸检测
-            confidence_list = get_face_confidence(frame_buffer)
-            for confidence in confidence_list:
-                # 达到阈值立即返回
-                print(f"confidence: {confidence}, frame_cnt: {frame_cnt}")
-                if confidence >= max_score:
-                    cap.release()
-                    return frame
+def decode_entry(entry: FileEntry):
+    decoded = decode_media(entry.path)
+    # 在解码线程中用已经解码的画面生成缩略图, 检索结果不需要再读取原文件
+    if THUMBNAIL_ON_INGEST and decoded:
+        try:
+            get_thumbnail_cache().put_frames(entry.path, decoded, entry.size, entry.mtime)
+        except Exception as e:
+            logger.warning(f"缩略图生成失败: {entry.path}, {e}")
+    return decoded
 
-                # 更新最佳人脸
-                if confidence > best_score:
-                    best_image = frame
-                    best_score = confidence
 
-    cap.release()
-    return best_image if best_score > 0 else None
+def scan_for_ingest(paths: List[str], store) -> ScanResult:
+    """
+    对比文件清单, 只返回新增或内容变化的文件; 重命名的文件直接更新路径, 内容变化的文件先删除旧的人脸数据
+    """
+    b = time.perf_counter()
+    scan = scan_files(paths, store.meta)
+    metrics.observe("file_walk", time.perf_counter() - b, len(scan.files) + scan.unchanged)
+    for old_path, entry in scan.renamed:
+        store.rename_path(old_path, entry.path)
+    store.update_manifest(entry for _, entry in scan.renamed)
+    store.remove_paths(scan.changed)
+    return scan
 
 
-def check_file_size(file_path):
-    if os.path.getsize(file_path) > FILE_MAX_BYTE_CNT:
-        print(f"file_path: {file_path} too large, continue")
-        return False
-    return True
+def get_hash_rows(dedup: DedupResult, paths: List[str]) -> List[tuple]:
+    """
+    :return: 去重时算出的感知哈希 [(path, kind, code), ...]
+    """
+    return [(path, *dedup.hashes[path]) for path in paths if path in dedup.hashes]
 
 
 @exception_print
-def gen_embedding(paths: List[str]):
-    # 获取所有的文件列表
-    exists_files = get_exist_keys()
-    file_list = get_files_from_list(paths, exists_files)
-    del exists_files
-    file_size, emb_dict = len(file_list), {}
-    for index, file_path in enumerate(file_list):
+def gen_embedding(paths: List[str], decode_workers=INGEST_DECODE_WORKERS, infer_workers=INGEST_INFER_WORKERS,
+                  batch_size=INGEST_BATCH_SIZE, queue_size=INGEST_QUEUE_SIZE):
+    """
+    入库, 读取解码、批量推理、写入分阶段并行执行
+    :return: 生成器, 每处理完一个文件返回一次 (当前数量, 总数); 去重阶段每算完一个文件的感知哈希返回一次
+             (已完成数, 需要计算感知哈希的文件数)
+    """
+    store = get_face_store()
+    scan = scan_for_ingest(paths, store)
+
+    file_size, current, file_list = len(scan.files), 0, []
+    for entry in scan.files:
         # 检查文件大小
-        if not check_file_size(file_path):
-            yield index + 1, file_size
-            continue
+        if not check_file_size(entry.path):
+            metrics.incr("files_skipped")
+            current += 1
+            yield current, file_size
+        else:
+            file_list.append(entry)
+
+    # 入库前去重, 重复文件不进入识别流水线, 直接关联到目标文件的人脸
+    dedup = DedupResult(file_list, [], {}, {})
+    if DEDUP_ENABLED and file_list:
+        with metrics.timer("dedup", items=len(file_list)):
+            dedup = yield from iter_find_duplicates(file_list, store.meta, workers=decode_workers)
+        store.update_dedup(dedup.linked, get_hash_rows(dedup, [entry.path for entry, _ in dedup.linked]))
+        metrics.incr("files_duplicate", len(dedup.linked))
+        current += len(dedup.linked)
+        yield current, file_size
+
+    emb_dict, manifest_entries, link_entries, hash_rows = {}, [], [], []
+    for entry, faces, error in run_pipeline(dedup.files, decode_entry, infer_media, decode_workers=decode_workers,
+                                            infer_workers=infer_workers, batch_size=batch_size,
+                                            queue_size=queue_size):
+        file_path = entry.path
+        # 与本文件重复的文件随本文件一起完成
+        duplicates = dedup.pending.get(file_path, [])
+        current += 1 + len(duplicates)
 
         # 写入数据库
         if len(emb_dict.keys()) > WRITE_BATCH_SIZE:
-            write_embedding(emb_dict)
-            emb_dict = {}
-
-        try:
-            embs = get_embeddings_by_media(file_path, ALLOWED_IMG_TYPES, ALLOWED_VIDEO_TYPES)
-        except Exception as e:
-            import traceback
-            traceback.print_exc()
-            traceback.print_stack()
-            print(f"识别错误文件: {file_path}")
-            yield index + 1, file_size
+            store.add(emb_dict)
+            store.update_manifest(manifest_entries)
+            store.update_dedup(link_entries, hash_rows)
+            emb_dict, manifest_entries, link_entries, hash_rows = {}, [], [], []
+
+        if error is not None:
+            logger.error(f"识别错误文件: {file_path}, 重复文件 {len(duplicates)} 个下次扫描时重新处理", exc_info=error)
+            metrics.incr("files_failed")
+            yield current, file_size
             continue
 
-        if not embs:
-            print(f"未识别到人脸: {file_path}")
-            yield index + 1, file_size
+        # 没有人脸的文件也记入清单, 下次扫描时跳过
+        manifest_entries.append(entry)
+        link_entries.extend((duplicate, file_path) for duplicate in duplicates)
+        hash_rows.extend(get_hash_rows(dedup, [file_path] + [duplicate.path for duplicate in duplicates]))
+        metrics.incr("files_processed")
+        metrics.incr("files_duplicate", len(duplicates))
+        if not faces:
+            metrics.incr("files_no_face")
+            logger.debug(f"未识别到人脸: {file_path}")
+            yield current, file_size
             continue
 
-        emb_dict[file_path] = embs
-        for emb in embs:
-            print(type(emb))
-            print(f"file_path: {file_path}, emb: {emb}")
-        yield index + 1, file_size
+        emb_dict[file_path] = faces
+        metrics.incr("faces_found", len(faces))
+        logger.debug(f"file_path: {file_path}, 人脸数: {len(faces)}")
+        yield current, file_size
 
     if emb_dict:
-        write_embedding(emb_dict)
+        store.add(emb_dict)
+    store.update_manifest(manifest_entries)
+    store.update_dedup(link_entries, hash_rows)
+    store.flush()
 
     yield file_size, file_size
-
-
@@ -1,7 +1,164 @@
-from insightface.app import FaceAnalysis
+from typing import List, TYPE_CHECKING
 
+import cv2
+import numpy as np
+from skimage.transform import SimilarityTransform
 
-buffalo_model = FaceAnalysis(name=r"D:\models\insightface\buffalo_l", providers=['CUDAExecutionProvider'])
-buffalo_model.prepare(ctx_id=0)
+from core.metrics import metrics
+from core.models import get_buffalo_model
 
+if TYPE_CHECKING:
+    # insightface 会导入 onnxruntime, 只在第一次加载模型时导入, 使用替代模型的基准不需要安装
+    from insightface.app import FaceAnalysis
 
+# 68 点关键点中左眼、右眼、鼻尖、左嘴角、右嘴角的下标, 顺序与 ArcFace 对齐模板的 5 点一致
+LMK68_LEFT_EYE = slice(36, 42)
+LMK68_RIGHT_EYE = slice(42, 48)
+LMK68_NOSE = 30
+LMK68_LEFT_MOUTH = 48
+LMK68_RIGHT_MOUTH = 54
+# ArcFace 112x112 对齐模板的 5 点坐标
+ARCFACE_DST = np.array([[38.2946, 51.6963], [73.5318, 51.5014], [56.0252, 71.7366], [41.5493, 92.3655],
+                        [70.7299, 92.2041]], dtype=np.float32)
+
+
+class Face(dict):
+    """
+    与 insightface.app.common.Face 相同的属性字典: 属性和键互通, 不存在的属性为 None,
+    insightface 的模型按 face.bbox 读取、按 face[key] 写入结果, 两种 Face 可以混用
+    """
+
+    def __init__(self, d=None, **kwargs):
+        super().__init__()
+        for key, value in dict(d or {}, **kwargs).items():
+            self[key] = value
+
+    def __getattr__(self, name):
+        return self.get(name)
+
+    def __setattr__(self, name, value):
+        self[name] = value
+
+
+def norm_crop(image: np.ndarray, kps: np.ndarray, image_size=112) -> np.ndarray:
+    """
+    按 5 点关键点相似变换到 ArcFace 模板, 与 insightface.utils.face_align.norm_crop 的计算相同
+    """
+    if image_size % 112 == 0:
+        ratio, diff_x = image_size / 112.0, 0.0
+    else:
+        ratio = image_size / 128.0
+        diff_x = 8.0 * ratio
+    dst = ARCFACE_DST * ratio
+    dst[:, 0] += diff_x
+    tform = SimilarityTransform()
+    tform.estimate(kps, dst)
+    return cv2.warpAffine(image, tform.params[0:2, :], (image_size, image_size), borderValue=0.0)
+
+
+def __getattr__(name):
+    # 兼容旧代码的 from core.face_analysis import buffalo_model, 访问时才加载模型
+    if name == "buffalo_model":
+        return get_buffalo_model()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def detect_faces(image: np.ndarray, model: "FaceAnalysis" = None) -> List[Face]:
+    """
+    只做人脸检测, 返回带 bbox、kps、det_score 的 Face, 不计算 embedding
+    """
+    model = get_buffalo_model() if model is None else model
+    with metrics.timer("buffalo_detect"):
+        bboxes, kpss = model.det_model.detect(image, max_num=0, metric='default')
+    faces = []
+    for i in range(bboxes.shape[0]):
+        faces.append(Face(bbox=bboxes[i, 0:4], kps=None if kpss is None else kpss[i], det_score=bboxes[i, 4]))
+    return faces
+
+
+def scrfd_detect_arrays(image: np.ndarray, model: "FaceAnalysis" = None):
+    """
+    SCRFD 检测, 返回格式与 core.yolo.detect_faces_arrays 一致
+    :return: (boxes (n, 4), scores (n,), kpss (n, 5, 2))
+    """
+    model = get_buffalo_model() if model is None else model
+    with metrics.timer("buffalo_detect"):
+        bboxes, kpss = model.det_model.detect(image, max_num=0, metric='default')
+    return bboxes[:, 0:4], bboxes[:, 4], kpss
+
+
+def landmarks_to_kps(landmarks: np.ndarray) -> np.ndarray:
+    """
+    68 点关键点转为对齐用的 5 点
+    """
+    landmarks = landmarks[:, :2]
+    return np.stack([
+        landmarks[LMK68_LEFT_EYE].mean(axis=0),
+        landmarks[LMK68_RIGHT_EYE].mean(axis=0),
+        landmarks[LMK68_NOSE],
+        landmarks[LMK68_LEFT_MOUTH],
+        landmarks[LMK68_RIGHT_MOUTH],
+    ]).astype(np.float32)
+
+
+def faces_from_boxes(image: np.ndarray, boxes: np.ndarray, scores: np.ndarray, kpss: np.ndarray | None = None,
+                     model: "FaceAnalysis" = None) -> List[Face]:
+    """
+    使用外部检测器(如 YOLO)的结果构造 Face, 不再运行 SCRFD
+    检测器没有关键点时用 68 点关键点模型在框内定位, 换算成对齐用的 5 点
+    """
+    model = get_buffalo_model() if model is None else model
+    faces = []
+    for i in range(len(boxes)):
+        face = Face(bbox=np.asarray(boxes[i], dtype=np.float32), det_score=float(scores[i]),
+                    kps=None if kpss is None else np.asarray(kpss[i], dtype=np.float32))
+        if face.kps is None:
+            with metrics.timer("landmark"):
+                model.models['landmark_3d_68'].get(image, face)
+            face.kps = landmarks_to_kps(face.landmark_3d_68)
+        faces.append(face)
+    return faces
+
+
+def recognize_faces(images: List[np.ndarray], faces_list: List[List[Face]], model: "FaceAnalysis" = None):
+    """
+    批量计算 embedding, 多张图片中的所有人脸对齐后拼成一个 batch, 只调用一次识别模型
+    :param images: BGR 图片
+    :param faces_list: 与 images 一一对应的人脸列表, 结果写入 face.embedding
+    """
+    model = get_buffalo_model() if model is None else model
+    rec_model = model.models['recognition']
+    crops, owners = [], []
+    for image, faces in zip(images, faces_list):
+        for face in faces:
+            crops.append(norm_crop(image, face.kps, image_size=rec_model.input_size[0]))
+            owners.append(face)
+    if not crops:
+        return
+
+    with metrics.timer("recognition", items=len(crops)):
+        embeddings = rec_model.get_feat(crops)
+    for face, embedding in zip(owners, embeddings):
+        face.embedding = embedding.flatten()
+
+
+def get_faces_batch(images: List[np.ndarray | None], detections: List[tuple | None] = None,
+                    model: "FaceAnalysis" = None) -> List[List[Face]]:
+    """
+    批量检测和识别, 检测逐张进行, 识别跨图片合并为一个 batch
+    :param images: BGR 图片, None 表示没有可用的画面
+    :param detections: 与 images 对应的已有检测结果 (boxes, scores, kpss), 为 None 的位置用 SCRFD 检测
+    """
+    model = get_buffalo_model() if model is None else model
+    detections = detections or [None] * len(images)
+    faces_list = []
+    for image, detection in zip(images, detections):
+        if image is None:
+            faces_list.append([])
+        elif detection is not None:
+            faces_list.append(faces_from_boxes(image, *detection, model=model))
+        else:
+            faces_list.append(detect_faces(image, model))
+    recognize_faces([image for image in images if image is not None],
+                    [faces for image, faces in zip(images, faces_list) if image is not None], model)
+    return faces_list
@@ -0,0 +1,360 @@
+# 分布式入库: 共享存储上的 SQLite 任务队列, 多台机器上的无界面节点各自加载模型识别, 结果写成独立的结果文件,
+# 最后由持有索引的进程合并进主索引和元数据
+# 用法:
+#   python -m core.ingest_queue submit 文件夹 ...     扫描文件清单, 按 INGEST_JOB_SIZE 拆成任务
+#   python -m core.ingest_queue worker               在任意节点上运行, 领取任务直到队列为空
+#   python -m core.ingest_queue merge                合并已完成的任务
+#   python -m core.ingest_queue status
+# 所有节点看到的文件路径需要一致(相同的挂载点)
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from typing import List, NamedTuple
+
+import numpy as np
+
+from core.database import get_face_store, EMBEDDING_DIM
+from core.manifest import FileEntry
+from core.utils import setup_logging, atomic_write
+from settings import INGEST_QUEUE_DIR, INGEST_JOB_SIZE, INGEST_LEASE_SECONDS, INGEST_MAX_ATTEMPTS, \
+    INGEST_DECODE_WORKERS, INGEST_INFER_WORKERS, INGEST_BATCH_SIZE, INGEST_QUEUE_SIZE
+
+logger = logging.getLogger(__name__)
+
+QUEUE_DB = "queue.db"
+RESULT_DIR = "results"
+
+# 任务状态: pending 等待领取, running 已被领取(租约过期后可以重新领取), done 结果文件已写好,
+# merged 已合并进主索引, failed 超过最大尝试次数
+JOB_STATUSES = ("pending", "running", "done", "merged", "failed")
+
+
+class Job(NamedTuple):
+    id: int
+    entries: List[FileEntry]
+    attempts: int
+
+
+class JobQueue:
+    """
+    任务和租约都保存在 queue_dir/queue.db 中, 领取任务在 BEGIN IMMEDIATE 事务中进行, 同一任务只会被一个节点持有;
+    节点定期续租, 进程退出或机器宕机后租约过期, 任务被其他节点重新领取
+    网络文件系统不支持 WAL 需要的共享内存, 这里使用默认的回滚日志
+    """
+
+    def __init__(self, queue_dir=INGEST_QUEUE_DIR, lease_seconds=INGEST_LEASE_SECONDS,
+                 max_attempts=INGEST_MAX_ATTEMPTS):
+        self.queue_dir = queue_dir
+        self.result_dir = os.path.join(queue_dir, RESULT_DIR)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        os.makedirs(self.result_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(queue_dir, QUEUE_DB), timeout=60, isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY,
+                entries TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                worker TEXT,
+                lease_until REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                result TEXT,
+                error TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status);
+            -- 已入队且尚未合并的文件, 重复提交时跳过
+            CREATE TABLE IF NOT EXISTS queued_files (
+                path TEXT PRIMARY KEY,
+                job_id INTEGER NOT NULL
+            );
+        """)
+
+    def submit(self, entries: List[FileEntry], job_size=INGEST_JOB_SIZE) -> int:
+        """
+        按 job_size 个文件一个任务入队, 已在队列中等待处理或合并的文件跳过
+        :return: 新增的任务数
+        """
+        job_count = 0
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                queued = {row[0] for row in self.conn.execute("SELECT path FROM queued_files")}
+                entries = [entry for entry in entries if entry.path not in queued]
+                for i in range(0, len(entries), job_size):
+                    chunk = entries[i:i + job_size]
+                    job_id = self.conn.execute("INSERT INTO jobs (entries) VALUES (?)",
+                                               (json.dumps([list(entry) for entry in chunk], ensure_ascii=False),)
+                                               ).lastrowid
+                    self.conn.executemany("INSERT INTO queued_files (path, job_id) VALUES (?, ?)",
+                                          [(entry.path, job_id) for entry in chunk])
+                    job_count += 1
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+        return job_count
+
+    def claim(self, worker) -> Job | None:
+        """
+        领取一个等待中或租约已过期的任务, 尝试次数用完的任务标记为 failed
+        :return: 没有可领取的任务时返回 None
+        """
+        now = time.time()
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.execute(
+                    "UPDATE jobs SET status = 'failed', error = COALESCE(error, '租约过期次数超过上限') "
+                    "WHERE status = 'running' AND lease_until < ? AND attempts >= ?", (now, self.max_attempts))
+                row = self.conn.execute(
+                    "SELECT id, entries, attempts FROM jobs WHERE status = 'pending' "
+                    "OR (status = 'running' AND lease_until < ?) ORDER BY id LIMIT 1", (now,)).fetchone()
+                if row is not None:
+                    self.conn.execute(
+                        "UPDATE jobs SET status = 'running', worker = ?, lease_until = ?, attempts = attempts + 1 "
+                        "WHERE id = ?", (worker, now + self.lease_seconds, row[0]))
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        return Job(row[0], [FileEntry(*entry) for entry in json.loads(row[1])], row[2] + 1)
+
+    def _update_owned(self, job: Job, worker, sql, params=()) -> bool:
+        """
+        只在节点仍持有任务时更新, 租约过期后被其他节点领取的任务不会被旧节点覆盖
+        """
+        with self._lock:
+            cursor = self.conn.execute(f"{sql} WHERE id = ? AND worker = ? AND attempts = ? AND status = 'running'",
+                                       (*params, job.id, worker, job.attempts))
+        return cursor.rowcount == 1
+
+    def heartbeat(self, job: Job, worker) -> bool:
+        return self._update_owned(job, worker, "UPDATE jobs SET lease_until = ?", (time.time() + self.lease_seconds,))
+
+    def complete(self, job: Job, worker, result_file) -> bool:
+        return self._update_owned(job, worker, "UPDATE jobs SET status = 'done', result = ?",
+                                  (os.path.relpath(result_file, self.queue_dir),))
+
+    def fail(self, job: Job, worker, error) -> bool:
+        """
+        任务出错后重新排队, 尝试次数用完时标记为 failed
+        """
+        status = "failed" if job.attempts >= self.max_attempts else "pending"
+        return self._update_owned(job, worker, "UPDATE jobs SET status = ?, error = ?", (status, error))
+
+    def done_jobs(self) -> List[tuple]:
+        """
+        :return: [(job_id, 结果文件路径), ...]
+        """
+        with self._lock:
+            rows = self.conn.execute("SELECT id, result FROM jobs WHERE status = 'done' ORDER BY id").fetchall()
+        return [(job_id, os.path.join(self.queue_dir, result)) for job_id, result in rows]
+
+    def mark_merged(self, job_id):
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.execute("UPDATE jobs SET status = 'merged' WHERE id = ?", (job_id,))
+            self.conn.execute("DELETE FROM queued_files WHERE job_id = ?", (job_id,))
+            self.conn.execute("COMMIT")
+
+    def retry_failed(self) -> int:
+        with self._lock:
+            return self.conn.execute(
+                "UPDATE jobs SET status = 'pending', attempts = 0, error = NULL WHERE status = 'failed'").rowcount
+
+    def has_unfinished(self) -> bool:
+        with self._lock:
+            return self.conn.execute(
+                "SELECT 1 FROM jobs WHERE status IN ('pending', 'running') LIMIT 1").fetchone() is not None
+
+    def status(self) -> dict:
+        with self._lock:
+            counts = dict(self.conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+            workers = [row[0] for row in self.conn.execute(
+                "SELECT DISTINCT worker FROM jobs WHERE status = 'running' AND lease_until >= ?", (time.time(),))]
+        return {**{status: counts.get(status, 0) for status in JOB_STATUSES}, "workers": workers}
+
+    def close(self):
+        self.conn.close()
+
+
+def write_result(result_file, results: List[tuple]):
+    """
+    结果文件包含重建数据所需的全部内容, 不依赖节点上的任何状态
+    :param results: [(FileEntry, [Face, ...]), ...], 没有人脸的文件同样写入清单
+    """
+    from core.metadata import to_face_record
+
+    faces, paths = [], []
+    for entry, file_faces in results:
+        faces.extend(to_face_record(face) for face in file_faces)
+        paths.extend([entry.path] * len(file_faces))
+    entries = [entry for entry, _ in results]
+    atomic_write(result_file, lambda file: np.savez(
+        file,
+        embs=np.array([face["embedding"] for face in faces], dtype=np.float32).reshape(-1, EMBEDDING_DIM),
+        paths=np.array(paths, dtype=str),
+        bboxes=np.array([np.full(4, np.nan) if face["bbox"] is None else face["bbox"] for face in faces],
+                        dtype=np.float32).reshape(-1, 4),
+        det_scores=np.array([np.nan if face["det_score"] is None else face["det_score"] for face in faces],
+                            dtype=np.float32),
+        frame_ts=np.array([np.nan if face["frame_ts"] is None else face["frame_ts"] for face in faces],
+                          dtype=np.float64),
+        manifest_paths=np.array([entry.path for entry in entries], dtype=str),
+        manifest_sizes=np.array([entry.size for entry in entries], dtype=np.int64),
+        manifest_mtimes=np.array([entry.mtime for entry in entries], dtype=np.float64),
+        manifest_hashes=np.array([entry.hash for entry in entries], dtype=str),
+    ))
+
+
+def read_result(result_file) -> tuple:
+    """
+    :return: (emb_dict, manifest_entries), 格式与 FaceStore.add 和 update_manifest 的参数一致
+    """
+    with np.load(result_file) as result:
+        emb_dict = {}
+        for emb, path, bbox, det_score, frame_ts in zip(result["embs"], result["paths"], result["bboxes"],
+                                                        result["det_scores"], result["frame_ts"]):
+            emb_dict.setdefault(str(path), []).append(
+                {"embedding": emb, "bbox": None if np.isnan(bbox).all() else bbox, "det_score": det_score,
+                 "frame_ts": None if np.isnan(frame_ts) else float(frame_ts)})
+        manifest_entries = [FileEntry(str(path), int(size), float(mtime), str(file_hash)) for path, size, mtime, file_hash
+                            in zip(result["manifest_paths"], result["manifest_sizes"], result["manifest_mtimes"],
+                                   result["manifest_hashes"])]
+    return emb_dict, manifest_entries
+
+
+def submit_paths(paths: List[str], queue: JobQueue, job_size=INGEST_JOB_SIZE) -> int:
+    """
+    在持有索引的进程中扫描文件清单, 只把新增或内容变化的文件入队
+    :return: 新增的任务数
+    """
+    from core.embedding import scan_for_ingest, check_file_size
+
+    store = get_face_store()
+    scan = scan_for_ingest(paths, store)
+    store.flush()
+    entries = [entry for entry in scan.files if check_file_size(entry.path)]
+    job_count = queue.submit(entries, job_size)
+    logger.info(f"已提交 {job_count} 个任务, 文件数: {len(entries)}")
+    return job_count
+
+
+def process_job(job: Job, decode_workers=INGEST_DECODE_WORKERS, infer_workers=INGEST_INFER_WORKERS,
+                batch_size=INGEST_BATCH_SIZE, queue_size=INGEST_QUEUE_SIZE) -> List[tuple]:
+    """
+    用本节点的模型识别一个任务中的文件, 单个文件出错时跳过, 不记入清单, 下次扫描时重新提交
+    :return: [(FileEntry, [Face, ...]), ...]
+    """
+    from core.embedding import decode_media, infer_media
+    from core.pipeline import run_pipeline
+
+    results = []
+    for entry, faces, error in run_pipeline(job.entries, lambda entry: decode_media(entry.path), infer_media,
+                                            decode_workers=decode_workers, infer_workers=infer_workers,
+                                            batch_size=batch_size, queue_size=queue_size):
+        if error is not None:
+            logger.warning(f"识别错误文件: {entry.path}, {error}")
+            continue
+        results.append((entry, faces or []))
+    return results
+
+
+def run_worker(queue: JobQueue, worker=None, poll_seconds=30, exit_when_empty=True):
+    """
+    循环领取任务, 识别后写入结果文件; 处理期间后台线程每 lease_seconds / 3 续租一次
+    其他节点持有的任务可能因为节点失联重新分配, 所以只要还有未完成的任务就继续等待
+    """
+    worker = worker or f"{socket.gethostname()}-{os.getpid()}"
+    logger.info(f"入库节点 {worker} 已启动, 队列: {queue.queue_dir}")
+    while True:
+        job = queue.claim(worker)
+        if job is None:
+            if exit_when_empty and not queue.has_unfinished():
+                break
+            time.sleep(poll_seconds)
+            continue
+
+        b = time.time()
+        stop = threading.Event()
+
+        def keep_lease():
+            while not stop.wait(queue.lease_seconds / 3):
+                if not queue.heartbeat(job, worker):
+                    logger.warning(f"任务 {job.id} 的租约已失效")
+                    return
+
+        heartbeat_thread = threading.Thread(target=keep_lease, name="ingest-lease", daemon=True)
+        heartbeat_thread.start()
+        try:
+            results = process_job(job)
+            result_file = os.path.join(queue.result_dir, f"job_{job.id:08d}_{job.attempts}.npz")
+            write_result(result_file, results)
+            if queue.complete(job, worker, result_file):
+                face_count = sum(len(faces) for _, faces in results)
+                logger.info(f"任务 {job.id} 已完成, 文件数: {len(job.entries)}, 人脸数: {face_count}, "
+                            f"耗时: {time.time() - b:.2f}s")
+            else:
+                # 租约过期后任务已经交给其他节点
+                os.remove(result_file)
+                logger.warning(f"任务 {job.id} 已被重新分配, 丢弃本节点的结果")
+        except Exception as e:
+            logger.exception(f"任务 {job.id} 出错")
+            queue.fail(job, worker, str(e))
+        finally:
+            stop.set()
+            heartbeat_thread.join()
+    logger.info(f"入库节点 {worker} 退出, 队列中没有未完成的任务")
+
+
+def gen_merge_results(queue: JobQueue):
+    """
+    在持有索引的进程中把已完成任务的结果文件合并进主索引和元数据
+    每个任务落盘后才标记为 merged, 中途退出后重新合并时已入库的文件由 FaceStore.add 跳过
+    :return: 生成器, 每合并一个任务返回一次 (当前数量, 总数)
+    """
+    store = get_face_store()
+    done_jobs = queue.done_jobs()
+    for current, (job_id, result_file) in enumerate(done_jobs, start=1):
+        emb_dict, manifest_entries = read_result(result_file)
+        face_count = store.add(emb_dict)
+        store.update_manifest(manifest_entries)
+        store.flush()
+        queue.mark_merged(job_id)
+        os.remove(result_file)
+        logger.info(f"已合并任务 {job_id}, 文件数: {len(manifest_entries)}, 人脸数: {face_count}")
+        yield current, len(done_jobs)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="分布式入库: 提交任务、运行入库节点、合并结果")
+    parser.add_argument("command", choices=["submit", "worker", "merge", "status", "retry"])
+    parser.add_argument("paths", nargs="*", help="submit 时待入库的文件或文件夹")
+    parser.add_argument("--queue", default=INGEST_QUEUE_DIR, help="共享存储上的队列目录")
+    parser.add_argument("--job-size", type=int, default=INGEST_JOB_SIZE)
+    parser.add_argument("--worker-id", default=None)
+    parser.add_argument("--wait", action="store_true", help="队列为空时继续等待新任务")
+    args = parser.parse_args()
+    setup_logging()
+
+    job_queue = JobQueue(args.queue)
+    if args.command == "submit":
+        submit_paths(args.paths, job_queue, args.job_size)
+    elif args.command == "worker":
+        run_worker(job_queue, args.worker_id, exit_when_empty=not args.wait)
+    elif args.command == "merge":
+        for _ in gen_merge_results(job_queue):
+            pass
+    elif args.command == "retry":
+        print(f"已重新排队 {job_queue.retry_failed()} 个失败的任务")
+    print(job_queue.status())
@@ -0,0 +1,140 @@
+# 文件清单, 用于增量扫描: 只处理新增或内容变化的文件, 识别重命名/移动的文件
+import hashlib
+import logging
+import os
+from pathlib import Path
+from typing import List, NamedTuple
+
+from core.metadata import MetaStore
+from core.utils import scan_dir_entries
+from settings import ALLOWED_IMG_TYPES, ALLOWED_VIDEO_TYPES
+
+logger = logging.getLogger(__name__)
+
+# 快速哈希只读取文件头、中、尾各 64KB
+HASH_CHUNK_SIZE = 64 * 1024
+# 完整哈希每次读取的字节数
+FULL_HASH_BLOCK_SIZE = 1024 * 1024
+
+
+class FileEntry(NamedTuple):
+    path: str
+    size: int
+    mtime: float
+    hash: str
+
+
+class ScanResult(NamedTuple):
+    # 需要识别的文件(新增或内容变化)
+    files: List[FileEntry]
+    # 内容变化的文件路径, 识别前需要删除旧的人脸数据
+    changed: List[str]
+    # 被重命名或移动的文件 [(旧路径, 新文件)]
+    renamed: List[tuple]
+    # 未变化的文件数量
+    unchanged: int
+
+
+def fast_file_hash(file_path, size=None) -> str:
+    """
+    文件大小 + 头中尾采样的 blake2b 哈希, 大文件也只读取 192KB
+    """
+    size = os.path.getsize(file_path) if size is None else size
+    hasher = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with open(file_path, 'rb') as file:
+        if size <= HASH_CHUNK_SIZE * 3:
+            hasher.update(file.read())
+        else:
+            for offset in (0, size // 2 - HASH_CHUNK_SIZE // 2, size - HASH_CHUNK_SIZE):
+                file.seek(offset)
+                hasher.update(file.read(HASH_CHUNK_SIZE))
+    return hasher.hexdigest()
+
+
+def is_sampled_hash(size) -> bool:
+    """
+    快速哈希是否只采样了部分内容, 大小和采样部分都相同的不同文件哈希相同
+    """
+    return size > HASH_CHUNK_SIZE * 3
+
+
+def full_file_hash(file_path) -> str:
+    """
+    文件大小 + 完整内容的 blake2b 哈希, 不超过 192KB 的文件与 fast_file_hash 相同
+    需要读取整个文件, 只用于确认快速哈希相同的文件内容是否一致
+    """
+    hasher = hashlib.blake2b(str(os.path.getsize(file_path)).encode(), digest_size=16)
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(FULL_HASH_BLOCK_SIZE), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def iter_media_entries(paths: List[str], suffixes=ALLOWED_IMG_TYPES + ALLOWED_VIDEO_TYPES):
+    """
+    遍历文件和文件夹, 返回支持类型的 (path, size, mtime)
+    """
+    for obj_path in paths:
+        if os.path.isfile(obj_path):
+            if Path(obj_path).suffix.lower() in suffixes:
+                stat = os.stat(obj_path)
+                yield obj_path, stat.st_size, stat.st_mtime
+        elif os.path.isdir(obj_path):
+            for entry in scan_dir_entries(obj_path):
+                if Path(entry.name).suffix.lower() in suffixes:
+                    stat = entry.stat()
+                    yield entry.path, stat.st_size, stat.st_mtime
+
+
+def scan_files(paths: List[str], meta: MetaStore) -> ScanResult:
+    """
+    对比清单找出需要识别的文件
+    大小和修改时间都没变的文件直接跳过, 只对其余文件计算快速哈希;
+    哈希与清单中某个已不存在的文件相同时视为重命名, 不需要重新识别
+    """
+    manifest = meta.get_manifest()
+    files, changed, renamed, unchanged, seen = [], [], [], 0, set()
+    candidates, legacy_entries = [], []
+    for path, size, mtime in iter_media_entries(paths):
+        if path in seen:
+            continue
+        seen.add(path)
+        record = manifest.get(path)
+        if record is not None and record[0] == size and record[1] == mtime:
+            unchanged += 1
+        else:
+            candidates.append((path, size, mtime))
+
+    # 旧版本导入的文件没有清单记录, 数据库中已存在时直接补记清单
+    exist_paths = meta.existing_paths(path for path, _, _ in candidates if path not in manifest)
+    for path, size, mtime in candidates:
+        try:
+            entry = FileEntry(path, size, mtime, fast_file_hash(path, size))
+        except OSError as e:
+            logger.warning(f"无法读取文件: {path}, {e}")
+            continue
+
+        record = manifest.get(path)
+        if path in exist_paths:
+            legacy_entries.append(entry)
+            unchanged += 1
+        elif record is not None:
+            if record[2] == entry.hash:
+                # 只是修改时间变了
+                legacy_entries.append(entry)
+                unchanged += 1
+            else:
+                changed.append(path)
+                files.append(entry)
+        else:
+            moved_from = next((old_path for old_path in meta.find_paths_by_hash(entry.hash)
+                               if old_path not in seen and not os.path.exists(old_path)), None)
+            if moved_from is not None:
+                renamed.append((moved_from, entry))
+                seen.add(moved_from)
+            else:
+                files.append(entry)
+
+    meta.update_manifest(legacy_entries)
+    logger.info(f"扫描完成, 待识别: {len(files)}, 内容变化: {len(changed)}, 重命名: {len(renamed)}, 未变化: {unchanged}")
+    return ScanResult(files, changed, renamed, unchanged)
@@ -0,0 +1,391 @@
+# 人脸元数据存储, 基于 SQLite(WAL 模式)
+import json
+import logging
+import os
+import sqlite3
+import threading
+from typing import List, Dict, Iterable
+
+import numpy as np
+
+from settings import META_DB_PATH
+
+logger = logging.getLogger(__name__)
+
+# 单条 SQL 中 IN (...) 的参数个数上限
+_SQL_BATCH = 900
+
+
+def to_face_record(face) -> dict:
+    """
+    统一人脸数据格式, 支持 insightface 的 Face(dict 子类)或者只有向量的 np.ndarray
+    :return: {"embedding", "bbox", "det_score", "frame_ts"}
+    """
+    if isinstance(face, np.ndarray):
+        return {"embedding": face, "bbox": None, "det_score": None, "frame_ts": None}
+    return {
+        "embedding": face["embedding"],
+        "bbox": face.get("bbox"),
+        "det_score": face.get("det_score"),
+        "frame_ts": face.get("frame_ts"),
+    }
+
+
+def _float_or_none(value):
+    return None if value is None or np.isnan(value) else float(value)
+
+
+class MetaStore:
+    """
+    文件路径只在 files 表中存一次, faces 表按人脸 id 记录所属文件和检测属性
+    id 和路径上都有索引, 打开时不需要把全部数据读进内存
+
+    写入在同一个连接的事务中进行, 直到 commit 才对其他连接可见,
+    FaceStore 在段文件落盘之后才 commit, 保证元数据不会领先于向量
+    """
+
+    def __init__(self, db_path=META_DB_PATH):
+        self.db_path = db_path
+        dir_name = os.path.dirname(db_path)
+        if dir_name:
+            os.makedirs(dir_name, exist_ok=True)
+        self._lock = threading.RLock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                id INTEGER PRIMARY KEY,
+                path TEXT NOT NULL UNIQUE
+            );
+            CREATE TABLE IF NOT EXISTS faces (
+                id INTEGER PRIMARY KEY,
+                file_id INTEGER NOT NULL REFERENCES files(id),
+                x1 REAL, y1 REAL, x2 REAL, y2 REAL,
+                det_score REAL,
+                frame_ts REAL
+            );
+            CREATE INDEX IF NOT EXISTS faces_file_id ON faces(file_id);
+            CREATE TABLE IF NOT EXISTS deleted_faces (
+                id INTEGER PRIMARY KEY
+            );
+            CREATE TABLE IF NOT EXISTS manifest (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL,
+                hash TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS manifest_hash ON manifest(hash);
+            CREATE TABLE IF NOT EXISTS store_state (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+            CREATE TABLE IF NOT EXISTS file_links (
+                path TEXT PRIMARY KEY,
+                target TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS file_links_target ON file_links(target);
+            CREATE TABLE IF NOT EXISTS perceptual_hashes (
+                path TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                code BLOB NOT NULL
+            );
+        """)
+        self.conn.commit()
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            return self.conn.execute("SELECT 1 FROM faces LIMIT 1").fetchone() is None
+
+    def max_face_id(self) -> int:
+        """
+        已分配过的最大人脸 id, 包含已删除的 id, 保证 id 不会被复用
+        """
+        with self._lock:
+            return self.conn.execute(
+                "SELECT MAX((SELECT COALESCE(MAX(id), 0) FROM faces), "
+                "(SELECT COALESCE(MAX(id), 0) FROM deleted_faces))").fetchone()[0]
+
+    def face_count(self) -> int:
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM faces").fetchone()[0]
+
+    def face_ids(self) -> List[int]:
+        with self._lock:
+            return [row[0] for row in self.conn.execute("SELECT id FROM faces")]
+
+    def all_paths(self) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self.conn.execute("SELECT path FROM files")]
+
+    def deleted_ids(self) -> set:
+        with self._lock:
+            return {row[0] for row in self.conn.execute("SELECT id FROM deleted_faces")}
+
+    def manifest_paths(self) -> List[str]:
+        """
+        清单中的文件路径, 包含没有人脸的文件
+        """
+        with self._lock:
+            return [row[0] for row in self.conn.execute("SELECT path FROM manifest")]
+
+    def paths_under(self, folder) -> List[str]:
+        """
+        文件夹下(含子文件夹)已入库或已记入清单的文件, 兼容 / 和 \\ 两种分隔符
+        """
+        folder = folder.rstrip("/\\")
+        prefixes = [folder + "/", folder + "\\"]
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT path FROM files WHERE substr(path, 1, ?) IN (?, ?) "
+                "UNION SELECT path FROM manifest WHERE substr(path, 1, ?) IN (?, ?)",
+                (len(prefixes[0]), *prefixes, len(prefixes[0]), *prefixes))
+            return [row[0] for row in rows]
+
+    def has_path(self, path) -> bool:
+        with self._lock:
+            return self.conn.execute("SELECT 1 FROM files WHERE path = ?", (path,)).fetchone() is not None
+
+    def existing_paths(self, paths: Iterable[str]) -> set:
+        paths, exists = list(paths), set()
+        with self._lock:
+            for i in range(0, len(paths), _SQL_BATCH):
+                chunk = paths[i:i + _SQL_BATCH]
+                rows = self.conn.execute(
+                    f"SELECT path FROM files WHERE path IN ({','.join('?' * len(chunk))})", chunk)
+                exists.update(row[0] for row in rows)
+        return exists
+
+    def _get_or_create_file_id(self, path) -> int:
+        row = self.conn.execute("SELECT id FROM files WHERE path = ?", (path,)).fetchone()
+        if row is not None:
+            return row[0]
+        return self.conn.execute("INSERT INTO files (path) VALUES (?)", (path,)).lastrowid
+
+    def add_faces(self, ids: Iterable[int], paths: Iterable[str], faces: Iterable[dict]):
+        """
+        写入人脸元数据, 不自动 commit; 已存在的 id 会被忽略, 段文件回放时可以重复写入
+        """
+        rows = []
+        with self._lock:
+            file_ids = {}
+            for face_id, path, face in zip(ids, paths, faces):
+                if path not in file_ids:
+                    file_ids[path] = self._get_or_create_file_id(path)
+                bbox = face.get("bbox")
+                x1, y1, x2, y2 = [None] * 4 if bbox is None else [_float_or_none(v) for v in bbox]
+                rows.append((int(face_id), file_ids[path], x1, y1, x2, y2,
+                             _float_or_none(face.get("det_score")), _float_or_none(face.get("frame_ts"))))
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO faces (id, file_id, x1, y1, x2, y2, det_score, frame_ts) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def get_paths(self, ids: Iterable[int]) -> Dict[int, str]:
+        """
+        按人脸 id 批量查询文件路径
+        """
+        return {face_id: path for face_id, (path, _) in self.get_hits(ids).items()}
+
+    def get_hits(self, ids: Iterable[int]) -> Dict[int, tuple]:
+        """
+        按人脸 id 批量查询检索结果需要展示的信息
+        :return: {face_id: (file_path, frame_ts)}, 图片的 frame_ts 为 None
+        """
+        ids, hits = list({int(i) for i in ids}), {}
+        with self._lock:
+            for i in range(0, len(ids), _SQL_BATCH):
+                chunk = ids[i:i + _SQL_BATCH]
+                rows = self.conn.execute(
+                    f"SELECT faces.id, files.path, faces.frame_ts FROM faces JOIN files ON faces.file_id = files.id "
+                    f"WHERE faces.id IN ({','.join('?' * len(chunk))})", chunk)
+                hits.update((face_id, (path, frame_ts)) for face_id, path, frame_ts in rows)
+        return hits
+
+    def delete_paths(self, paths: Iterable[str]) -> List[int]:
+        """
+        删除文件及其人脸和清单记录, 被删除的人脸 id 记入 deleted_faces, 段文件回放时跳过
+        文件有关联的重复文件时, 人脸转给第一个未被删除的重复文件, 不会被删除
+        :return: 被删除的人脸 id
+        """
+        paths, face_ids = list(paths), []
+        with self._lock:
+            self._promote_links(paths)
+            for i in range(0, len(paths), _SQL_BATCH):
+                chunk = paths[i:i + _SQL_BATCH]
+                placeholders = ','.join('?' * len(chunk))
+                file_ids = f"SELECT id FROM files WHERE path IN ({placeholders})"
+                face_ids.extend(row[0] for row in self.conn.execute(
+                    f"SELECT id FROM faces WHERE file_id IN ({file_ids})", chunk))
+                self.conn.execute(
+                    f"INSERT OR IGNORE INTO deleted_faces (id) SELECT id FROM faces WHERE file_id IN ({file_ids})",
+                    chunk)
+                self.conn.execute(f"DELETE FROM faces WHERE file_id IN ({file_ids})", chunk)
+                self.conn.execute(f"DELETE FROM files WHERE path IN ({placeholders})", chunk)
+                self.conn.execute(f"DELETE FROM manifest WHERE path IN ({placeholders})", chunk)
+                self.conn.execute(f"DELETE FROM file_links WHERE path IN ({placeholders})", chunk)
+                self.conn.execute(f"DELETE FROM perceptual_hashes WHERE path IN ({placeholders})", chunk)
+        return face_ids
+
+    def _promote_links(self, paths: List[str]):
+        """
+        被删除的文件中有重复文件关联的, 把人脸和其余关联转给第一个不在 paths 中的重复文件
+        """
+        rows, deleting = [], set(paths)
+        for i in range(0, len(paths), _SQL_BATCH):
+            chunk = paths[i:i + _SQL_BATCH]
+            rows.extend(self.conn.execute(
+                f"SELECT path, target FROM file_links WHERE target IN ({','.join('?' * len(chunk))}) ORDER BY path",
+                chunk))
+        heirs = {}
+        for path, target in rows:
+            if path not in deleting and target not in heirs:
+                heirs[target] = path
+        for target, heir in heirs.items():
+            self.conn.execute("DELETE FROM file_links WHERE path = ?", (heir,))
+            self.conn.execute("UPDATE file_links SET target = ? WHERE target = ?", (heir, target))
+            self.conn.execute("UPDATE files SET path = ? WHERE path = ?", (heir, target))
+
+    def renumber_faces(self, id_map: Iterable[tuple]):
+        """
+        按 old_ids -> new_ids 重新编号, 不在映射中的人脸被删除, 同时清空删除记录和没有人脸的文件, 不自动 commit
+        :param id_map: 分批的 [(old_ids, new_ids), ...], 逐批写入临时表
+        """
+        with self._lock:
+            self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS id_map (old_id INTEGER PRIMARY KEY, new_id INTEGER)")
+            self.conn.execute("DELETE FROM id_map")
+            for old_ids, new_ids in id_map:
+                self.conn.executemany("INSERT INTO id_map (old_id, new_id) VALUES (?, ?)",
+                                      zip(np.asarray(old_ids).tolist(), np.asarray(new_ids).tolist()))
+            self.conn.execute("DELETE FROM faces WHERE id NOT IN (SELECT old_id FROM id_map)")
+            # 先整体移到负数区间再改为新 id, 避免与尚未更新的旧 id 冲突
+            self.conn.execute("UPDATE faces SET id = -(SELECT new_id FROM id_map WHERE old_id = faces.id)")
+            self.conn.execute("UPDATE faces SET id = -id")
+            self.conn.execute("DELETE FROM files WHERE id NOT IN (SELECT DISTINCT file_id FROM faces)")
+            self.conn.execute("DELETE FROM deleted_faces")
+            self.conn.execute("DROP TABLE id_map")
+
+    def get_state(self, key, default=None):
+        with self._lock:
+            row = self.conn.execute("SELECT value FROM store_state WHERE key = ?", (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def set_state(self, key, value):
+        """
+        记录存储状态, 不自动 commit
+        """
+        with self._lock:
+            self.conn.execute("INSERT OR REPLACE INTO store_state (key, value) VALUES (?, ?)", (key, value))
+
+    def rename_path(self, old_path, new_path):
+        """
+        文件被重命名或移动, 只更新路径, 人脸数据保持不变
+        """
+        with self._lock:
+            self.conn.execute("UPDATE files SET path = ? WHERE path = ?", (new_path, old_path))
+            self.conn.execute("UPDATE manifest SET path = ? WHERE path = ?", (new_path, old_path))
+            self.conn.execute("UPDATE file_links SET path = ? WHERE path = ?", (new_path, old_path))
+            self.conn.execute("UPDATE file_links SET target = ? WHERE target = ?", (new_path, old_path))
+            self.conn.execute("UPDATE perceptual_hashes SET path = ? WHERE path = ?", (new_path, old_path))
+
+    def get_manifest(self) -> Dict[str, tuple]:
+        """
+        :return: {path: (size, mtime, hash)}
+        """
+        with self._lock:
+            return {row[0]: row[1:] for row in self.conn.execute("SELECT path, size, mtime, hash FROM manifest")}
+
+    def find_paths_by_hash(self, file_hash) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self.conn.execute("SELECT path FROM manifest WHERE hash = ?", (file_hash,))]
+
+    def update_manifest(self, entries: Iterable[tuple]):
+        """
+        :param entries: [(path, size, mtime, hash), ...]
+        """
+        with self._lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO manifest (path, size, mtime, hash) VALUES (?, ?, ?, ?)", list(entries))
+
+    def link_paths(self, links: Iterable[tuple]):
+        """
+        记录重复文件, 重复文件没有自己的人脸, 检索时随目标文件一起返回
+        :param links: [(重复文件路径, 目标文件路径), ...], 目标文件本身不能是重复文件
+        """
+        with self._lock:
+            self.conn.executemany("INSERT OR REPLACE INTO file_links (path, target) VALUES (?, ?)", list(links))
+
+    def get_link_targets(self, paths: Iterable[str]) -> Dict[str, str]:
+        """
+        :return: {重复文件路径: 目标文件路径}, 不是重复文件的路径不在其中
+        """
+        paths, targets = list(paths), {}
+        with self._lock:
+            for i in range(0, len(paths), _SQL_BATCH):
+                chunk = paths[i:i + _SQL_BATCH]
+                targets.update(self.conn.execute(
+                    f"SELECT path, target FROM file_links WHERE path IN ({','.join('?' * len(chunk))})", chunk))
+        return targets
+
+    def get_links(self, targets: Iterable[str]) -> Dict[str, List[str]]:
+        """
+        :return: {目标文件路径: [重复文件路径, ...]}, 没有重复文件的路径不在其中
+        """
+        targets, links = list(targets), {}
+        with self._lock:
+            for i in range(0, len(targets), _SQL_BATCH):
+                chunk = targets[i:i + _SQL_BATCH]
+                rows = self.conn.execute(
+                    f"SELECT path, target FROM file_links WHERE target IN ({','.join('?' * len(chunk))}) ORDER BY path",
+                    chunk)
+                for path, target in rows:
+                    links.setdefault(target, []).append(path)
+        return links
+
+    def get_perceptual_hashes(self, kind) -> tuple:
+        """
+        :return: (paths, codes), codes 为 (n, 字节数) 的 uint8 矩阵
+        """
+        with self._lock:
+            rows = self.conn.execute("SELECT path, code FROM perceptual_hashes WHERE kind = ?", (kind,)).fetchall()
+        if not rows:
+            return [], None
+        return [path for path, _ in rows], np.vstack([np.frombuffer(code, dtype=np.uint8) for _, code in rows])
+
+    def update_perceptual_hashes(self, rows: Iterable[tuple]):
+        """
+        :param rows: [(path, kind, code bytes), ...]
+        """
+        with self._lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO perceptual_hashes (path, kind, code) VALUES (?, ?, ?)", list(rows))
+
+    def paths_without_perceptual_hash(self) -> List[str]:
+        """
+        清单中还没有感知哈希的文件, 如去重功能加入之前导入的文件
+        """
+        with self._lock:
+            return [row[0] for row in self.conn.execute(
+                "SELECT path FROM manifest WHERE path NOT IN (SELECT path FROM perceptual_hashes)")]
+
+    def commit(self):
+        with self._lock:
+            self.conn.commit()
+
+    def close(self):
+        with self._lock:
+            self.conn.commit()
+            self.conn.close()
+
+    def migrate_from_json(self, datameta_path) -> int:
+        """
+        一次性把旧版 datameta.json({id: file_path}) 导入数据库
+        :return: 导入的人脸数量
+        """
+        with open(datameta_path, 'r') as file:
+            datameta_dict = json.load(file)
+        ids = [int(key) for key in datameta_dict.keys()]
+        paths = list(datameta_dict.values())
+        self.add_faces(ids, paths, [{}] * len(ids))
+        self.commit()
+        logger.info(f"已从 {datameta_path} 迁移 {len(ids)} 条元数据到 {self.db_path}")
+        return len(ids)
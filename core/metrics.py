@@ -0,0 +1,126 @@
+# 分阶段的性能统计: 每个阶段一个计数器和耗时直方图, 界面定时读取快照, 也可以导出为 JSON
+import json
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict
+
+import numpy as np
+
+# 入库和检索的各个阶段, 未列出的名称同样可以记录
+STAGES = ("file_walk", "dedup", "decode", "infer", "yolo_detect", "buffalo_detect", "landmark", "recognition",
+          "index_add", "metadata_write", "segment_write", "search")
+# 入库流水线中互不嵌套的顶层阶段, 只在它们之间比较瓶颈;
+# 其余阶段是它们内部的步骤, 如 decode 中视频抽帧时的 yolo_detect、infer 中的 recognition
+PIPELINE_STAGES = ("file_walk", "dedup", "decode", "infer", "index_add", "metadata_write", "segment_write")
+
+# 直方图的桶上界(毫秒), 按对数均匀分布, 从 0.01ms 到 100s, 超出的计入最后一个桶
+BUCKET_BOUNDS_MS = np.logspace(-2, 5, 57)
+
+
+class Histogram:
+    """
+    固定分桶的耗时直方图, 记录的开销与次数无关, 分位数由桶上界估计
+    """
+
+    def __init__(self):
+        self.buckets = np.zeros(len(BUCKET_BOUNDS_MS) + 1, dtype=np.int64)
+        self.count = 0
+        self.items = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, ms, items=1):
+        self.buckets[np.searchsorted(BUCKET_BOUNDS_MS, ms)] += 1
+        self.count += 1
+        self.items += items
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def percentile(self, q) -> float:
+        if self.count == 0:
+            return 0.0
+        i = int(np.searchsorted(np.cumsum(self.buckets), q / 100 * self.count))
+        return float(BUCKET_BOUNDS_MS[min(i, len(BUCKET_BOUNDS_MS) - 1)])
+
+    def to_dict(self, elapsed) -> dict:
+        return {
+            "count": self.count,
+            # 每次记录处理的数量之和, 如一批识别的人脸数
+            "items": self.items,
+            "total_s": self.total_ms / 1000,
+            "mean_ms": self.total_ms / self.count if self.count else 0.0,
+            "p50_ms": self.percentile(50),
+            "p95_ms": self.percentile(95),
+            "p99_ms": self.percentile(99),
+            "max_ms": self.max_ms,
+            "items_per_s": self.items / elapsed if elapsed > 0 else 0.0,
+        }
+
+
+class StageMetrics:
+    """
+    线程安全, 入库流水线的解码线程、推理线程和写入方可以同时记录
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.histograms: Dict[str, Histogram] = {}
+            self.counters: Dict[str, int] = {}
+
+    def observe(self, stage, seconds, items=1):
+        with self._lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.observe(seconds * 1000, items)
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextmanager
+    def timer(self, stage, items=1):
+        """
+        with metrics.timer("decode"): ...
+        出错时同样记录耗时, 并计入 {stage}_errors 计数器
+        """
+        b = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.incr(f"{stage}_errors")
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - b, items)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            elapsed = time.time() - self.started
+            return {
+                "elapsed_s": elapsed,
+                "stages": {stage: histogram.to_dict(elapsed) for stage, histogram in self.histograms.items()},
+                "counters": dict(self.counters),
+            }
+
+    def bottleneck(self) -> str | None:
+        """
+        PIPELINE_STAGES 中累计耗时最长的阶段, 流水线各阶段并行时即为限制吞吐量的阶段
+        """
+        with self._lock:
+            stages = [stage for stage in PIPELINE_STAGES if stage in self.histograms]
+            if not stages:
+                return None
+            return max(stages, key=lambda stage: self.histograms[stage].total_ms)
+
+    def export_json(self, path):
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(self.snapshot(), file, indent=2, ensure_ascii=False)
+
+
+metrics = StageMetrics()
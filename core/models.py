@@ -0,0 +1,284 @@
+# 模型注册表: 模型在第一次使用时才加载, 界面可以先启动, 再在后台预热
+import glob
+import hashlib
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, List
+
+import numpy as np
+
+from settings import BUFFALO_MODEL_PATH, ONNX_PROVIDERS, YOLO_MODEL_PATH, WARMUP_MODELS, INFERENCE_PROFILES, \
+    INFERENCE_PROFILE, VIDEO_DETECTOR, IMAGE_DETECTOR, VIDEO_INGEST_MODE, VIDEO_SAMPLE_FPS, VIDEO_SAMPLE_MODE, YOLO_CONF, \
+    YOLO_IMGSZ, VIDEO_TIME_BUDGET, VIDEO_MAX_SAMPLES, TRACK_IOU_THRESH, TRACK_MAX_GAP, TRACK_MAX_CANDIDATES, \
+    TRACK_CROP_MARGIN, TRACK_MERGE_SIM, TRACK_MAX_EMBEDDINGS, TRACK_DUPLICATE_SIM
+
+logger = logging.getLogger(__name__)
+
+GRAPH_OPTIMIZATION_LEVELS = {
+    "disable": "ORT_DISABLE_ALL",
+    "basic": "ORT_ENABLE_BASIC",
+    "extended": "ORT_ENABLE_EXTENDED",
+    "all": "ORT_ENABLE_ALL",
+}
+
+
+def get_providers() -> List[str]:
+    """
+    onnxruntime 推理后端, 配置了 ONNX_PROVIDERS 时直接使用, 否则有 CUDA 用 CUDA, 没有时只用 CPU,
+    避免在没有显卡的机器上先尝试 CUDA 再回退
+    """
+    if ONNX_PROVIDERS:
+        return list(ONNX_PROVIDERS)
+    import onnxruntime
+
+    if "CUDAExecutionProvider" in onnxruntime.get_available_providers():
+        return ["CUDAExecutionProvider", "CPUExecutionProvider"]
+    return ["CPUExecutionProvider"]
+
+
+class ModelRegistry:
+    """
+    按名称注册模型的加载函数, get 时才加载, 同一个模型只加载一次, 并记录每个组件的加载耗时
+    """
+
+    def __init__(self):
+        self._loaders: Dict[str, Callable] = {}
+        self._warmers: Dict[str, Callable] = {}
+        self._models = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+        self.timings: Dict[str, float] = {}
+
+    def register(self, name, loader: Callable, warmer: Callable = None):
+        """
+        :param loader: 无参数, 返回加载好的模型
+        :param warmer: 接收模型, 用一次空输入推理完成初始化, 可以为空
+        """
+        with self._lock:
+            self._loaders[name] = loader
+            self._locks[name] = threading.Lock()
+            if warmer is not None:
+                self._warmers[name] = warmer
+
+    def is_loaded(self, name) -> bool:
+        return name in self._models
+
+    def get(self, name):
+        model = self._models.get(name)
+        if model is not None:
+            return model
+        if name not in self._loaders:
+            raise KeyError(f"未注册的模型: {name}, 可选: {list(self._loaders)}")
+
+        # 后台预热和第一次使用同时发生时, 后来的一方等待加载完成
+        with self._locks[name]:
+            model = self._models.get(name)
+            if model is None:
+                b = time.time()
+                model = self._loaders[name]()
+                self._models[name] = model
+                self.record(name, time.time() - b)
+                logger.info(f"加载 {name} 耗时: {self.timings[name]:.2f}s")
+        return model
+
+    def record(self, name, seconds):
+        """
+        记录组件的启动耗时, 界面等不经过注册表的组件也可以记录进来
+        """
+        self.timings[name] = seconds
+
+    def warmup(self, names: List[str] = None, background=True, callback: Callable = None):
+        """
+        依次加载并预热模型
+        :param names: 为空时预热所有注册的模型
+        :param callback: 全部完成后以 timings 为参数调用
+        :return: background 为 True 时返回后台线程
+        """
+        names = list(self._loaders) if names is None else names
+
+        def run():
+            for name in names:
+                try:
+                    model = self.get(name)
+                    warmer = self._warmers.get(name)
+                    if warmer is not None:
+                        b = time.time()
+                        warmer(model)
+                        self.record(f"{name}_warmup", time.time() - b)
+                except Exception as e:
+                    logger.warning(f"预热 {name} 失败: {e}")
+            if callback is not None:
+                callback(dict(self.timings))
+
+        if not background:
+            run()
+            return None
+        thread = threading.Thread(target=run, name="model-warmup", daemon=True)
+        thread.start()
+        return thread
+
+    def report(self) -> str:
+        return ", ".join(f"{name}: {seconds:.2f}s" for name, seconds in self.timings.items())
+
+
+def get_inference_profile(profile=INFERENCE_PROFILE) -> dict:
+    """
+    :param profile: INFERENCE_PROFILES 中的名称, 或者配置字典
+    :return: 补全了 allowed_modules 的配置
+    """
+    if isinstance(profile, str):
+        if profile not in INFERENCE_PROFILES:
+            raise ValueError(f"不支持的推理配置: {profile}, 可选: {list(INFERENCE_PROFILES)}")
+        profile = INFERENCE_PROFILES[profile]
+    profile = dict(profile)
+    allowed_modules = profile.get("allowed_modules")
+    if allowed_modules is not None:
+        allowed_modules = list(allowed_modules)
+        # YOLO 的检测框没有关键点时, 对齐需要 68 点关键点模型
+        if "yolo" in (VIDEO_DETECTOR, IMAGE_DETECTOR) and "landmark_3d_68" not in allowed_modules:
+            allowed_modules.append("landmark_3d_68")
+        profile["allowed_modules"] = allowed_modules
+    return profile
+
+
+def make_session_options(profile: dict):
+    import onnxruntime
+
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = profile.get("intra_op_threads", 0)
+    options.inter_op_num_threads = profile.get("inter_op_threads", 0)
+    level = GRAPH_OPTIMIZATION_LEVELS[profile.get("graph_optimization", "all")]
+    options.graph_optimization_level = getattr(onnxruntime.GraphOptimizationLevel, level)
+    return options
+
+
+def quantize_model(model_file) -> str:
+    """
+    动态量化为 INT8, 量化后的模型保存在原模型旁边, 已存在时直接使用
+    """
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    root, ext = os.path.splitext(model_file)
+    int8_file = f"{root}_int8{ext}"
+    if not os.path.exists(int8_file):
+        b = time.time()
+        quantize_dynamic(model_file, int8_file, weight_type=QuantType.QInt8)
+        logger.info(f"量化识别模型耗时: {time.time() - b:.2f}s, int8_file: {int8_file}")
+    return int8_file
+
+
+def get_model_version(profile=INFERENCE_PROFILE) -> str:
+    """
+    影响 embedding 结果的模型和配置的摘要, 任何一项变化后缓存的向量都不再可用
+    """
+    parts = [BUFFALO_MODEL_PATH, YOLO_MODEL_PATH, repr(sorted(get_inference_profile(profile).items())), VIDEO_DETECTOR,
+             IMAGE_DETECTOR, YOLO_CONF, YOLO_IMGSZ,
+             # 视频的抽帧和跟踪参数决定了哪些帧、哪些人脸参与识别
+             VIDEO_INGEST_MODE, VIDEO_SAMPLE_FPS, VIDEO_SAMPLE_MODE, VIDEO_TIME_BUDGET, VIDEO_MAX_SAMPLES,
+             TRACK_IOU_THRESH, TRACK_MAX_GAP, TRACK_MAX_CANDIDATES, TRACK_CROP_MARGIN, TRACK_MERGE_SIM,
+             TRACK_MAX_EMBEDDINGS, TRACK_DUPLICATE_SIM]
+    return hashlib.blake2b("|".join(map(str, parts)).encode("utf-8"), digest_size=8).hexdigest()
+
+
+def load_buffalo_module(model_file, options, providers: List[str], int8=False):
+    """
+    用 insightface 的 ModelRouter 按输入输出识别模块类型, 只创建一次带 SessionOptions 的 onnxruntime session
+    识别模型量化后的文件与原模型放在一起, 已存在时直接用它创建 session, 预处理参数仍从原模型的计算图中读取
+    :return: insightface 的模块, 不认识的模型返回 None
+    """
+    from insightface.model_zoo.arcface_onnx import ArcFaceONNX
+    from insightface.model_zoo.model_zoo import ModelRouter, PickableInferenceSession
+
+    root, ext = os.path.splitext(model_file)
+    if int8 and os.path.exists(f"{root}_int8{ext}"):
+        session = PickableInferenceSession(f"{root}_int8{ext}", sess_options=options, providers=providers)
+        return ArcFaceONNX(model_file=model_file, session=session)
+    module = ModelRouter(model_file).get_model(sess_options=options, providers=providers)
+    if int8 and module is not None and module.taskname == "recognition":
+        # 第一次使用 int8 时量化, 之后由上面的分支直接加载量化后的文件
+        session = PickableInferenceSession(quantize_model(model_file), sess_options=options, providers=providers)
+        module = ArcFaceONNX(model_file=model_file, session=session)
+    return module
+
+
+def load_buffalo(profile=INFERENCE_PROFILE, providers: List[str] = None):
+    """
+    按推理配置加载 buffalo_l
+    insightface 的 FaceAnalysis 创建模型时不会传递 SessionOptions, 这里不调用它的构造函数,
+    按与它相同的规则逐个加载模块, 每个模块只创建一次 session
+    """
+    import onnxruntime
+    from insightface.app import FaceAnalysis
+
+    # 与 FaceAnalysis 的构造函数相同, 只输出 onnxruntime 的错误日志
+    onnxruntime.set_default_logger_severity(3)
+    profile = get_inference_profile(profile)
+    providers = get_providers() if providers is None else providers
+    allowed_modules = profile.get("allowed_modules")
+    options = make_session_options(profile)
+
+    model = FaceAnalysis.__new__(FaceAnalysis)
+    model.model_dir, model.models = BUFFALO_MODEL_PATH, {}
+    for model_file in sorted(glob.glob(os.path.join(BUFFALO_MODEL_PATH, "*.onnx"))):
+        # 量化后的识别模型随原模型一起加载
+        if model_file.endswith("_int8.onnx"):
+            continue
+        module = load_buffalo_module(model_file, options, providers, int8=bool(profile.get("int8")))
+        if module is None or module.taskname in model.models or \
+                (allowed_modules is not None and module.taskname not in allowed_modules):
+            continue
+        model.models[module.taskname] = module
+    if "detection" not in model.models:
+        raise FileNotFoundError(f"{BUFFALO_MODEL_PATH} 中没有人脸检测模型")
+    model.det_model = model.models["detection"]
+    model.prepare(ctx_id=0 if "CUDAExecutionProvider" in providers else -1, det_size=tuple(profile["det_size"]))
+    return model
+
+
+def _load_buffalo():
+    return load_buffalo(INFERENCE_PROFILE)
+
+
+def _warm_buffalo(model):
+    image = np.zeros((112, 112, 3), dtype=np.uint8)
+    model.det_model.detect(image, max_num=0, metric='default')
+    model.models['recognition'].get_feat([image])
+
+
+def _load_yolo():
+    from ultralytics import YOLO
+
+    return YOLO(YOLO_MODEL_PATH, verbose=False)
+
+
+def _warm_yolo(model):
+    from core.yolo import _predict_lock
+
+    with _predict_lock:
+        model.predict([np.zeros((64, 64, 3), dtype=np.uint8)], verbose=False)
+
+
+def _load_face_store():
+    from core.database import get_face_store
+
+    return get_face_store()
+
+
+registry = ModelRegistry()
+registry.register("buffalo", _load_buffalo, _warm_buffalo)
+registry.register("yolo", _load_yolo, _warm_yolo)
+registry.register("face_store", _load_face_store)
+
+
+def get_buffalo_model():
+    return registry.get("buffalo")
+
+
+def get_yolo_model():
+    return registry.get("yolo")
+
+
+def warmup(names: List[str] = WARMUP_MODELS, background=True, callback: Callable = None):
+    return registry.warmup(names, background=background, callback=callback)
@@ -0,0 +1,124 @@
+# 分阶段的并行入库流水线
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, List
+
+from settings import INGEST_DECODE_WORKERS, INGEST_INFER_WORKERS, INGEST_BATCH_SIZE, INGEST_QUEUE_SIZE
+
+_SENTINEL = object()
+
+
+def _put(q: queue.Queue, item, stop: threading.Event) -> bool:
+    """
+    带停止标志的阻塞 put, 调用方提前退出时各阶段线程不会一直卡在满队列上
+    """
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(q: queue.Queue, stop: threading.Event):
+    """
+    带停止标志的阻塞 get, 停止时返回 _SENTINEL
+    """
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return _SENTINEL
+
+
+def run_pipeline(items: Iterable, decode_func: Callable, infer_func: Callable[[List], List],
+                 decode_workers=INGEST_DECODE_WORKERS, infer_workers=INGEST_INFER_WORKERS,
+                 batch_size=INGEST_BATCH_SIZE, queue_size=INGEST_QUEUE_SIZE):
+    """
+    读取解码线程池 -> 有界队列 -> 批量推理线程 -> 有界队列 -> 调用方(唯一的写入方)
+    :param decode_func: item -> 解码结果, 在线程池中执行
+    :param infer_func: [解码结果, ...] -> [推理结果, ...], 每次处理最多 batch_size 个
+    :return: 按完成顺序返回 (item, 推理结果, 异常), 异常不为空时推理结果为 None
+             调用方提前关闭生成器时, 尚未开始的解码不再执行, 各阶段线程在 0.1 秒内退出
+    """
+    decoded_queue = queue.Queue(maxsize=queue_size)
+    result_queue = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    # 已提交但还没放进队列的解码任务数上限, 不会一次把所有文件都提交到线程池
+    slots = threading.Semaphore(decode_workers + queue_size)
+
+    def decode(item):
+        try:
+            if stop.is_set():
+                return
+            _put(decoded_queue, (item, decode_func(item), None), stop)
+        except Exception as e:
+            _put(decoded_queue, (item, None, e), stop)
+        finally:
+            slots.release()
+
+    def produce():
+        with ThreadPoolExecutor(max_workers=decode_workers) as pool:
+            for item in items:
+                while not stop.is_set() and not slots.acquire(timeout=0.1):
+                    pass
+                if stop.is_set():
+                    break
+                pool.submit(decode, item)
+        for _ in range(infer_workers):
+            _put(decoded_queue, _SENTINEL, stop)
+
+    def infer():
+        finished = False
+        while not finished and not stop.is_set():
+            batch = [_get(decoded_queue, stop)]
+            if stop.is_set():
+                break
+            # 队列中已经解码好的数据凑成一批, 不等待
+            while len(batch) < batch_size:
+                try:
+                    batch.append(decoded_queue.get_nowait())
+                except queue.Empty:
+                    break
+            if _SENTINEL in batch:
+                finished = True
+                # 每个推理线程只消费一个结束标记, 多取的放回去
+                for _ in range(batch.count(_SENTINEL) - 1):
+                    _put(decoded_queue, _SENTINEL, stop)
+                batch = [data for data in batch if data is not _SENTINEL]
+
+            errors = [data for data in batch if data[2] is not None]
+            batch = [data for data in batch if data[2] is None]
+            for item, _, error in errors:
+                _put(result_queue, (item, None, error), stop)
+            if not batch:
+                continue
+            try:
+                results = infer_func([decoded for _, decoded, _ in batch])
+                if len(results) != len(batch):
+                    raise ValueError(f"推理结果数量 {len(results)} 与输入数量 {len(batch)} 不一致")
+                for (item, _, _), result in zip(batch, results):
+                    _put(result_queue, (item, result, None), stop)
+            except Exception as e:
+                for item, _, _ in batch:
+                    _put(result_queue, (item, None, e), stop)
+        _put(result_queue, _SENTINEL, stop)
+
+    threads = [threading.Thread(target=produce, daemon=True)]
+    threads += [threading.Thread(target=infer, daemon=True) for _ in range(infer_workers)]
+    for thread in threads:
+        thread.start()
+
+    try:
+        finished_workers = 0
+        while finished_workers < infer_workers:
+            data = result_queue.get()
+            if data is _SENTINEL:
+                finished_workers += 1
+                continue
+            yield data
+    finally:
+        stop.set()
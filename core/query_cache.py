@@ -0,0 +1,107 @@
+# 检索文件的向量缓存, 以文件内容哈希和模型版本为键, 同一文件换参数重新检索时不再运行模型
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from core.database import EMBEDDING_DIM
+from core.manifest import full_file_hash
+from core.models import get_model_version
+from settings import QUERY_CACHE_SIZE, QUERY_CACHE_PATH
+
+
+class QueryCache:
+    """
+    内存中按最近使用淘汰, 最多保留 max_size 个文件的向量;
+    db_path 不为空时同时写入 SQLite, 重启后仍然有效, 数据库中的条目同样按最近使用淘汰
+    """
+
+    def __init__(self, max_size=QUERY_CACHE_SIZE, db_path=QUERY_CACHE_PATH):
+        self.max_size = max_size
+        self._cache: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._lock = threading.RLock()
+        self.conn = None
+        if db_path:
+            dir_name = os.path.dirname(db_path)
+            if dir_name:
+                os.makedirs(dir_name, exist_ok=True)
+            self.conn = sqlite3.connect(db_path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS query_embeddings (
+                    key TEXT PRIMARY KEY,
+                    embs BLOB NOT NULL,
+                    count INTEGER NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            """)
+            self.conn.commit()
+
+    @staticmethod
+    def make_key(file_path) -> str:
+        """
+        使用完整内容的哈希, 只采样的快速哈希会让大小和采样部分相同的不同文件共用缓存
+        :raise OSError: 文件不存在或无法读取
+        """
+        return f"{get_model_version()}:{full_file_hash(file_path)}"
+
+    def get(self, key) -> np.ndarray | None:
+        with self._lock:
+            embs = self._cache.get(key)
+            if embs is not None:
+                self._cache.move_to_end(key)
+                return embs
+            if self.conn is None:
+                return None
+            row = self.conn.execute("SELECT embs, count FROM query_embeddings WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            embs = np.frombuffer(row[0], dtype=np.float32).reshape(row[1], EMBEDDING_DIM)
+            self.conn.execute("UPDATE query_embeddings SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+            self._put_memory(key, embs)
+            return embs
+
+    def put(self, key, embs: np.ndarray):
+        """
+        :param embs: (n, 512), 没有人脸的文件为 (0, 512), 同样缓存
+        """
+        embs = np.ascontiguousarray(embs, dtype=np.float32).reshape(-1, EMBEDDING_DIM)
+        with self._lock:
+            self._put_memory(key, embs)
+            if self.conn is None:
+                return
+            self.conn.execute("INSERT OR REPLACE INTO query_embeddings (key, embs, count, last_used) VALUES (?, ?, ?, ?)",
+                              (key, embs.tobytes(), len(embs), time.time()))
+            # 数据库中同样只保留最近使用的 max_size 条
+            self.conn.execute("DELETE FROM query_embeddings WHERE key NOT IN "
+                              "(SELECT key FROM query_embeddings ORDER BY last_used DESC LIMIT ?)", (self.max_size,))
+            self.conn.commit()
+
+    def _put_memory(self, key, embs):
+        self._cache[key] = embs
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            if self.conn is not None:
+                self.conn.execute("DELETE FROM query_embeddings")
+                self.conn.commit()
+
+
+_query_cache: QueryCache | None = None
+_query_cache_lock = threading.Lock()
+
+
+def get_query_cache() -> QueryCache:
+    global _query_cache
+    with _query_cache_lock:
+        if _query_cache is None:
+            _query_cache = QueryCache()
+        return _query_cache
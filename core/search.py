@@ -1,19 +1,173 @@
-from core.database import query_embedding
+import logging
+from typing import Callable, List, Dict, NamedTuple
+
+import numpy as np
+
+from core.database import get_face_store, EMBEDDING_DIM
 from core.embedding import get_embeddings_by_media
-from core.utils import exception_print
-from settings import ALLOWED_IMG_TYPES, ALLOWED_VIDEO_TYPES
+from core.metrics import metrics
+from core.query_cache import get_query_cache
+from core.shards import in_scope
+from core.utils import exception_print, get_files_from_list
+from settings import ALLOWED_IMG_TYPES, ALLOWED_VIDEO_TYPES, MIN_SCORE, SEARCH_MODE, SEARCH_AGG
 
+logger = logging.getLogger(__name__)
 
-@exception_print
-def search_function(file_path, top_k, min_score):
+SEARCH_MODES = ("range", "knn")
+SEARCH_AGGS = ("max", "mean")
+
+
+class FileHit(NamedTuple):
+    # 按 agg 合并后的文件分数
+    score: float
+    path: str
+    # 分数最高的人脸在视频中的时间(秒), 图片为 None
+    frame_ts: float | None
+    # 命中的人脸数量
+    hits: int
+    # 分数最高的人脸 id
+    face_id: int
+    # 入库时去重关联到该文件的重复文件
+    duplicates: tuple = ()
+
+
+def get_query_embeddings(file_path, use_cache=True, embed_func: Callable = None) -> List[np.ndarray] | None:
+    """
+    检索文件的人脸向量, 相同内容的文件在模型版本不变时直接使用缓存
+    :param embed_func: 未命中缓存时的识别函数 file_path -> [embedding, ...] 或 None, 默认逐个文件识别
+    :return: 不支持的文件类型返回 None, 没有人脸或使用缓存时文件不存在、无法读取返回空列表
+    """
+    if embed_func is None:
+        embed_func = lambda path: get_embeddings_by_media(path, ALLOWED_IMG_TYPES, ALLOWED_VIDEO_TYPES)
+    if not use_cache:
+        return embed_func(file_path)
+
+    cache = get_query_cache()
     try:
-        embs = get_embeddings_by_media(file_path, ALLOWED_IMG_TYPES, ALLOWED_VIDEO_TYPES)
-        file_paths = query_embedding(embs, k=top_k)
-        results = [(score, file_path) for score, file_path in file_paths if score >= min_score]
-    except:
-        import traceback
-        traceback.print_exc()
-        traceback.print_stack()
-        raise
+        key = cache.make_key(file_path)
+    except OSError as e:
+        logger.warning(f"读取检索文件失败: {file_path}, {e}")
+        return []
+    embs = cache.get(key)
+    if embs is not None:
+        logger.debug(f"使用缓存的检索向量: {file_path}, 人脸数: {len(embs)}")
+        return list(embs)
+
+    embs = embed_func(file_path)
+    if embs is not None:
+        cache.put(key, np.vstack(embs) if embs else np.empty((0, EMBEDDING_DIM), dtype=np.float32))
+    return embs
+
+
+def aggregate_by_file(ids: np.ndarray, scores: np.ndarray, id_hits: Dict[int, tuple], agg=SEARCH_AGG,
+                      top_k=None) -> List[FileHit]:
+    """
+    把人脸级别的命中合并为文件级别, 同一人脸被多个查询人脸命中时只保留最高分
+    :param ids: 命中的人脸 id
+    :param scores: 与 ids 对应的分数
+    :param id_hits: {face_id: (file_path, frame_ts)}, 不在其中的人脸(已删除)被忽略
+    :param top_k: 按文件分数取前 top_k 个文件, None 表示全部
+    """
+    if agg not in SEARCH_AGGS:
+        raise ValueError(f"不支持的合并方式: {agg}, 可选: {SEARCH_AGGS}")
+    ids, scores = np.asarray(ids, dtype=np.int64), np.asarray(scores, dtype=np.float32)
+    if len(ids) == 0:
+        return []
+
+    face_ids, inverse = np.unique(ids, return_inverse=True)
+    face_scores = np.full(len(face_ids), -np.inf, dtype=np.float32)
+    np.maximum.at(face_scores, inverse, scores)
+    alive = np.array([int(face_id) in id_hits for face_id in face_ids], dtype=bool)
+    face_ids, face_scores = face_ids[alive], face_scores[alive]
+    if len(face_ids) == 0:
+        return []
+
+    paths, file_index = np.unique(np.array([id_hits[int(face_id)][0] for face_id in face_ids]), return_inverse=True)
+    counts = np.bincount(file_index, minlength=len(paths))
+    if agg == "max":
+        file_scores = np.full(len(paths), -np.inf, dtype=np.float32)
+        np.maximum.at(file_scores, file_index, face_scores)
+    else:
+        file_scores = (np.bincount(file_index, weights=face_scores, minlength=len(paths)) / counts).astype(np.float32)
+
+    # 按 (文件, 分数降序) 排序后每个文件的第一个人脸即为分数最高的人脸
+    order = np.lexsort((-face_scores, file_index))
+    best_faces = face_ids[order[np.searchsorted(file_index[order], np.arange(len(paths)))]]
 
+    top = np.argsort(-file_scores, kind="stable")[:top_k]
+    return [FileHit(float(file_scores[i]), str(paths[i]), id_hits[int(best_faces[i])][1], int(counts[i]),
+                    int(best_faces[i])) for i in top]
+
+
+def search_files(embs, top_k, min_score, mode=SEARCH_MODE, agg=SEARCH_AGG, scope: List[str] = None) -> List[FileHit]:
+    """
+    用一组查询人脸检索, 结果按文件合并
+    :param mode: range 返回分数不低于 min_score 的全部人脸后合并; knn 每个查询人脸取 top_k 个近邻后过滤
+    :param scope: 检索范围(文件夹列表), 为空时检索整个库, 只会打开与范围有交集的分片
+    """
+    return search_files_batch([embs], top_k, min_score, mode=mode, agg=agg, scope=scope)[0]
+
+
+def search_files_batch(embs_list: List, top_k, min_score, mode=SEARCH_MODE, agg=SEARCH_AGG,
+                       scope: List[str] = None) -> List[List[FileHit]]:
+    """
+    多组查询人脸拼成一个矩阵, 只检索一次索引、查询一次元数据, 每组的结果单独按文件合并
+    :param embs_list: [embs, ...], 每个元素是一个待检索文件的人脸向量, 可以为 None 或空
+    :return: 与 embs_list 一一对应的 [FileHit, ...]
+    """
+    if mode not in SEARCH_MODES:
+        raise ValueError(f"不支持的检索方式: {mode}, 可选: {SEARCH_MODES}")
+    owners = np.array([i for i, embs in enumerate(embs_list) for _ in embs or []], dtype=np.int64)
+    results = [[] for _ in embs_list]
+    if len(owners) == 0:
+        return results
+
+    store = get_face_store()
+    queries = np.vstack([emb for embs in embs_list for emb in embs or []])
+    with metrics.timer("search", items=len(queries)):
+        if mode == "range":
+            hits_list = store.range_search_ids(queries, min_score, scope=scope)
+        else:
+            hits_list = store.search_ids(queries, k=top_k, scope=scope)
+        id_hits = store.meta.get_hits(np.unique(np.concatenate([ids for ids, _ in hits_list])).tolist())
+    links = store.meta.get_links({path for path, _ in id_hits.values()})
+    if scope:
+        # 分片按根文件夹挑选, 主索引和范围较大的分片中仍有范围外的文件; 重复文件在范围内时同样保留
+        id_hits = {face_id: hit for face_id, hit in id_hits.items()
+                   if any(in_scope(path, scope) for path in [hit[0], *links.get(hit[0], [])])}
+
+    for i in np.unique(owners):
+        owned = [hits_list[j] for j in np.flatnonzero(owners == i)]
+        ids = np.concatenate([ids for ids, _ in owned])
+        scores = np.concatenate([scores for _, scores in owned])
+        keep = scores >= min_score
+        results[i] = [hit._replace(duplicates=tuple(links.get(hit.path, ())))
+                      for hit in aggregate_by_file(ids[keep], scores[keep], id_hits, agg=agg, top_k=top_k)]
     return results
+
+
+@exception_print
+def search_function(file_path, top_k, min_score, mode=SEARCH_MODE, agg=SEARCH_AGG, scope: List[str] = None) -> List[FileHit]:
+    # 异常由 exception_print 写入日志
+    embs = get_query_embeddings(file_path)
+    return search_files(embs, top_k, min_score, mode=mode, agg=agg, scope=scope)
+
+
+@exception_print
+def search_many(files: List[str], top_k=100, min_score=MIN_SCORE, mode=SEARCH_MODE,
+                agg=SEARCH_AGG) -> Dict[str, List[FileHit]]:
+    """
+    批量检索, 所有待检索文件(或文件夹)中的人脸向量拼成一个矩阵, 只检索一次索引
+    :param files: 待检索的文件或文件夹列表
+    :return: {待检索文件: [FileHit, ...]}, 每个待检索文件的结果单独按文件合并
+    """
+    query_files, embs_list = get_files_from_list(files, []), []
+    for file_path in query_files:
+        try:
+            embs = get_query_embeddings(file_path)
+        except Exception:
+            logger.exception(f"识别错误文件: {file_path}")
+            embs = None
+        embs_list.append(embs)
+
+    return dict(zip(query_files, search_files_batch(embs_list, top_k, min_score, mode=mode, agg=agg)))
@@ -0,0 +1,245 @@
+# 无界面的检索服务: 模型和索引常驻内存, 并发请求的识别和检索分别合并成批量调用
+# 用法: python -m core.server [--host 127.0.0.1] [--port 8765]
+#   GET  /health
+#   POST /search  {"path": 服务端可读的文件路径} 或 {"image": base64 编码的图片} 或 {"embeddings": [[...], ...]},
+#                 可选 top_k、min_score、mode、agg、scope, 返回 {"results": [FileHit, ...], "faces": 查询人脸数}
+import base64
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Callable, List
+
+import cv2
+import numpy as np
+
+from core.database import get_face_store, EMBEDDING_DIM
+from core.embedding import decode_media, infer_media
+from core.models import registry, warmup
+from core.search import get_query_embeddings, search_files_batch, SEARCH_MODES, SEARCH_AGGS
+from core.utils import setup_logging
+from settings import SERVER_HOST, SERVER_PORT, SERVER_MAX_BATCH, SERVER_MAX_WAIT_MS, MIN_SCORE, SEARCH_MODE, \
+    SEARCH_AGG, WARMUP_MODELS
+
+logger = logging.getLogger(__name__)
+
+
+class MicroBatcher:
+    """
+    请求线程 submit 后等待 Future, 后台线程从收到第一个请求起最多等待 max_wait 秒, 凑满 max_batch 个后一起处理
+    单个请求时只多等待 max_wait, 并发请求越多每批越大
+    """
+
+    def __init__(self, func: Callable[[List], List], max_batch=SERVER_MAX_BATCH, max_wait=SERVER_MAX_WAIT_MS / 1000,
+                 name="micro-batcher"):
+        """
+        :param func: [item, ...] -> [result, ...], 结果与输入一一对应, 某一项的结果为 Exception 时只有该请求失败
+        """
+        self.func = func
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, item) -> Future:
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            items, futures = [item for item, _ in batch], [future for _, future in batch]
+            for future, result in zip(futures, self._call(items)):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def _call(self, items) -> list:
+        """
+        整批出错时逐个重新处理, 一个请求的错误不影响同一批的其他请求
+        """
+        try:
+            return self.func(items)
+        except Exception as e:
+            if len(items) == 1:
+                return [e]
+        results = []
+        for item in items:
+            try:
+                results.append(self.func([item])[0])
+            except Exception as e:
+                results.append(e)
+        return results
+
+
+def search_grouped(requests: List[tuple]) -> List[list]:
+    """
+    参数相同的请求合并为一次索引检索, 某一组出错时只有该组的请求失败
+    :param requests: [(embs, (top_k, min_score, mode, agg, scope)), ...]
+    :return: 与 requests 一一对应的 [FileHit, ...] 或 Exception
+    """
+    results, groups = [None] * len(requests), {}
+    for i, (_, params) in enumerate(requests):
+        groups.setdefault(params, []).append(i)
+    for (top_k, min_score, mode, agg, scope), indices in groups.items():
+        try:
+            batch = search_files_batch([requests[i][0] for i in indices], top_k, min_score, mode=mode, agg=agg,
+                                       scope=list(scope) if scope else None)
+        except Exception as e:
+            batch = [e] * len(indices)
+        for i, hits in zip(indices, batch):
+            results[i] = hits
+    return results
+
+
+class SearchService:
+    """
+    识别和检索各有一个批处理线程: 解码在请求线程中并行进行, 多个请求的画面合并为一次 infer_media,
+    多个请求的查询向量合并为一次索引检索
+    """
+
+    def __init__(self, max_batch=SERVER_MAX_BATCH, max_wait=SERVER_MAX_WAIT_MS / 1000):
+        self.recognizer = MicroBatcher(infer_media, max_batch, max_wait, name="recognize-batcher")
+        self.searcher = MicroBatcher(search_grouped, max_batch, max_wait, name="search-batcher")
+
+    def embed_decoded(self, decoded) -> List[np.ndarray] | None:
+        if decoded is None:
+            return None
+        if not decoded:
+            return []
+        return [face["embedding"] for face in self.recognizer.submit(decoded).result()]
+
+    def embed_file(self, file_path) -> List[np.ndarray] | None:
+        return self.embed_decoded(decode_media(file_path))
+
+    def get_embeddings(self, request: dict) -> List[np.ndarray] | None:
+        if "embeddings" in request:
+            # 在入队之前检查, 维度不对的向量会让同一批的检索全部失败
+            embs = np.asarray(request["embeddings"], dtype=np.float32)
+            if embs.size == 0:
+                return []
+            if embs.ndim != 2 or embs.shape[1] != EMBEDDING_DIM or not np.isfinite(embs).all():
+                raise ValueError(f"embeddings 应为 n x {EMBEDDING_DIM} 的有限数值矩阵, 实际为 {embs.shape}")
+            return list(embs)
+        if "image" in request:
+            image = cv2.imdecode(np.frombuffer(base64.b64decode(request["image"]), dtype=np.uint8), cv2.IMREAD_COLOR)
+            if image is None:
+                raise ValueError("无法解码 image")
+            return self.embed_decoded([(image, None, None, None)])
+        if "path" in request:
+            if not os.path.isfile(request["path"]):
+                raise FileNotFoundError(request["path"])
+            return get_query_embeddings(request["path"], embed_func=self.embed_file)
+        raise ValueError("请求中需要 path、image 或 embeddings")
+
+    def search(self, request: dict) -> dict:
+        mode, agg = request.get("mode", SEARCH_MODE), request.get("agg", SEARCH_AGG)
+        if mode not in SEARCH_MODES or agg not in SEARCH_AGGS:
+            raise ValueError(f"mode 可选: {SEARCH_MODES}, agg 可选: {SEARCH_AGGS}")
+        scope = request.get("scope")
+        params = (int(request.get("top_k", 100)), float(request.get("min_score", MIN_SCORE)), mode, agg,
+                  tuple(scope) if scope else None)
+
+        embs = self.get_embeddings(request)
+        if embs is None:
+            raise ValueError("不支持的文件类型")
+        hits = self.searcher.submit((embs, params)).result() if embs else []
+        return {"results": [hit._asdict() for hit in hits], "faces": len(embs)}
+
+    @staticmethod
+    def health() -> dict:
+        store = get_face_store()
+        return {"status": "ok", "faces": store.meta.face_count(),
+                "models": {name: registry.is_loaded(name) for name in ("face_store", "buffalo", "yolo")},
+                "timings": registry.timings}
+
+
+class SearchRequestHandler(BaseHTTPRequestHandler):
+    service: SearchService = None
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, self.service.health())
+        else:
+            self._send_json(404, {"error": f"未知的路径: {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/search":
+            self._send_json(404, {"error": f"未知的路径: {self.path}"})
+            return
+        b = time.time()
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            response = self.service.search(request)
+        except FileNotFoundError as e:
+            self._send_json(404, {"error": f"文件不存在: {e}"})
+            return
+        except (ValueError, TypeError, KeyError) as e:
+            self._send_json(400, {"error": str(e)})
+            return
+        except Exception as e:
+            logger.exception("检索请求出错")
+            self._send_json(500, {"error": str(e)})
+            return
+        response["seconds"] = time.time() - b
+        self._send_json(200, response)
+
+    def _send_json(self, status, data):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # 高并发时不逐条打印请求日志
+        pass
+
+
+def serve(host=SERVER_HOST, port=SERVER_PORT, max_batch=SERVER_MAX_BATCH, max_wait=SERVER_MAX_WAIT_MS / 1000):
+    """
+    启动前同步加载并预热模型和索引, 第一个请求不需要等待加载
+    """
+    warmup(WARMUP_MODELS, background=False)
+    logger.info(f"启动耗时: {registry.report()}")
+    SearchRequestHandler.service = SearchService(max_batch, max_wait)
+    server = ThreadingHTTPServer((host, port), SearchRequestHandler)
+    server.daemon_threads = True
+    logger.info(f"检索服务已启动: http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="检索服务")
+    parser.add_argument("--host", default=SERVER_HOST)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("--max-batch", type=int, default=SERVER_MAX_BATCH)
+    parser.add_argument("--max-wait-ms", type=float, default=SERVER_MAX_WAIT_MS)
+    args = parser.parse_args()
+    setup_logging()
+    serve(args.host, args.port, args.max_batch, args.max_wait_ms / 1000)
@@ -0,0 +1,280 @@
+# 只读分片: 按根文件夹划分的 faiss 索引文件, 以内存映射方式打开, 启动时不读取向量数据
+import hashlib
+import json
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+import faiss
+import numpy as np
+
+from core.utils import atomic_write
+from settings import SHARD_DIR, SHARD_DEPTH, SHARD_SEARCH_WORKERS
+
+SHARDS_FILE = "shards.json"
+
+
+def normalize_path(path) -> str:
+    return path.replace("\\", "/").rstrip("/")
+
+
+def shard_root(path, depth=SHARD_DEPTH) -> str:
+    """
+    文件所属分片的根文件夹, 即所在目录的前 depth 层, 如 D:/photos/2024/a.jpg -> D:/photos
+    """
+    parts = normalize_path(os.path.dirname(path)).split("/")
+    # 以 / 开头的路径第一段为空字符串, 不计入层数
+    depth += parts[0] == ""
+    return "/".join(parts[:depth])
+
+
+def in_scope(path, scope: List[str] | None) -> bool:
+    if not scope:
+        return True
+    path = normalize_path(path)
+    return any(path == folder or path.startswith(folder + "/") for folder in map(normalize_path, scope))
+
+
+def get_mmap_flag(index_type) -> int:
+    """
+    倒排索引映射倒排表, 其余类型映射向量编码
+    faiss 1.11 之前没有 IO_FLAG_MMAP_IFC, 退回 IO_FLAG_MMAP, 非倒排索引此时整体读入内存
+    """
+    if index_type in ("ivf_flat", "ivf_pq"):
+        return faiss.IO_FLAG_MMAP
+    return getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+
+
+def search_params(index, selector=None):
+    """
+    带 id 过滤的检索参数, 倒排和 hnsw 需要对应类型的参数, 并沿用索引上设置的 nprobe / efSearch
+    :param selector: 只检索被选中的 id, None 时不过滤
+    """
+    if selector is None:
+        return None
+    sub_index = faiss.downcast_index(index.index)
+    if isinstance(sub_index, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(sel=selector, nprobe=sub_index.nprobe)
+    if isinstance(sub_index, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=sub_index.hnsw.efSearch)
+    return faiss.SearchParameters(sel=selector)
+
+
+def merge_knn(results: List[tuple], k) -> tuple:
+    """
+    合并同一条查询在多个分片中的 k 近邻结果, 同一 id 只保留一次
+    :param results: [(ids, scores), ...]
+    """
+    ids = np.concatenate([ids for ids, _ in results])
+    scores = np.concatenate([scores for _, scores in results])
+    order = np.argsort(-scores, kind="stable")
+    ids, scores = ids[order], scores[order]
+    _, first = np.unique(ids, return_index=True)
+    first = np.sort(first)[:k]
+    return ids[first], scores[first]
+
+
+class ShardSet:
+    """
+    一代分片保存在 shard_dir/gen_{generation} 下, shards.json 记录每个分片的根文件夹和索引类型;
+    同一根文件夹每次 seal 追加一个新的分片文件, 已有的分片不再改写, 重建时每个根文件夹合并为一个分片写入新一代目录,
+    由元数据中的 shard_generation 决定使用哪一代
+    内存映射的索引不能修改, 写入前先关闭
+    """
+
+    def __init__(self, shard_dir=SHARD_DIR, generation=0, workers=SHARD_SEARCH_WORKERS):
+        self.shard_dir = shard_dir
+        self.generation = generation
+        self.workers = workers
+        self._lock = threading.RLock()
+        self._indexes: Dict[str, faiss.Index] = {}
+        # 已删除但仍留在分片中的 id(升序)及排除它们的 id 过滤器
+        self._tombstones = np.empty(0, dtype=np.int64)
+        self._selectors = None
+        self.shards: Dict[str, dict] = self._load_shards(generation)
+
+    @property
+    def generation_dir(self) -> str:
+        return os.path.join(self.shard_dir, f"gen_{self.generation}")
+
+    @staticmethod
+    def shard_name(root) -> str:
+        return hashlib.blake2b(root.encode("utf-8"), digest_size=8).hexdigest()
+
+    def shard_file(self, name, generation=None) -> str:
+        generation = self.generation if generation is None else generation
+        return os.path.join(self.shard_dir, f"gen_{generation}", f"shard_{name}.index")
+
+    def roots(self) -> Dict[str, List[str]]:
+        """
+        :return: {根文件夹: [分片名, ...]}
+        """
+        roots = {}
+        for name, shard in self.shards.items():
+            roots.setdefault(shard["root"], []).append(name)
+        return roots
+
+    @property
+    def ntotal(self) -> int:
+        return sum(shard["ntotal"] for shard in self.shards.values())
+
+    @property
+    def max_id(self) -> int:
+        return max((shard["max_id"] for shard in self.shards.values()), default=0)
+
+    def remove_stale_generations(self):
+        """
+        删除当前代以外的分片目录(重建中断或已被替换)
+        """
+        if not os.path.isdir(self.shard_dir):
+            return
+        for name in os.listdir(self.shard_dir):
+            if name.startswith("gen_") and name != f"gen_{self.generation}":
+                shutil.rmtree(os.path.join(self.shard_dir, name), ignore_errors=True)
+
+    def clear_generation(self, generation):
+        """
+        清空尚未切换到的一代分片目录, 同一进程中上次重建失败留下的分片不会与新写入的混在一起
+        """
+        if generation == self.generation:
+            raise ValueError(f"不能清空当前使用的分片: gen_{generation}")
+        shutil.rmtree(os.path.join(self.shard_dir, f"gen_{generation}"), ignore_errors=True)
+
+    def set_tombstones(self, ids):
+        """
+        设置已删除的 id, 之后的检索在包含它们的分片中排除这些 id
+        """
+        with self._lock:
+            self._tombstones = np.array(sorted(ids), dtype=np.int64)
+            if len(self._tombstones):
+                batch = faiss.IDSelectorBatch(self._tombstones)
+                # IDSelectorNot 不持有 IDSelectorBatch 的引用, 两个一起保存
+                self._selectors = (batch, faiss.IDSelectorNot(batch))
+            else:
+                self._selectors = None
+
+    @property
+    def tombstone_selector(self):
+        selectors = self._selectors
+        return None if selectors is None else selectors[1]
+
+    def _selector(self, name):
+        """
+        分片的 id 范围内有已删除的 id 时才使用过滤器, faiss 1.10 的 flat 索引带过滤器检索时不走 BLAS, 慢数倍
+        """
+        selector, shard = self.tombstone_selector, self.shards[name]
+        if selector is None:
+            return None
+        start = np.searchsorted(self._tombstones, shard.get("min_id", 0))
+        return selector if start < len(self._tombstones) and self._tombstones[start] <= shard["max_id"] else None
+
+    def select(self, scope: List[str] | None = None) -> List[str]:
+        """
+        与检索范围有交集的分片: 分片在范围内, 或者范围在分片内
+        """
+        if not scope:
+            return list(self.shards)
+        scope = [normalize_path(folder) for folder in scope]
+        return [name for name, shard in self.shards.items()
+                if any(in_scope(shard["root"], [folder]) or in_scope(folder, [shard["root"]]) for folder in scope)]
+
+    def open(self, name) -> faiss.Index:
+        with self._lock:
+            index = self._indexes.get(name)
+            if index is None:
+                index = faiss.read_index(self.shard_file(name), get_mmap_flag(self.shards[name]["type"]))
+                self._indexes[name] = index
+            return index
+
+    def close(self, name=None):
+        """
+        释放内存映射, Windows 下被映射的文件不能替换
+        """
+        with self._lock:
+            if name is None:
+                self._indexes.clear()
+            else:
+                self._indexes.pop(name, None)
+
+    def search(self, queries: np.ndarray, k, scope=None) -> List[List[tuple]]:
+        """
+        并行检索范围内的分片, 已删除的向量被排除在外, 不会占用 k 个名额
+        :return: 每个分片一个列表, 列表中是每条查询的 (ids, scores)
+        """
+        names = self.select(scope)
+
+        def search_shard(name):
+            index = self.open(name)
+            distances, indices = index.search(queries, k, params=search_params(index, self._selector(name)))
+            return [(row_ids[row_ids >= 0], row_scores[row_ids >= 0]) for row_ids, row_scores in zip(indices, distances)]
+
+        return self._map(search_shard, names)
+
+    def range_search(self, queries: np.ndarray, radius, scope=None) -> List[List[tuple]]:
+        names = self.select(scope)
+
+        def search_shard(name):
+            index = self.open(name)
+            lims, distances, indices = index.range_search(queries, radius,
+                                                          params=search_params(index, self._selector(name)))
+            return [(indices[lims[i]:lims[i + 1]], distances[lims[i]:lims[i + 1]]) for i in range(len(queries))]
+
+        return self._map(search_shard, names)
+
+    def _map(self, func, names):
+        if len(names) <= 1:
+            return [func(name) for name in names]
+        # faiss 检索时释放 GIL, 多个分片可以并行
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(names))) as pool:
+            return list(pool.map(func, names))
+
+    def read_vectors(self, name):
+        """
+        完整读取分片中的 (ids, vectors), 不使用内存映射
+        """
+        from core.database import get_index_vectors
+
+        return get_index_vectors(faiss.read_index(self.shard_file(name)))
+
+    def write_shard(self, root, index, generation=None) -> str:
+        """
+        把 index 原子写入为根文件夹下一个新的分片文件并更新 shards.json, 不改写已有的分片
+        :return: 分片名
+        """
+        from core.database import get_index_type, get_index_min_id, get_index_max_id
+
+        generation = self.generation if generation is None else generation
+        with self._lock:
+            shards = self.shards if generation == self.generation else self._load_shards(generation)
+            seq = sum(shard["root"] == root for shard in shards.values())
+        name = f"{self.shard_name(root)}_{seq}"
+        index_bytes = faiss.serialize_index(index)
+        atomic_write(self.shard_file(name, generation), lambda file: file.write(index_bytes.tobytes()))
+        with self._lock:
+            shards = self.shards if generation == self.generation else self._load_shards(generation)
+            shards[name] = {"root": root, "type": get_index_type(index), "ntotal": int(index.ntotal),
+                             "min_id": get_index_min_id(index), "max_id": get_index_max_id(index)}
+            self._write_shards(shards, generation)
+        return name
+
+    def _load_shards(self, generation) -> Dict[str, dict]:
+        shards_file = os.path.join(self.shard_dir, f"gen_{generation}", SHARDS_FILE)
+        if not os.path.exists(shards_file):
+            return {}
+        with open(shards_file, "r", encoding="utf-8") as file:
+            return json.load(file)
+
+    def _write_shards(self, shards, generation):
+        data = json.dumps(shards, ensure_ascii=False, indent=2).encode("utf-8")
+        atomic_write(os.path.join(self.shard_dir, f"gen_{generation}", SHARDS_FILE), lambda file: file.write(data))
+
+    def switch_generation(self, generation):
+        """
+        切换到已经写好的新一代分片
+        """
+        with self._lock:
+            self.close()
+            self.generation = generation
+            self.shards = self._load_shards(generation)
@@ -0,0 +1,203 @@
+# 缩略图磁盘缓存, 以 (路径, 修改时间, 大小, 帧时间) 为键, 文件变化后自动失效, 超出容量时按最近使用时间淘汰
+import hashlib
+import logging
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from settings import THUMBNAIL_DIR, THUMBNAIL_CACHE_BYTES, THUMBNAIL_SIZE, ALLOWED_IMG_TYPES, ALLOWED_VIDEO_TYPES
+
+logger = logging.getLogger(__name__)
+
+# 淘汰时删除到容量的 90%, 避免每次写入都触发淘汰
+EVICT_RATIO = 0.9
+THUMBNAIL_QUALITY = 85
+
+_REDUCED_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+
+def read_image_reduced(file_path, size=THUMBNAIL_SIZE) -> np.ndarray | None:
+    """
+    按缩略图尺寸降采样解码, 长边不小于 size 的前提下尽量使用 1/8、1/4、1/2 的解码尺寸,
+    JPEG 在 DCT 阶段直接缩小, 比完整解码再缩放快得多
+    """
+    try:
+        # 只读取文件头得到原图尺寸
+        with Image.open(file_path) as image:
+            long_side = max(image.size)
+    except Exception:
+        long_side = 0
+
+    flag = cv2.IMREAD_COLOR
+    for factor, reduced_flag in _REDUCED_FLAGS:
+        if long_side // factor >= size:
+            flag = reduced_flag
+            break
+    image = cv2.imdecode(np.fromfile(file_path, dtype=np.uint8), flag)
+    if image is None:
+        with Image.open(file_path) as pil_image:
+            pil_image.draft("RGB", (size, size))
+            image = cv2.cvtColor(np.array(pil_image.convert("RGB")), cv2.COLOR_RGB2BGR)
+    return image
+
+
+def read_video_frame(video_path, frame_ts=None) -> np.ndarray | None:
+    """
+    读取视频中 frame_ts 秒的帧, frame_ts 为空时取第 100 帧
+    """
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        return None
+
+    if frame_ts is not None:
+        cap.set(cv2.CAP_PROP_POS_MSEC, frame_ts * 1000)
+    else:
+        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        cap.set(cv2.CAP_PROP_POS_FRAMES, min(100, total_frames))
+
+    ret, frame = cap.read()
+    cap.release()
+    return frame if ret else None
+
+
+def resize_thumbnail(image: np.ndarray, size=THUMBNAIL_SIZE) -> np.ndarray:
+    h, w = image.shape[:2]
+    scale = size / max(h, w)
+    if scale >= 1:
+        return image
+    return cv2.resize(image, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=cv2.INTER_AREA)
+
+
+class ThumbnailCache:
+    """
+    缩略图保存为 JPEG, 按键的哈希分到 256 个子目录
+    命中时更新文件的修改时间, 淘汰时删除修改时间最早的文件, 即最久未使用的缩略图
+    """
+
+    def __init__(self, cache_dir=THUMBNAIL_DIR, max_bytes=THUMBNAIL_CACHE_BYTES, size=THUMBNAIL_SIZE):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.size = size
+        self._lock = threading.Lock()
+        # 缓存目录的总大小, 第一次写入时统计
+        self._total_bytes = None
+
+    def _cache_file(self, path, frame_ts=None, size=None, mtime=None) -> str:
+        if size is None or mtime is None:
+            stat = os.stat(path)
+            size, mtime = stat.st_size, stat.st_mtime
+        key = f"{os.path.abspath(path)}|{size}|{mtime:.6f}|{'' if frame_ts is None else f'{frame_ts:.3f}'}"
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], f"{digest}.jpg")
+
+    def get(self, path, frame_ts=None) -> str | None:
+        """
+        :return: 已缓存的缩略图文件路径, 源文件不存在或未缓存时返回 None
+        """
+        try:
+            cache_file = self._cache_file(path, frame_ts)
+            os.utime(cache_file)
+        except OSError:
+            return None
+        return cache_file
+
+    def put(self, path, frame_ts, image: np.ndarray, size=None, mtime=None) -> str | None:
+        """
+        缩放并写入缩略图
+        :param image: BGR 图片, 可以是原尺寸
+        :param size: 源文件大小, 与 mtime 一起由调用方传入时不再 stat
+        :return: 缩略图文件路径
+        """
+        ok, data = cv2.imencode(".jpg", resize_thumbnail(image, self.size), [cv2.IMWRITE_JPEG_QUALITY, THUMBNAIL_QUALITY])
+        if not ok:
+            return None
+        cache_file = self._cache_file(path, frame_ts, size, mtime)
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp_file = f"{cache_file}.{threading.get_ident()}.tmp"
+        with open(tmp_file, "wb") as file:
+            file.write(data.tobytes())
+        os.replace(tmp_file, cache_file)
+
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = sum(size for _, size, _ in self._iter_cache_files())
+            else:
+                self._total_bytes += len(data)
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+        return cache_file
+
+    def ensure(self, path, frame_ts=None) -> str | None:
+        """
+        返回缩略图文件路径, 未缓存时从源文件生成, 无法读取时返回 None
+        """
+        cache_file = self.get(path, frame_ts)
+        if cache_file is not None:
+            return cache_file
+        if not os.path.exists(path):
+            return None
+
+        if path.lower().endswith(ALLOWED_IMG_TYPES):
+            image = read_image_reduced(path, self.size)
+        elif path.lower().endswith(ALLOWED_VIDEO_TYPES):
+            image = read_video_frame(path, frame_ts)
+        else:
+            return None
+        if image is None:
+            return None
+        return self.put(path, frame_ts, image)
+
+    def put_frames(self, path, frames, size=None, mtime=None):
+        """
+        入库时用已经解码的画面生成缩略图, 同一时间的帧只写一次; 跟踪模式下只有人脸附近的裁剪区域, 不生成
+        :param frames: decode_media 的结果 [(BGR 图片, 检测结果, 帧时间戳, 轨迹 id), ...]
+        """
+        done = set()
+        for image, _, frame_ts, track_id in frames:
+            if image is None or track_id is not None or frame_ts in done:
+                continue
+            done.add(frame_ts)
+            self.put(path, frame_ts, image, size, mtime)
+
+    def _iter_cache_files(self):
+        if not os.path.isdir(self.cache_dir):
+            return
+        for sub_dir in os.scandir(self.cache_dir):
+            if not sub_dir.is_dir():
+                continue
+            for entry in os.scandir(sub_dir.path):
+                if entry.name.endswith(".jpg"):
+                    stat = entry.stat()
+                    yield entry.path, stat.st_size, stat.st_mtime
+
+    def _evict(self):
+        b = time.time()
+        files = sorted(self._iter_cache_files(), key=lambda item: item[2])
+        total, removed = sum(size for _, size, _ in files), 0
+        for cache_file, size, _ in files:
+            if total <= self.max_bytes * EVICT_RATIO:
+                break
+            try:
+                os.remove(cache_file)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        self._total_bytes = total
+        logger.info(f"缩略图缓存已淘汰 {removed} 个文件, 剩余 {total / 1024 ** 2:.1f}MB, 耗时: {time.time() - b:.2f}s")
+
+
+_thumbnail_cache: ThumbnailCache | None = None
+_thumbnail_cache_lock = threading.Lock()
+
+
+def get_thumbnail_cache() -> ThumbnailCache:
+    global _thumbnail_cache
+    with _thumbnail_cache_lock:
+        if _thumbnail_cache is None:
+            _thumbnail_cache = ThumbnailCache()
+        return _thumbnail_cache
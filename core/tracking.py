@@ -0,0 +1,153 @@
+# 视频人脸跟踪, 把多帧中的检测结果串成轨迹, 每条轨迹只保留少量有代表性的人脸
+from typing import Callable, List
+
+import numpy as np
+
+from core.video import iter_video_frames, iter_frame_batches
+from settings import YOLO_BATCH_SIZE, TRACK_IOU_THRESH, TRACK_MAX_GAP, TRACK_MAX_CANDIDATES, TRACK_MAX_EMBEDDINGS, \
+    TRACK_MERGE_SIM, TRACK_DUPLICATE_SIM, VIDEO_SAMPLE_FPS, TRACK_CROP_MARGIN
+
+
+def box_iou(boxes_a: np.ndarray, boxes_b: np.ndarray) -> np.ndarray:
+    """
+    :return: (len(boxes_a), len(boxes_b)) 的 IoU 矩阵
+    """
+    x1 = np.maximum(boxes_a[:, None, 0], boxes_b[None, :, 0])
+    y1 = np.maximum(boxes_a[:, None, 1], boxes_b[None, :, 1])
+    x2 = np.minimum(boxes_a[:, None, 2], boxes_b[None, :, 2])
+    y2 = np.minimum(boxes_a[:, None, 3], boxes_b[None, :, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (boxes_a[:, 2] - boxes_a[:, 0]) * (boxes_a[:, 3] - boxes_a[:, 1])
+    area_b = (boxes_b[:, 2] - boxes_b[:, 0]) * (boxes_b[:, 3] - boxes_b[:, 1])
+    return inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-6)
+
+
+def crop_face(frame: np.ndarray, box: np.ndarray, margin=TRACK_CROP_MARGIN) -> tuple:
+    """
+    裁剪人脸框四周外扩 margin 倍宽高的区域, 关键点模型和对齐需要框外的一部分画面
+    :return: (裁剪区域的副本, 裁剪区域左上角在原画面中的坐标 (x, y))
+    """
+    h, w = frame.shape[:2]
+    box_w, box_h = box[2] - box[0], box[3] - box[1]
+    x1, y1 = int(max(0, np.floor(box[0] - box_w * margin))), int(max(0, np.floor(box[1] - box_h * margin)))
+    x2, y2 = int(min(w, np.ceil(box[2] + box_w * margin))), int(min(h, np.ceil(box[3] + box_h * margin)))
+    # 复制一份, 不引用整帧画面
+    return frame[y1:y2, x1:x2].copy(), np.array([x1, y1], dtype=np.float32)
+
+
+class IouTracker:
+    """
+    按检测框 IoU 贪心关联相邻采样帧中的人脸
+    每条轨迹只保留 det_score 最高的 max_candidates 个检测作为候选, 候选只保存人脸附近的裁剪区域,
+    内存占用与视频长度和分辨率无关
+    """
+
+    def __init__(self, iou_thresh=TRACK_IOU_THRESH, max_gap=TRACK_MAX_GAP, max_candidates=TRACK_MAX_CANDIDATES,
+                 crop_margin=TRACK_CROP_MARGIN):
+        self.iou_thresh = iou_thresh
+        self.max_gap = max_gap
+        self.max_candidates = max_candidates
+        self.crop_margin = crop_margin
+        # track_id -> {"box": 最近一次的框, "ts": 最近出现的时间, "candidates": [(score, ts, crop, detection)]}
+        self.tracks = {}
+        self._next_id = 0
+
+    def update(self, frame: np.ndarray, frame_ts: float, boxes: np.ndarray, scores: np.ndarray, kpss=None):
+        # seek 抽帧时时间戳不是单调递增的, 用时间差的绝对值判断
+        active_ids = [track_id for track_id, track in self.tracks.items()
+                      if abs(frame_ts - track["ts"]) <= self.max_gap]
+        matched = {}
+        if active_ids and len(boxes):
+            iou = box_iou(np.stack([self.tracks[track_id]["box"] for track_id in active_ids]), boxes)
+            for t, d in zip(*np.unravel_index(np.argsort(-iou, axis=None), iou.shape)):
+                if iou[t, d] < self.iou_thresh:
+                    break
+                if active_ids[t] in matched.values() or d in matched:
+                    continue
+                matched[d] = active_ids[t]
+
+        for d in range(len(boxes)):
+            track_id = matched.get(d)
+            if track_id is None:
+                track_id, self._next_id = self._next_id, self._next_id + 1
+                self.tracks[track_id] = {"box": boxes[d], "ts": frame_ts, "candidates": []}
+            track = self.tracks[track_id]
+            track["box"], track["ts"] = boxes[d], frame_ts
+            candidates, score = track["candidates"], float(scores[d])
+            # 进不了前 max_candidates 的检测不裁剪
+            if len(candidates) >= self.max_candidates and score <= candidates[-1][0]:
+                continue
+            crop, offset = crop_face(frame, boxes[d], self.crop_margin)
+            # 检测结果换算到裁剪区域的坐标, 附带偏移量, 识别后再换算回原画面
+            detection = (boxes[d:d + 1] - np.tile(offset, 2), scores[d:d + 1],
+                         None if kpss is None else kpss[d:d + 1] - offset, offset)
+            candidates.append((score, frame_ts, crop, detection))
+            candidates.sort(key=lambda candidate: -candidate[0])
+            del candidates[self.max_candidates:]
+
+    def candidates(self) -> List[tuple]:
+        """
+        :return: [(crop, detection, frame_ts, track_id), ...], detection 为 (boxes, scores, kpss, offset)
+        """
+        return [(crop, detection, frame_ts, track_id)
+                for track_id, track in self.tracks.items()
+                for _, frame_ts, crop, detection in track["candidates"]]
+
+
+def extract_video_face_tracks(video_path, detect_batch_func: Callable, sample_fps=VIDEO_SAMPLE_FPS,
+                              batch_size=YOLO_BATCH_SIZE) -> List[tuple]:
+    """
+    抽帧检测并跟踪视频中的所有人脸, 每 batch_size 帧批量检测一次
+    :param detect_batch_func: [frame, ...] -> [(boxes, scores, kpss), ...]
+    :return: 各轨迹的候选人脸 [(crop, detection, frame_ts, track_id), ...], 见 IouTracker.candidates
+    """
+    tracker = IouTracker()
+    for batch in iter_frame_batches(iter_video_frames(video_path, sample_fps), batch_size):
+        detections = detect_batch_func([frame for _, frame in batch])
+        for (frame_ts, frame), (boxes, scores, kpss) in zip(batch, detections):
+            tracker.update(frame, frame_ts, boxes, scores, kpss)
+    return tracker.candidates()
+
+
+def _normalize(embeddings: np.ndarray) -> np.ndarray:
+    return embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-6)
+
+
+def select_track_representatives(faces: list, track_ids: List[int], merge_sim=TRACK_MERGE_SIM,
+                                 duplicate_sim=TRACK_DUPLICATE_SIM, max_embeddings=TRACK_MAX_EMBEDDINGS) -> list:
+    """
+    按轨迹挑选代表性人脸
+    先把平均特征相似的轨迹合并(同一个人离开画面后再次出现), 再在每条轨迹中按 det_score
+    从高到低挑选, 跳过与已选人脸过于相似的, 每条轨迹最多保留 max_embeddings 个
+    """
+    if not faces:
+        return []
+
+    groups = {}
+    for face, track_id in zip(faces, track_ids):
+        groups.setdefault(track_id, []).append(face)
+
+    track_list = list(groups.values())
+    means = _normalize(np.stack([_normalize(np.stack([face.embedding for face in group])).mean(axis=0)
+                                 for group in track_list]))
+    merged, owner = [], [-1] * len(track_list)
+    for i in range(len(track_list)):
+        if owner[i] < 0:
+            owner[i] = len(merged)
+            merged.append([])
+        for j in range(i + 1, len(track_list)):
+            if owner[j] < 0 and float(means[i] @ means[j]) >= merge_sim:
+                owner[j] = owner[i]
+        merged[owner[i]].extend(track_list[i])
+
+    selected = []
+    for group in merged:
+        chosen = []
+        for face in sorted(group, key=lambda f: -f.det_score):
+            embedding = _normalize(face.embedding.reshape(1, -1))[0]
+            if all(float(embedding @ other) < duplicate_sim for other in chosen):
+                chosen.append(embedding)
+                selected.append(face)
+            if len(chosen) >= max_embeddings:
+                break
+    return selected
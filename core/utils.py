@@ -1,16 +1,42 @@
+import logging
 import os
 
+from settings import LOG_LEVEL, LOG_FORMAT
+
+logger = logging.getLogger(__name__)
+
+
+def setup_logging(level=None):
+    """
+    程序入口调用一次, 配置根日志的级别和格式
+    """
+    logging.basicConfig(level=level or LOG_LEVEL, format=LOG_FORMAT)
+
+
+def scan_dir_entries(dir_path):
+    """
+    使用 os.scandir 非递归遍历目录, 返回文件的 os.DirEntry, 其 stat 结果可以直接复用
+    """
+    stack = [dir_path]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if entry.is_file():
+                        yield entry
+                    elif entry.is_dir():
+                        stack.append(entry.path)
+        except PermissionError as e:
+            logger.warning(f"无法读取目录: {e}")
+
 
 def get_dir_files(dir_path):
-    for file_name in os.listdir(dir_path):
-        file_path = os.path.join(dir_path, file_name)
-        if os.path.isfile(file_path):
-            yield file_path
-        elif os.path.isdir(file_path):
-            yield from get_dir_files(file_path)
+    for entry in scan_dir_entries(dir_path):
+        yield entry.path
 
 
 def get_files_from_list(dir_list, exist_file_paths):
+    exist_file_paths = set(exist_file_paths)
     file_list = []
     for obj_path in dir_list:
         if obj_path in exist_file_paths:
@@ -26,14 +52,30 @@ def get_files_from_list(dir_list, exist_file_paths):
     return file_list
 
 
+def atomic_write(filename, write_func):
+    """
+    先写临时文件并 fsync, 再原子替换目标文件
+    """
+    dir_name = os.path.dirname(filename)
+    if dir_name:
+        os.makedirs(dir_name, exist_ok=True)
+    tmp_filename = f"{filename}.tmp"
+    with open(tmp_filename, 'wb') as file:
+        write_func(file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_filename, filename)
+
+
 def exception_print(func):
+    """
+    异常时把堆栈写入日志后继续抛出
+    """
     def __exe__(*args, **kwargs):
         try:
             return func(*args, **kwargs)
-        except:
-            import traceback
-            traceback.print_exc()
-            traceback.print_stack()
+        except Exception:
+            logger.exception(f"{func.__name__} 执行失败")
             raise
 
     return __exe__
@@ -91,7 +133,7 @@ def remove_video_suffix(input_path, output_path, threshold=0.95, buffer_frames=1
         prev_frame = current_gray.copy()
 
     if not found_cut:
-        print("未检测到重复后缀")
+        logger.info("未检测到重复后缀")
         return
 
     # 重新定位到视频开头
@@ -111,7 +153,7 @@ def remove_video_suffix(input_path, output_path, threshold=0.95, buffer_frames=1
 
     cap.release()
     out.release()
-    print(f"视频处理完成，保留前 {cut_position} 帧（原始 {total_frames} 帧）")
+    logger.info(f"视频处理完成，保留前 {cut_position} 帧（原始 {total_frames} 帧）")
 
 
 # 使用示例
@@ -0,0 +1,177 @@
+# 视频抽帧
+import importlib.util
+import logging
+import time
+from typing import Iterator, Tuple
+
+import cv2
+import numpy as np
+
+from settings import VIDEO_SAMPLE_FPS, VIDEO_SAMPLE_MODE, VIDEO_TIME_BUDGET, VIDEO_MAX_SAMPLES
+
+logger = logging.getLogger(__name__)
+
+# 可选的抽帧方式:
+# read     逐帧 read, 跳过的帧也完整解码并转换颜色
+# grab     跳过的帧只 grab, 不 retrieve, 省去像素格式转换和拷贝
+# keyframe 只解码关键帧, 依赖 PyAV, 未安装时退化为 seek
+# seek     按时间跳转, 采样点由粗到细排列, 超出时间预算时仍然覆盖整个视频
+SAMPLE_MODES = ("read", "grab", "keyframe", "seek")
+
+
+def new_sample_stats() -> dict:
+    """
+    :return: {"decoded": 经过解码器的帧数, "sampled": 返回给调用方的帧数, "seconds": 耗时}
+    """
+    return {"decoded": 0, "sampled": 0, "seconds": 0.0}
+
+
+def iter_video_frames(video_path, sample_fps=VIDEO_SAMPLE_FPS, mode=VIDEO_SAMPLE_MODE, time_budget=VIDEO_TIME_BUDGET,
+                      max_samples=VIDEO_MAX_SAMPLES, stats: dict = None) -> Iterator[Tuple[float, np.ndarray]]:
+    """
+    按 sample_fps 抽帧
+    :param mode: 抽帧方式, 见 SAMPLE_MODES
+    :param time_budget: 单个视频的抽帧时间预算(秒), 超出后停止, None 表示不限制
+    :param max_samples: 单个视频最多返回的帧数, None 表示不限制
+    :param stats: 传入 new_sample_stats() 的结果时记录解码帧数等统计
+    :return: (帧时间戳(秒), BGR 帧)
+    """
+    if mode not in SAMPLE_MODES:
+        raise ValueError(f"不支持的抽帧方式: {mode}, 可选: {SAMPLE_MODES}")
+    stats = new_sample_stats() if stats is None else stats
+    b = time.time()
+
+    if mode == "keyframe" and importlib.util.find_spec("av") is None:
+        mode = "seek"
+
+    if mode == "keyframe":
+        frames = _iter_keyframes(video_path, stats)
+    elif mode == "seek":
+        frames = _iter_seek(video_path, sample_fps, max_samples, stats)
+    else:
+        frames = _iter_sequential(video_path, sample_fps, mode == "grab", stats, max_samples)
+
+    try:
+        for frame_ts, frame in frames:
+            stats["sampled"] += 1
+            stats["seconds"] = time.time() - b
+            yield frame_ts, frame
+            if max_samples is not None and stats["sampled"] >= max_samples:
+                # seek 的采样点由粗到细, 提前停止时仍覆盖整个视频; 其他方式还有剩余的帧时说明只覆盖了前一部分
+                if mode != "seek" and next(frames, None) is not None:
+                    logger.warning(f"达到最多抽帧数 {max_samples}, video_path: {video_path}, 只覆盖到 {frame_ts:.1f}s")
+                break
+            if time_budget is not None and time.time() - b >= time_budget:
+                logger.warning(f"抽帧超出时间预算 {time_budget}s, video_path: {video_path}, 已抽取 {stats['sampled']} 帧")
+                break
+    finally:
+        frames.close()
+        stats["seconds"] = time.time() - b
+
+
+def iter_frame_batches(frames: Iterator, batch_size) -> Iterator[list]:
+    """
+    把抽出的帧按 batch_size 分组, 供批量检测使用
+    """
+    batch = []
+    for frame in frames:
+        batch.append(frame)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _open_video(video_path):
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        logger.warning(f"无法打开视频文件, video_path: {video_path}")
+        return None
+    return cap
+
+
+def _iter_sequential(video_path, sample_fps, use_grab, stats, max_samples=None):
+    cap = _open_video(video_path)
+    if cap is None:
+        return
+
+    # 帧率只读取一次
+    video_fps = cap.get(cv2.CAP_PROP_FPS) or 25
+    frame_interval = max(1, int(video_fps / sample_fps))
+    # 已知总帧数时加大间隔, 使 max_samples 帧均匀覆盖整个视频, 而不是只取前 max_samples / sample_fps 秒
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    if max_samples and total_frames > 0:
+        frame_interval = max(frame_interval, -(-total_frames // max_samples))
+    frame_count = 0
+    try:
+        while True:
+            sampled = frame_count % frame_interval == 0
+            if use_grab and not sampled:
+                ret, frame = cap.grab(), None
+            else:
+                ret, frame = cap.read()
+            if not ret:
+                break
+            stats["decoded"] += 1
+            if sampled:
+                yield frame_count / video_fps, frame
+            frame_count += 1
+    finally:
+        cap.release()
+
+
+def _seek_order(n):
+    """
+    采样点由粗到细的顺序: 0, n/2, n/4, 3n/4, ... 提前停止时已取到的帧仍均匀分布在整个视频中
+    """
+    order, seen, step = [], set(), 1
+    while step < n:
+        step *= 2
+    while step >= 1:
+        for i in range(0, n, step):
+            if i not in seen:
+                seen.add(i)
+                order.append(i)
+        step //= 2
+    return order
+
+
+def _iter_seek(video_path, sample_fps, max_samples, stats):
+    cap = _open_video(video_path)
+    if cap is None:
+        return
+
+    video_fps = cap.get(cv2.CAP_PROP_FPS) or 25
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    duration = total_frames / video_fps
+    n = max(1, int(duration * sample_fps))
+    if max_samples is not None:
+        n = min(n, max_samples)
+    try:
+        for i in _seek_order(n):
+            frame_ts = duration * i / n
+            cap.set(cv2.CAP_PROP_POS_MSEC, frame_ts * 1000)
+            ret, frame = cap.read()
+            if not ret:
+                continue
+            # 跳转会从最近的关键帧解码到目标帧, 这里只能统计到目标帧本身
+            stats["decoded"] += 1
+            yield frame_ts, frame
+    finally:
+        cap.release()
+
+
+def _iter_keyframes(video_path, stats):
+    import av
+
+    container = av.open(video_path)
+    try:
+        stream = container.streams.video[0]
+        # 解码器直接丢弃非关键帧
+        stream.codec_context.skip_frame = "NONKEY"
+        for frame in container.decode(stream):
+            stats["decoded"] += 1
+            yield float(frame.time or 0), frame.to_ndarray(format="bgr24")
+    finally:
+        container.close()
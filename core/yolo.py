@@ -1,15 +1,27 @@
-from typing import List
+import threading
+from typing import List, TYPE_CHECKING
 
-from ultralytics import YOLO
-from ultralytics.engine.results import Results
+from core.metrics import metrics
+from core.models import get_yolo_model
+from settings import YOLO_CONF, YOLO_BATCH_SIZE, YOLO_IMGSZ
 
-from settings import YOLO_MODEL_PATH
+if TYPE_CHECKING:
+    # ultralytics 会导入 torch, 只在第一次加载模型时导入
+    from ultralytics.engine.results import Results
 
-model = YOLO(YOLO_MODEL_PATH, verbose=True)  # 加载预训练模型
+# ultralytics 的 predictor 不是线程安全的, 入库流水线的多个解码线程共用一个模型时需要加锁
+_predict_lock = threading.Lock()
+
+
+def __getattr__(name):
+    # 兼容旧代码的 from core.yolo import model, 访问时才加载模型
+    if name == "model":
+        return get_yolo_model()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def detect_faces_bbox(image: str):
-    results = model(image)
+    results = get_yolo_model()(image)
     faces = []
     for box in results[0].boxes:
         x1, y1, x2, y2 = map(int, box.xyxy[0].tolist())
@@ -17,7 +29,7 @@ def detect_faces_bbox(image: str):
     return faces
 
 
-def detect_faces_results(image) -> List[Results]:
+def detect_faces_results(image) -> List['Results']:
     """
     :param image:
     :return: [
@@ -34,4 +46,34 @@ def detect_faces_results(image) -> List[Results]:
       }
     ]
     """
-    return model.predict(image)
+    model = get_yolo_model()
+    with _predict_lock:
+        return model.predict(image)
+
+
+def detect_faces_batch(images: List, batch_size=YOLO_BATCH_SIZE, imgsz=YOLO_IMGSZ, conf=YOLO_CONF) -> List[tuple]:
+    """
+    批量检测, 每 batch_size 张图片调用一次模型, 不输出逐帧日志
+    :param images: BGR 图片列表, 尺寸可以不同, 模型内部按 imgsz 做 letterbox
+    :return: 每张图片的 (boxes (n, 4) xyxy, scores (n,), kpss (n, 5, 2)), 坐标为原图坐标,
+             模型没有关键点输出时 kpss 为 None
+    """
+    model, detections = get_yolo_model(), []
+    for i in range(0, len(images), batch_size):
+        batch = images[i:i + batch_size]
+        # 计时包含等待模型锁的时间
+        with metrics.timer("yolo_detect", items=len(batch)), _predict_lock:
+            results = model.predict(batch, imgsz=imgsz, conf=conf, verbose=False)
+        for result in results:
+            boxes = result.boxes.xyxy.cpu().numpy()
+            scores = result.boxes.conf.cpu().numpy()
+            kpss = None if result.keypoints is None else result.keypoints.xy.cpu().numpy()
+            detections.append((boxes, scores, kpss))
+    return detections
+
+
+def detect_faces_arrays(image, conf=YOLO_CONF):
+    """
+    单张图片的 detect_faces_batch
+    """
+    return detect_faces_batch([image], conf=conf)[0]
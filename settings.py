@@ -11,4 +11,137 @@ WRITE_BATCH_SIZE = 100
 
 YOLO_MODEL_PATH = r"D:\models\arnabdhar\YOLOv8-Face-Detection\model.pt"
 INDEX_PATH = "../backup/20250426/faiss_index.index"
-DATAMETA_PATH = "../backup/20250426/datameta.json"
\ No newline at end of file
+# 旧版本的元数据文件, 只在首次打开 META_DB_PATH 时用于迁移
+DATAMETA_PATH = "../backup/20250426/datameta.json"
+META_DB_PATH = "../backup/20250426/datameta.db"
+
+# 内存中的索引和元数据自动落盘的间隔(秒), None 表示只在显式 flush 时落盘
+FLUSH_INTERVAL = 30
+
+# 追加写的段文件目录, 段文件数量达到 COMPACT_SEGMENT_COUNT 后在后台合并进主索引
+SEGMENT_DIR = "../backup/20250426/segments"
+COMPACT_SEGMENT_COUNT = 20
+# 已删除的人脸数达到存活人脸数的该比例后, 合并时重新编号并重建索引和元数据
+REBUILD_DELETED_RATIO = 0.2
+
+# 索引类型: flat / flat_fp16 / flat_sq8 / ivf_flat / ivf_pq / hnsw, 需要训练的类型在向量数足够后自动迁移
+# flat_fp16 每维 2 字节, flat_sq8 每维 1 字节, 都是暴力检索
+INDEX_TYPE = "flat_fp16"
+IVF_NLIST = 1024
+PQ_M = 64
+HNSW_M = 32
+# 召回率与延迟的调节参数, 分别作用于 ivf 和 hnsw
+NPROBE = 16
+EF_SEARCH = 64
+TRAIN_SAMPLE_SIZE = 100000
+# 入库和检索前把向量归一化, 分数为余弦相似度, 取值 [-1, 1]; 打开未归一化的旧索引时自动迁移
+EMBEDDING_NORMALIZE = True
+# 检索结果的默认最低分数(余弦相似度)
+MIN_SCORE = 0.4
+# 检索方式: range 返回分数不低于 MinScore 的全部人脸, knn 每个查询人脸只取 Top-K 个近邻
+SEARCH_MODE = "range"
+# 同一文件多个命中人脸的分数合并方式 max / mean, Top-K 按文件计算
+SEARCH_AGG = "max"
+# 索引不支持 range_search 时改用的近邻数
+RANGE_FALLBACK_K = 1000
+
+# 入库流水线: 读取解码线程数、推理线程数、每批推理的图片数、阶段之间的队列长度
+INGEST_DECODE_WORKERS = 4
+INGEST_INFER_WORKERS = 1
+INGEST_BATCH_SIZE = 16
+INGEST_QUEUE_SIZE = 64
+
+# 人脸检测器: buffalo 使用 buffalo_l 自带的 SCRFD, yolo 复用 YOLO 的检测框, 只运行识别模型
+VIDEO_DETECTOR = "yolo"
+IMAGE_DETECTOR = "buffalo"
+YOLO_CONF = 0.5
+# YOLO 每次推理的图片数和输入尺寸
+YOLO_BATCH_SIZE = 16
+YOLO_IMGSZ = 640
+
+# 视频入库模式: tracks 多帧跟踪视频中的所有人脸, best_frame 只取人脸置信度最高的一帧
+VIDEO_INGEST_MODE = "tracks"
+VIDEO_SAMPLE_FPS = 2
+# 抽帧方式 read / grab / keyframe / seek, 单个视频的抽帧时间预算(秒)和最多抽取的帧数
+VIDEO_SAMPLE_MODE = "grab"
+VIDEO_TIME_BUDGET = 30
+VIDEO_MAX_SAMPLES = 600
+# 跟踪参数: 关联的最小 IoU, 轨迹允许中断的秒数, 每条轨迹参与识别的候选帧数
+TRACK_IOU_THRESH = 0.3
+TRACK_MAX_GAP = 2.0
+TRACK_MAX_CANDIDATES = 5
+# 候选只保存人脸框四周各外扩 TRACK_CROP_MARGIN 倍框宽高的裁剪区域, 不保留整帧画面
+TRACK_CROP_MARGIN = 0.5
+# 平均特征相似度超过 TRACK_MERGE_SIM 的轨迹视为同一个人, 每人最多保留 TRACK_MAX_EMBEDDINGS 个向量,
+# 与已保留向量相似度超过 TRACK_DUPLICATE_SIM 的跳过
+TRACK_MERGE_SIM = 0.6
+TRACK_MAX_EMBEDDINGS = 3
+TRACK_DUPLICATE_SIM = 0.9
+
+# 模型: buffalo_l 所在目录, onnxruntime 推理后端(None 时自动选择, 有 CUDA 用 CUDA, 否则 CPU)
+BUFFALO_MODEL_PATH = r"D:\models\insightface\buffalo_l"
+ONNX_PROVIDERS = None
+# 界面启动后在后台预热的组件, 为空时全部在第一次使用时加载
+WARMUP_MODELS = ["face_store", "buffalo", "yolo"]
+
+# buffalo_l 推理配置
+# allowed_modules: 加载的模块, None 表示全部加载; 入库和检索只用到 detection 和 recognition,
+#                  YOLO 检测器没有关键点时会自动加上 landmark_3d_68
+# det_size: SCRFD 输入尺寸
+# intra_op_threads / inter_op_threads: onnxruntime 线程数, 0 表示由 onnxruntime 决定
+# graph_optimization: 图优化级别 disable / basic / extended / all
+# int8: 识别模型使用动态量化的 INT8 模型
+INFERENCE_PROFILES = {
+    "default": {"allowed_modules": None, "det_size": (640, 640), "intra_op_threads": 0, "inter_op_threads": 0,
+                "graph_optimization": "all", "int8": False},
+    "lean": {"allowed_modules": ["detection", "recognition"], "det_size": (640, 640), "intra_op_threads": 0,
+             "inter_op_threads": 1, "graph_optimization": "all", "int8": False},
+    "lean_320": {"allowed_modules": ["detection", "recognition"], "det_size": (320, 320), "intra_op_threads": 0,
+                 "inter_op_threads": 1, "graph_optimization": "all", "int8": False},
+    "lean_int8": {"allowed_modules": ["detection", "recognition"], "det_size": (640, 640), "intra_op_threads": 0,
+                  "inter_op_threads": 1, "graph_optimization": "all", "int8": True},
+}
+INFERENCE_PROFILE = "lean"
+
+# 缩略图缓存: 目录、最大占用字节数(超出后删除最久未使用的)、边长, 入库时是否同时生成
+THUMBNAIL_DIR = "../backup/20250426/thumbnails"
+THUMBNAIL_CACHE_BYTES = 1024 * 1024 * 512
+THUMBNAIL_SIZE = 200
+THUMBNAIL_ON_INGEST = True
+
+# 检索文件的向量缓存: 内存中保留的文件数, 持久化的数据库路径(None 表示只缓存在内存中)
+QUERY_CACHE_SIZE = 256
+QUERY_CACHE_PATH = "../backup/20250426/query_cache.db"
+
+# 分片: 主索引中的向量达到 SHARD_SEAL_SIZE 后按文件所在的根文件夹(路径的前 SHARD_DEPTH 层)写入只读分片,
+# 分片以内存映射方式打开, 检索时并行查询并合并结果, 指定检索范围时只打开范围内的分片
+SHARD_DIR = "../backup/20250426/shards"
+SHARD_DEPTH = 2
+SHARD_SEAL_SIZE = 100000
+SHARD_SEARCH_WORKERS = 4
+
+# 分布式入库: 共享存储上的任务队列目录(SQLite 队列和各节点的结果文件), 每个任务的文件数,
+# 任务租约秒数(节点失联超过租约后任务重新分配), 每个任务最多尝试的次数
+INGEST_QUEUE_DIR = "../backup/20250426/ingest_queue"
+INGEST_JOB_SIZE = 200
+INGEST_LEASE_SECONDS = 600
+INGEST_MAX_ATTEMPTS = 3
+
+# 检索服务: 监听地址和端口, 同时到达的请求合并为一批, 每批最多的请求数和凑批等待的毫秒数
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8765
+SERVER_MAX_BATCH = 32
+SERVER_MAX_WAIT_MS = 5
+
+# 日志级别 DEBUG / INFO / WARNING, DEBUG 时输出逐个文件的信息
+LOG_LEVEL = "INFO"
+LOG_FORMAT = "%(asctime)s %(levelname)s %(threadName)s %(name)s: %(message)s"
+
+# 入库前去重: 内容哈希相同或感知哈希相近的文件不再识别, 直接关联到已入库文件的人脸
+# DEDUP_MAX_DISTANCE: 感知哈希每 64 bit 允许的最大汉明距离, 越大越容易把相似但不同的画面当作重复
+DEDUP_ENABLED = True
+DEDUP_MAX_DISTANCE = 4
+# 感知哈希相近的文件再解码比较像素, 缩放到 DEDUP_VERIFY_SIZE 见方后分块, 每一块的平均灰度差都不超过 DEDUP_VERIFY_MAX_DIFF
+# 才算重复; 重新压缩或缩放的副本差异很小, 连拍中人物动作不同的照片在对应的块上差异明显
+DEDUP_VERIFY_SIZE = 128
+DEDUP_VERIFY_MAX_DIFF = 8
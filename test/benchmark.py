@@ -0,0 +1,436 @@
+# 可复现的性能基准: 入库吞吐量、每个视频解码的帧数、各索引类型的检索延迟和内存占用, 与基线文件对比
+# 用法: python -m test.benchmark [--scales 10000 100000 1000000] [--save-baseline]
+# 只使用 CPU; 模型换成 SyntheticBuffalo / SyntheticYolo, 入库测到的是解码、对齐、流水线和写入的开销, 不含真实模型推理
+# 入库路径不导入 insightface / ultralytics / onnxruntime, 没有安装它们的环境也能运行; 基线按 requirements.txt 中固定的 faiss 版本录制
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import cv2
+import faiss
+import numpy as np
+
+from core.database import INDEX_TYPES, EMBEDDING_DIM, create_index, train_index, set_search_params, \
+    get_min_train_size, get_index_bytes, get_index_type
+from core.shards import get_mmap_flag
+from core.utils import setup_logging
+from core.video import iter_video_frames, new_sample_stats, SAMPLE_MODES
+from settings import MIN_SCORE, VIDEO_SAMPLE_FPS
+from test.video_sampler import make_synthetic_video
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "benchmark_baseline.json")
+SEED = 20250426
+# 每次生成和写入索引的向量数, 1M 规模时不需要一次性生成全部向量
+CHUNK_SIZE = 100000
+# 每个人平均的人脸数, 同一个人的向量围绕同一个中心分布, 相互之间的余弦相似度约为 0.6
+FACES_PER_PERSON = 20
+PERSON_NOISE = 0.036
+
+
+def get_rss_mb() -> float | None:
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().rss / 1024 ** 2
+
+
+def percentiles(values_ms) -> dict:
+    return {"p50_ms": float(np.percentile(values_ms, 50)), "p99_ms": float(np.percentile(values_ms, 99))}
+
+
+# ---------------------------------------------------------------- 合成数据
+
+def iter_library_chunks(scale, seed=SEED, chunk_size=CHUNK_SIZE):
+    """
+    按块生成归一化的人脸向量库, 相同的 scale 和 seed 每次生成的数据相同
+    :return: (ids, vectors)
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(1, scale // FACES_PER_PERSON), EMBEDDING_DIM)).astype(np.float32)
+    centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+    for start in range(0, scale, chunk_size):
+        n = min(chunk_size, scale - start)
+        vectors = centers[rng.integers(0, len(centers), n)] + rng.standard_normal((n, EMBEDDING_DIM)).astype(
+            np.float32) * PERSON_NOISE
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        yield np.arange(start + 1, start + n + 1, dtype=np.int64), vectors
+
+
+def make_queries(scale, n_queries, seed=SEED):
+    """
+    从库中的人随机生成新的人脸作为查询, 与库中同一个人的向量相似
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(1, scale // FACES_PER_PERSON), EMBEDDING_DIM)).astype(np.float32)
+    centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+    rng = np.random.default_rng(seed + 1)
+    queries = centers[rng.integers(0, len(centers), n_queries)] + rng.standard_normal(
+        (n_queries, EMBEDDING_DIM)).astype(np.float32) * PERSON_NOISE
+    return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+
+def make_synthetic_images(image_dir, count, size=(1280, 720), seed=SEED):
+    """
+    随机背景上画一张简化的人脸, 保存为 jpg
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(image_dir, exist_ok=True)
+    paths = []
+    for i in range(count):
+        image = rng.integers(0, 255, (size[1], size[0], 3), dtype=np.uint8)
+        image = cv2.GaussianBlur(image, (31, 31), 0)
+        center = (size[0] // 2 + int(rng.integers(-100, 100)), size[1] // 2)
+        cv2.ellipse(image, center, (150, 200), 0, 0, 360, (150, 180, 220), -1)
+        for dx in (-60, 60):
+            cv2.circle(image, (center[0] + dx, center[1] - 50), 18, (40, 40, 40), -1)
+        cv2.ellipse(image, (center[0], center[1] + 90), (60, 20), 0, 0, 180, (60, 60, 160), 6)
+        path = os.path.join(image_dir, f"image_{i:05d}.jpg")
+        cv2.imwrite(path, image)
+        paths.append(path)
+    return paths
+
+
+# ---------------------------------------------------------------- 替代模型
+
+class _SyntheticDetector:
+    """
+    按 SCRFD 的接口返回画面中间的一张人脸, 缩放到检测尺寸模拟预处理的开销
+    """
+    # 5 点关键点在人脸框内的相对位置: 左眼、右眼、鼻尖、左嘴角、右嘴角
+    KPS = np.array([[0.35, 0.4], [0.65, 0.4], [0.5, 0.55], [0.38, 0.72], [0.62, 0.72]], dtype=np.float32)
+
+    def detect(self, image, max_num=0, metric='default'):
+        cv2.resize(image, (640, 640))
+        h, w = image.shape[:2]
+        box = np.array([w * 0.3, h * 0.2, w * 0.7, h * 0.8], dtype=np.float32)
+        kps = box[:2] + self.KPS * (box[2:] - box[:2])
+        return np.hstack([box, [0.9]]).astype(np.float32)[None], kps[None]
+
+
+class _SyntheticLandmarks:
+    def get(self, image, face):
+        box = np.asarray(face.bbox, dtype=np.float32)
+        landmarks = np.zeros((68, 3), dtype=np.float32)
+        kps = box[:2] + _SyntheticDetector.KPS * (box[2:] - box[:2])
+        landmarks[36:42, :2], landmarks[42:48, :2], landmarks[30, :2] = kps[0], kps[1], kps[2]
+        landmarks[48, :2], landmarks[54, :2] = kps[3], kps[4]
+        face.landmark_3d_68 = landmarks
+
+
+class _SyntheticRecognizer:
+    """
+    对齐后的人脸缩小到 16x16 再随机投影到 512 维, 相同的画面得到相同的向量
+    """
+    input_size = (112, 112)
+
+    def __init__(self, seed=SEED):
+        self.projection = np.random.default_rng(seed).standard_normal((16 * 16 * 3, EMBEDDING_DIM)).astype(np.float32)
+
+    def get_feat(self, crops):
+        pixels = np.stack([cv2.resize(crop, (16, 16)) for crop in crops]).reshape(len(crops), -1)
+        return (pixels.astype(np.float32) / 255) @ self.projection
+
+
+class SyntheticBuffalo:
+    def __init__(self):
+        self.det_model = _SyntheticDetector()
+        self.models = {"detection": self.det_model, "recognition": _SyntheticRecognizer(),
+                       "landmark_3d_68": _SyntheticLandmarks()}
+
+
+class _Tensor:
+    def __init__(self, array):
+        self.array = array
+
+    def cpu(self):
+        return self
+
+    def numpy(self):
+        return self.array
+
+
+class _Boxes:
+    def __init__(self, boxes, scores):
+        self.xyxy, self.conf = _Tensor(boxes), _Tensor(scores)
+
+
+class _Result:
+    def __init__(self, boxes, scores):
+        self.boxes, self.keypoints = _Boxes(boxes, scores), None
+
+
+class SyntheticYolo:
+    """
+    按 ultralytics 的 predict 接口返回结果, 没有关键点输出, 与人脸检测模型 YOLOv8-Face 一致
+    """
+
+    def __init__(self):
+        self.detector = _SyntheticDetector()
+
+    def predict(self, images, imgsz=640, conf=0.5, verbose=False):
+        results = []
+        for image in images:
+            bboxes, _ = self.detector.detect(image)
+            results.append(_Result(bboxes[:, :4], bboxes[:, 4]))
+        return results
+
+
+def install_synthetic_models():
+    from core.models import registry
+
+    registry.register("buffalo", SyntheticBuffalo)
+    registry.register("yolo", SyntheticYolo)
+
+
+# ---------------------------------------------------------------- 检索
+
+def build_index(index_type, scale):
+    """
+    训练后按块写入, 不保留全部向量
+    """
+    index = create_index(index_type, dim=EMBEDDING_DIM)
+    for i, (ids, vectors) in enumerate(iter_library_chunks(scale)):
+        if i == 0:
+            train_index(index, vectors)
+        index.add_with_ids(vectors, ids)
+    set_search_params(index)
+    return index
+
+
+def bench_search(scale, index_types, n_queries=200, k=100, recall_k=10, work_dir=None) -> dict:
+    """
+    :return: {index_type: 指标}, 召回率以同一批查询在 flat 上的结果为准
+    """
+    queries = make_queries(scale, n_queries)
+    results, ground_truth = {}, None
+    for index_type in ("flat",) + tuple(t for t in index_types if t != "flat"):
+        if scale < get_min_train_size(index_type):
+            print(f"{index_type}@{scale}: 向量数不足以训练, 跳过")
+            continue
+        gc.collect()
+        rss_before = get_rss_mb()
+        b = time.time()
+        index = build_index(index_type, scale)
+        metrics = {"build_s": time.time() - b, "index_mb": get_index_bytes(index) / 1024 ** 2}
+        if rss_before is not None:
+            metrics["rss_mb"] = get_rss_mb() - rss_before
+
+        latencies = []
+        for query in queries:
+            b = time.perf_counter()
+            index.search(query[None], k)
+            latencies.append((time.perf_counter() - b) * 1000)
+        metrics.update({f"knn_{key}": value for key, value in percentiles(latencies).items()})
+        b = time.perf_counter()
+        _, ids = index.search(queries, recall_k)
+        metrics["batch_qps"] = len(queries) / (time.perf_counter() - b)
+        if ground_truth is None:
+            ground_truth = ids
+        metrics["recall"] = float(np.mean([len(set(a[a >= 0]) & set(g[g >= 0])) / max(1, (g >= 0).sum())
+                                           for a, g in zip(ids, ground_truth)]))
+
+        try:
+            latencies, hits = [], 0
+            for query in queries:
+                b = time.perf_counter()
+                lims, _, _ = index.range_search(query[None], MIN_SCORE)
+                latencies.append((time.perf_counter() - b) * 1000)
+                hits += int(lims[-1])
+            metrics.update({f"range_{key}": value for key, value in percentiles(latencies).items()})
+            metrics["range_hits"] = hits / len(queries)
+        except RuntimeError:
+            pass
+
+        if work_dir is not None:
+            metrics.update(bench_mmap(index, index_type, queries, k, work_dir))
+
+        results[index_type] = metrics
+        print(f"{index_type}@{scale}: " + ", ".join(f"{key}={value:.3f}" for key, value in metrics.items()))
+        del index
+    return results
+
+
+def bench_mmap(index, index_type, queries, k, work_dir) -> dict:
+    """
+    以分片的方式内存映射打开: 打开耗时、打开后和第一次检索后的常驻内存增量
+    """
+    index_file = os.path.join(work_dir, f"{index_type}.index")
+    faiss.write_index(index, index_file)
+    gc.collect()
+    rss_before = get_rss_mb()
+    b = time.perf_counter()
+    mapped = faiss.read_index(index_file, get_mmap_flag(get_index_type(index)))
+    metrics = {"mmap_open_ms": (time.perf_counter() - b) * 1000}
+    if rss_before is not None:
+        metrics["mmap_open_rss_mb"] = get_rss_mb() - rss_before
+    b = time.perf_counter()
+    mapped.search(queries[:1], k)
+    metrics["mmap_first_query_ms"] = (time.perf_counter() - b) * 1000
+    del mapped
+    os.remove(index_file)
+    return metrics
+
+
+# ---------------------------------------------------------------- 入库和抽帧
+
+def bench_video_sampling(video_paths, sample_fps=VIDEO_SAMPLE_FPS) -> dict:
+    results = {}
+    for mode in SAMPLE_MODES:
+        total = new_sample_stats()
+        for video_path in video_paths:
+            stats = new_sample_stats()
+            for _ in iter_video_frames(video_path, sample_fps=sample_fps, mode=mode, time_budget=None,
+                                       max_samples=None, stats=stats):
+                pass
+            for key in total:
+                total[key] += stats[key]
+        n = len(video_paths)
+        results[mode] = {"decoded_per_video": total["decoded"] / n, "sampled_per_video": total["sampled"] / n,
+                         "seconds_per_video_s": total["seconds"] / n}
+        print(f"video {mode}: " + ", ".join(f"{key}={value:.3f}" for key, value in results[mode].items()))
+    return results
+
+
+def bench_ingest(image_paths, video_paths, work_dir) -> dict:
+    """
+    用替代模型跑完整的 gen_embedding, 索引、元数据和缩略图都写入临时目录
+    """
+    import core.database
+    import core.thumbnails
+    from core.database import FaceStore
+    from core.embedding import gen_embedding
+    from core.metrics import metrics
+    from core.thumbnails import ThumbnailCache
+
+    install_synthetic_models()
+    results = {}
+    for name, paths in (("images", image_paths), ("videos", video_paths)):
+        store_dir = os.path.join(work_dir, f"store_{name}")
+        core.database._face_store = FaceStore(
+            index_path=os.path.join(store_dir, "index.faiss"), meta_db_path=os.path.join(store_dir, "meta.db"),
+            segment_dir=os.path.join(store_dir, "segments"), shard_dir=os.path.join(store_dir, "shards"),
+            datameta_path=None)
+        core.thumbnails._thumbnail_cache = ThumbnailCache(os.path.join(store_dir, "thumbnails"))
+
+        metrics.reset()
+        b = time.time()
+        for _ in gen_embedding(paths):
+            pass
+        seconds = time.time() - b
+        store = core.database._face_store
+        results[name] = {"files_per_s": len(paths) / seconds, "faces_per_file": store.meta.face_count() / len(paths),
+                         "seconds_s": seconds}
+        store.close()
+        print(f"ingest {name}: " + ", ".join(f"{key}={value:.3f}" for key, value in results[name].items()))
+        # 各阶段的平均耗时, 吞吐量退化时用来定位是哪个阶段变慢
+        results[name]["stages"] = {f"{stage}_mean_ms": stats["mean_ms"]
+                                   for stage, stats in metrics.snapshot()["stages"].items()}
+    core.database._face_store = None
+    return results
+
+
+# ---------------------------------------------------------------- 基线
+
+def flatten(results, prefix="") -> dict:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}/"))
+        elif isinstance(value, (int, float)):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def is_higher_better(metric) -> bool | None:
+    name = metric.rsplit("/", 1)[-1]
+    if name.endswith(("_per_s", "_qps", "recall")):
+        return True
+    if name.endswith(("_ms", "_s", "_mb")):
+        return False
+    return None
+
+
+def compare(results, baseline, tolerance) -> list:
+    """
+    :return: 比基线差 tolerance 以上的指标 [(名称, 基线, 当前), ...]
+    """
+    regressions, current = [], flatten(results)
+    for metric, base in flatten(baseline).items():
+        higher = is_higher_better(metric)
+        value = current.get(metric)
+        if higher is None or value is None or base == 0:
+            continue
+        change = (value - base) / abs(base)
+        if (higher and change < -tolerance) or (not higher and change > tolerance):
+            regressions.append((metric, base, value))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="入库吞吐量与检索延迟基准")
+    parser.add_argument("--scales", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--index-types", nargs="+", default=list(INDEX_TYPES), choices=INDEX_TYPES)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--images", type=int, default=100)
+    parser.add_argument("--videos", type=int, default=4)
+    parser.add_argument("--skip-ingest", action="store_true")
+    parser.add_argument("--output", default=None, help="结果写入的 json 文件")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="用本次结果覆盖基线")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="相对基线允许的变化比例")
+    args = parser.parse_args()
+    # 入库时逐文件的日志会干扰结果输出
+    setup_logging("WARNING")
+
+    # 只测 CPU
+    os.environ["CUDA_VISIBLE_DEVICES"] = ""
+    faiss.omp_set_num_threads(os.cpu_count() or 1)
+    work_dir = tempfile.mkdtemp(prefix="faceyolo_benchmark_")
+    results = {"meta": {"python": platform.python_version(), "platform": platform.platform(),
+                        "faiss": faiss.__version__, "cpu_count": os.cpu_count(), "seed": SEED},
+               "search": {}}
+
+    for scale in args.scales:
+        results["search"][str(scale)] = bench_search(scale, args.index_types, n_queries=args.queries,
+                                                     work_dir=work_dir)
+
+    video_paths = [make_synthetic_video(os.path.join(work_dir, f"video_{i}.mp4"), seconds=20)
+                   for i in range(args.videos)]
+    results["video"] = bench_video_sampling(video_paths)
+
+    if not args.skip_ingest:
+        image_paths = make_synthetic_images(os.path.join(work_dir, "images"), args.images)
+        results["ingest"] = bench_ingest(image_paths, video_paths, work_dir)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2, ensure_ascii=False)
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2, ensure_ascii=False)
+        print(f"已保存基线: {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"基线文件不存在: {args.baseline}, 使用 --save-baseline 生成")
+        return 0
+    with open(args.baseline, "r", encoding="utf-8") as file:
+        baseline = json.load(file)
+    base_faiss = baseline.get("meta", {}).get("faiss")
+    if base_faiss != faiss.__version__:
+        print(f"基线使用的 faiss 版本为 {base_faiss}, 当前为 {faiss.__version__}, 检索指标不可直接对比")
+    regressions = compare(results, baseline, args.tolerance)
+    for metric, base, value in regressions:
+        print(f"性能退化: {metric}, 基线: {base:.3f}, 当前: {value:.3f}")
+    print(f"与基线对比完成, 退化的指标数: {len(regressions)}")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,59 @@
+# 对比各推理配置的加载耗时、吞吐量, 以及与 default 配置相比的 embedding 偏差
+# 用法: python -m test.inference_profile [图片或文件夹 ...], 不传路径时使用 insightface 自带的示例图片
+import copy
+import sys
+import time
+
+import numpy as np
+from insightface.data import get_image
+
+from core.embedding import read_image
+from core.face_analysis import detect_faces, get_faces_batch, recognize_faces
+from core.models import load_buffalo
+from core.utils import get_files_from_list
+from settings import INFERENCE_PROFILES, ALLOWED_IMG_TYPES
+
+
+def normalize(embeddings):
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+
+def benchmark(images, profiles=tuple(INFERENCE_PROFILES), repeat=3, batch_size=16):
+    # 以 default 配置的检测结果为准, 各配置用相同的关键点对齐后比较 embedding
+    reference = load_buffalo("default")
+    faces_list = [detect_faces(image, reference) for image in images]
+    recognize_faces(images, faces_list, reference)
+    reference_embs = normalize([face.embedding for faces in faces_list for face in faces])
+    print(f"图片数: {len(images)}, 人脸数: {len(reference_embs)}")
+
+    print(f"{'profile':<12}{'load s':>10}{'images/s':>12}{'faces/s':>12}{'drift mean':>12}{'drift max':>12}")
+    for name in profiles:
+        b = time.time()
+        model = load_buffalo(name)
+        load_seconds = time.time() - b
+
+        face_count = 0
+        b = time.time()
+        for _ in range(repeat):
+            for i in range(0, len(images), batch_size):
+                face_count += sum(len(faces) for faces in get_faces_batch(images[i:i + batch_size], model=model))
+        seconds = time.time() - b
+
+        drift_mean = drift_max = float("nan")
+        if len(reference_embs):
+            profile_faces = copy.deepcopy(faces_list)
+            recognize_faces(images, profile_faces, model)
+            embs = normalize([face.embedding for faces in profile_faces for face in faces])
+            drift = 1 - np.sum(embs * reference_embs, axis=1)
+            drift_mean, drift_max = float(drift.mean()), float(drift.max())
+
+        print(f"{name:<12}{load_seconds:>10.2f}{len(images) * repeat / seconds:>12.1f}{face_count / seconds:>12.1f}"
+              f"{drift_mean:>12.5f}{drift_max:>12.5f}")
+
+
+if __name__ == '__main__':
+    paths = get_files_from_list(sys.argv[1:], [])
+    paths = [path for path in paths if path.lower().endswith(ALLOWED_IMG_TYPES)]
+    images = [read_image(path) for path in paths] if paths else [get_image("t1")]
+    benchmark([image for image in images if image is not None])
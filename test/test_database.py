@@ -0,0 +1,211 @@
+# FaceStore 的落盘与恢复: 旧版 JSON 元数据迁移、段文件回放、删除后重建
+import json
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+from core.database import FaceStore, build_index, save_faiss_index, normalize_embeddings, EMBEDDING_DIM
+
+
+def random_embeddings(n, seed=0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    return normalize_embeddings(rng.standard_normal((n, EMBEDDING_DIM)).astype(np.float32))
+
+
+@pytest.fixture
+def store_kwargs(tmp_path):
+    return {
+        "index_path": str(tmp_path / "index.faiss"),
+        "meta_db_path": str(tmp_path / "meta.db"),
+        "segment_dir": str(tmp_path / "segments"),
+        "shard_dir": str(tmp_path / "shards"),
+        "datameta_path": str(tmp_path / "datameta.json"),
+        "flush_interval": None,
+        "index_type": "flat",
+    }
+
+
+def open_store(store_kwargs, **kwargs) -> FaceStore:
+    return FaceStore(**{**store_kwargs, **kwargs})
+
+
+def top_path(store: FaceStore, emb: np.ndarray):
+    hits = store.search([emb], k=1)
+    return hits[0][1] if hits else None
+
+
+def test_migrate_from_json_once(store_kwargs):
+    embs = random_embeddings(3)
+    save_faiss_index(build_index(np.arange(1, 4, dtype=np.int64), embs, "flat"), store_kwargs["index_path"])
+    with open(store_kwargs["datameta_path"], "w") as file:
+        json.dump({"1": "/photos/a/1.jpg", "2": "/photos/a/2.jpg", "3": "/photos/b/3.jpg"}, file)
+
+    store = open_store(store_kwargs)
+    assert store.meta.face_count() == 3
+    assert top_path(store, embs[2]) == "/photos/b/3.jpg"
+    # 全部删除后重新打开, 旧的 JSON 不会再次导入
+    store.remove_paths(store.meta.all_paths())
+    store.close()
+    store = open_store(store_kwargs)
+    assert store.meta.face_count() == 0
+    assert store.search([embs[0]], k=1) == []
+    store.close()
+
+
+def test_json_not_migrated_without_vectors(store_kwargs):
+    with open(store_kwargs["datameta_path"], "w") as file:
+        json.dump({"1": "/photos/a/1.jpg"}, file)
+
+    store = open_store(store_kwargs)
+    assert store.meta.face_count() == 0
+    assert store.meta.get_state("json_migrated") == "1"
+    store.close()
+
+
+def test_replay_segments_after_crash(store_kwargs):
+    embs = random_embeddings(4)
+    store = open_store(store_kwargs)
+    store.add({"/photos/a/1.jpg": [embs[0], embs[1]], "/photos/a/2.jpg": [embs[2]]})
+    store.flush()
+    # 不合并直接丢弃会话, 相当于进程在写入主索引前退出
+    store.meta.close()
+    assert len(os.listdir(store_kwargs["segment_dir"])) == 1
+    assert not os.path.exists(store_kwargs["index_path"])
+
+    store = open_store(store_kwargs)
+    assert store.index.ntotal == 3
+    assert top_path(store, embs[2]) == "/photos/a/2.jpg"
+    # 回放后新增的 id 接在段文件之后
+    store.add({"/photos/a/3.jpg": [embs[3]]})
+    assert store.max_id == 4
+    assert top_path(store, embs[3]) == "/photos/a/3.jpg"
+    store.close()
+
+
+def test_replay_restores_uncommitted_metadata(store_kwargs):
+    embs = random_embeddings(2)
+    store = open_store(store_kwargs)
+    store.add({"/photos/a/1.jpg": [embs[0]], "/photos/a/2.jpg": [embs[1]]})
+    store.flush()
+    # 段文件写入后、元数据提交前崩溃: 数据库中没有这些人脸
+    store.meta.conn.execute("DELETE FROM faces")
+    store.meta.conn.execute("DELETE FROM files")
+    store.meta.close()
+
+    store = open_store(store_kwargs)
+    assert store.meta.face_count() == 2
+    assert top_path(store, embs[1]) == "/photos/a/2.jpg"
+    store.close()
+
+
+def test_replay_skips_vectors_already_compacted(store_kwargs, tmp_path):
+    embs = random_embeddings(2)
+    store = open_store(store_kwargs)
+    store.add({"/photos/a/1.jpg": [embs[0]], "/photos/a/2.jpg": [embs[1]]})
+    store.flush()
+    segment_file = os.path.join(store_kwargs["segment_dir"], os.listdir(store_kwargs["segment_dir"])[0])
+    shutil.copy(segment_file, tmp_path / "segment.npz")
+    store.compact()
+    store.close()
+    # 替换主索引之后、删除段文件之前崩溃
+    shutil.copy(tmp_path / "segment.npz", segment_file)
+
+    store = open_store(store_kwargs)
+    assert store.index.ntotal == 2
+    assert store.meta.face_count() == 2
+    store.close()
+
+
+def test_replay_skips_deleted_faces(store_kwargs):
+    embs = random_embeddings(2)
+    store = open_store(store_kwargs)
+    store.add({"/photos/a/1.jpg": [embs[0]], "/photos/a/2.jpg": [embs[1]]})
+    store.flush()
+    store.remove_paths(["/photos/a/1.jpg"])
+    store.close()
+
+    store = open_store(store_kwargs)
+    assert store.exist_paths(["/photos/a/1.jpg", "/photos/a/2.jpg"]) == {"/photos/a/2.jpg"}
+    assert top_path(store, embs[0]) != "/photos/a/1.jpg"
+    store.close()
+
+
+def add_files(store: FaceStore, embs: np.ndarray, folders=("/photos/a", "/photos/b")) -> list:
+    paths = [f"{folders[i % len(folders)]}/{i}.jpg" for i in range(len(embs))]
+    store.add({path: [emb] for path, emb in zip(paths, embs)})
+    return paths
+
+
+@pytest.mark.parametrize("shard_seal_size", [1000, 4])
+def test_rebuild_renumbers_ids(store_kwargs, shard_seal_size):
+    embs = random_embeddings(12)
+    store = open_store(store_kwargs, shard_seal_size=shard_seal_size)
+    paths = add_files(store, embs[:6])
+    store.compact()
+    paths += add_files(store, embs[6:], folders=("/photos/c",))
+    removed = set(paths[1::3])
+    store.remove_paths(sorted(removed))
+    store.rebuild()
+
+    alive = [i for i, path in enumerate(paths) if path not in removed]
+    assert sorted(store.meta.face_ids()) == list(range(1, len(alive) + 1))
+    assert store.max_id == len(alive)
+    assert not store.meta.deleted_ids()
+    for i in alive:
+        assert top_path(store, embs[i]) == paths[i]
+    store.close()
+
+    # 重新打开后编号和路径的对应关系不变, 新增的 id 接在后面
+    store = open_store(store_kwargs, shard_seal_size=shard_seal_size)
+    assert store.index.ntotal + store.shards.ntotal == len(alive)
+    for i in alive:
+        assert top_path(store, embs[i]) == paths[i]
+    new_emb = random_embeddings(1, seed=1)[0]
+    store.add({"/photos/d/new.jpg": [new_emb]})
+    assert store.max_id == len(alive) + 1
+    assert top_path(store, new_emb) == "/photos/d/new.jpg"
+    store.close()
+
+
+def test_deleted_shard_vectors_not_returned(store_kwargs):
+    embs = random_embeddings(8)
+    store = open_store(store_kwargs, shard_seal_size=4)
+    paths = add_files(store, embs)
+    store.compact()
+    assert store.shards.ntotal == 8 and store.index.ntotal == 0
+    # 分片只读, 删除的向量仍在分片中, 检索时不占用 top-k 的名额
+    query = embs[0] + 0.5 * embs[1]
+    store.remove_paths([paths[0]])
+    hits = store.search([query], k=2)
+    assert len(hits) == 2
+    assert paths[0] not in {path for _, path, _ in hits}
+    assert hits[0][1] == paths[1]
+    store.close()
+
+
+def test_rebuild_after_failed_rebuild(store_kwargs, monkeypatch):
+    embs = random_embeddings(8)
+    store = open_store(store_kwargs, shard_seal_size=4)
+    paths = add_files(store, embs)
+    store.compact()
+    store.remove_paths(paths[:2])
+    store.flush()
+
+    # 新一代分片写完、元数据提交前失败, 半成品留在下一代目录中
+    def fail(id_map):
+        raise RuntimeError("renumber failed")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(store.meta, "renumber_faces", fail)
+        with pytest.raises(RuntimeError):
+            store.rebuild()
+    store.meta.conn.rollback()
+    store.rebuild()
+
+    assert store.shards.ntotal == 6
+    assert sorted(store.meta.face_ids()) == list(range(1, 7))
+    for i in range(2, 8):
+        assert top_path(store, embs[i]) == paths[i]
+    store.close()
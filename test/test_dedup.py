@@ -0,0 +1,143 @@
+# 入库去重: 内容哈希和感知哈希查找重复文件, 删除目标文件时重复文件接管人脸
+import os
+import shutil
+
+import cv2
+import numpy as np
+import pytest
+
+from core.database import FaceStore, normalize_embeddings, EMBEDDING_DIM
+from core.dedup import find_duplicates, iter_find_duplicates, perceptual_hash
+from core.manifest import FileEntry, fast_file_hash
+from core.metadata import MetaStore
+
+
+def scene(seed, shift=0) -> np.ndarray:
+    """
+    平滑的随机背景加一个椭圆, 感知哈希在缩放和压缩后基本不变, 平移后明显变化
+    """
+    rng = np.random.default_rng(seed)
+    image = cv2.GaussianBlur(rng.integers(0, 255, (480, 640, 3), dtype=np.uint8), (0, 0), 12)
+    image = cv2.normalize(image, None, 0, 255, cv2.NORM_MINMAX)
+    cv2.ellipse(image, (320 + shift, 240), (90, 120), 0, 0, 360, (150, 180, 220), -1)
+    return image
+
+
+def make_entry(path) -> FileEntry:
+    stat = os.stat(path)
+    return FileEntry(str(path), stat.st_size, stat.st_mtime, fast_file_hash(str(path), stat.st_size))
+
+
+@pytest.fixture
+def images(tmp_path):
+    original = scene(0)
+    paths = {name: tmp_path / name for name in ("a.jpg", "a_copy.jpg", "a_small.png", "shifted.jpg", "other.jpg")}
+    cv2.imwrite(str(paths["a.jpg"]), original, [cv2.IMWRITE_JPEG_QUALITY, 95])
+    shutil.copy(paths["a.jpg"], paths["a_copy.jpg"])
+    cv2.imwrite(str(paths["a_small.png"]), cv2.resize(original, (320, 240), interpolation=cv2.INTER_AREA))
+    cv2.imwrite(str(paths["shifted.jpg"]), scene(0, shift=40), [cv2.IMWRITE_JPEG_QUALITY, 95])
+    cv2.imwrite(str(paths["other.jpg"]), scene(1), [cv2.IMWRITE_JPEG_QUALITY, 95])
+    return {name: make_entry(path) for name, path in paths.items()}
+
+
+@pytest.fixture
+def meta(tmp_path):
+    meta = MetaStore(str(tmp_path / "meta.db"))
+    yield meta
+    meta.close()
+
+
+def test_duplicates_within_batch(images, meta):
+    entries = list(images.values())
+    result = find_duplicates(entries, meta, workers=2)
+    a = images["a.jpg"].path
+    assert sorted(entry.path for entry in result.files) == sorted(
+        images[name].path for name in ("a.jpg", "shifted.jpg", "other.jpg"))
+    assert result.linked == []
+    assert sorted(entry.path for entry in result.pending[a]) == sorted(
+        images[name].path for name in ("a_copy.jpg", "a_small.png"))
+    # 内容相同的文件不需要计算感知哈希
+    assert images["a_copy.jpg"].path not in result.hashes
+
+
+def test_progress_reported(images, meta):
+    steps = iter_find_duplicates(list(images.values()), meta, workers=2)
+    progress = []
+    while True:
+        try:
+            progress.append(next(steps))
+        except StopIteration as stop:
+            result = stop.value
+            break
+    # 内容相同的副本在计算感知哈希之前已经归入目标文件
+    assert progress == [(i, 4) for i in range(1, 5)]
+    assert len(result.files) == 3
+
+
+def test_link_to_library(images, meta):
+    a = images["a.jpg"]
+    kind, code = perceptual_hash(a.path)
+    meta.update_manifest([a])
+    meta.update_perceptual_hashes([(a.path, kind, code.tobytes())])
+    meta.commit()
+
+    entries = [images[name] for name in ("a_copy.jpg", "a_small.png", "shifted.jpg")]
+    result = find_duplicates(entries, meta, workers=2)
+    assert sorted((entry.path, target) for entry, target in result.linked) == [
+        (images["a_copy.jpg"].path, a.path), (images["a_small.png"].path, a.path)]
+    assert [entry.path for entry in result.files] == [images["shifted.jpg"].path]
+    assert result.pending == {}
+
+
+def test_link_to_target_of_duplicate(images, meta):
+    a, copy = images["a.jpg"], images["a_copy.jpg"]
+    meta.update_manifest([a, copy])
+    meta.link_paths([(copy.path, a.path)])
+    meta.commit()
+    # 与重复文件内容相同时关联到它的目标文件
+    moved = copy._replace(path=copy.path + ".moved")
+    result = find_duplicates([moved], meta, workers=1)
+    assert result.linked == [(moved, a.path)]
+
+
+def test_delete_target_promotes_duplicate(images, tmp_path):
+    store = FaceStore(index_path=str(tmp_path / "index.faiss"), meta_db_path=str(tmp_path / "store.db"),
+                      segment_dir=str(tmp_path / "segments"), shard_dir=str(tmp_path / "shards"),
+                      datameta_path=None, flush_interval=None, index_type="flat")
+    emb = normalize_embeddings(np.random.default_rng(0).standard_normal((1, EMBEDDING_DIM)).astype(np.float32))[0]
+    a, copy, small = images["a.jpg"], images["a_copy.jpg"], images["a_small.png"]
+    store.add({a.path: [emb]})
+    store.update_manifest([a])
+    store.update_dedup([(copy, a.path), (small, a.path)], [])
+    store.flush()
+
+    # 人脸转给第一个重复文件, 其余重复文件关联到它
+    assert store.remove_paths([a.path]) == 0
+    assert store.search([emb], k=1)[0][1] == copy.path
+    assert store.meta.get_links([copy.path]) == {copy.path: [small.path]}
+    assert store.meta.get_link_targets([copy.path]) == {}
+
+    # 新的目标文件被删除时再转给下一个重复文件, 没有重复文件时才删除人脸
+    assert store.remove_paths([copy.path]) == 0
+    assert store.search([emb], k=1)[0][1] == small.path
+    assert store.remove_paths([small.path]) == 1
+    assert store.search([emb], k=1) == []
+    store.close()
+
+
+def test_sampled_hash_collision_not_linked(tmp_path, meta):
+    # 大小相同、头中尾 64KB 相同而其余内容不同的大文件, 快速哈希相同
+    data = np.random.default_rng(0).integers(0, 256, 400000, dtype=np.uint8).tobytes()
+    changed = data[:100000] + bytes([data[100000] ^ 0xFF]) + data[100001:]
+    paths = [tmp_path / name for name in ("big.jpg", "big_copy.jpg", "big_changed.jpg", "big_library.jpg")]
+    for path, content in zip(paths, (data, data, changed, changed)):
+        path.write_bytes(content)
+    big, copy, changed_entry, library = [make_entry(path) for path in paths]
+    assert big.hash == changed_entry.hash
+    meta.update_manifest([library])
+    meta.commit()
+
+    result = find_duplicates([big, copy, changed_entry], meta, workers=1)
+    assert result.pending == {big.path: [copy]}
+    assert result.linked == [(changed_entry, library.path)]
+    assert [entry.path for entry in result.files] == [big.path]
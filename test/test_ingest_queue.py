@@ -0,0 +1,116 @@
+# 分布式入库任务队列: 领取、租约过期、失败重试、结果文件合并
+import time
+
+import numpy as np
+import pytest
+
+import core.ingest_queue
+from core.database import FaceStore, normalize_embeddings, EMBEDDING_DIM
+from core.ingest_queue import JobQueue, write_result, read_result, gen_merge_results
+from core.manifest import FileEntry
+
+
+def make_entries(n, folder="/photos/a") -> list:
+    return [FileEntry(f"{folder}/{i}.jpg", 100 + i, 1700000000.0 + i, f"hash{i}") for i in range(n)]
+
+
+@pytest.fixture
+def job_queue(tmp_path):
+    queue = JobQueue(str(tmp_path / "queue"), lease_seconds=60, max_attempts=2)
+    yield queue
+    queue.close()
+
+
+def test_submit_splits_and_skips_queued(job_queue):
+    entries = make_entries(5)
+    assert job_queue.submit(entries, job_size=2) == 3
+    # 已在队列中的文件不会重复提交
+    assert job_queue.submit(entries + make_entries(1, "/photos/b"), job_size=2) == 1
+    assert job_queue.status()["pending"] == 4
+
+
+def test_claim_holds_job(job_queue):
+    job_queue.submit(make_entries(4), job_size=2)
+    first = job_queue.claim("w1")
+    second = job_queue.claim("w2")
+    assert first.id != second.id
+    assert first.entries == make_entries(2)
+    assert first.attempts == 1
+    assert job_queue.claim("w3") is None
+    assert sorted(job_queue.status()["workers"]) == ["w1", "w2"]
+    # 其他节点不能完成不属于自己的任务
+    assert not job_queue.complete(first, "w2", "result.npz")
+    assert job_queue.complete(first, "w1", "result.npz")
+    assert job_queue.has_unfinished()
+
+
+def test_expired_lease_reclaimed(job_queue):
+    job_queue.lease_seconds = 0.05
+    job_queue.submit(make_entries(2), job_size=2)
+    old = job_queue.claim("w1")
+    assert job_queue.claim("w2") is None
+    time.sleep(0.1)
+    new = job_queue.claim("w2")
+    assert new.id == old.id and new.attempts == 2
+    # 租约过期后旧节点的续租和提交都无效
+    assert not job_queue.heartbeat(old, "w1")
+    assert not job_queue.complete(old, "w1", "old.npz")
+    assert job_queue.heartbeat(new, "w2")
+    assert job_queue.complete(new, "w2", "new.npz")
+
+
+def test_expired_lease_fails_after_max_attempts(job_queue):
+    job_queue.lease_seconds = 0.05
+    job_queue.submit(make_entries(1), job_size=1)
+    for _ in range(2):
+        assert job_queue.claim("w1") is not None
+        time.sleep(0.1)
+    assert job_queue.claim("w1") is None
+    assert job_queue.status()["failed"] == 1
+
+
+def test_fail_requeues_then_retry(job_queue):
+    job_queue.submit(make_entries(1), job_size=1)
+    job = job_queue.claim("w1")
+    assert job_queue.fail(job, "w1", "decode error")
+    assert job_queue.status()["pending"] == 1
+    job = job_queue.claim("w1")
+    assert job.attempts == 2
+    assert job_queue.fail(job, "w1", "decode error")
+    assert job_queue.status()["failed"] == 1
+    assert not job_queue.has_unfinished()
+
+    assert job_queue.retry_failed() == 1
+    assert job_queue.claim("w1").attempts == 1
+
+
+def test_merge_results(job_queue, tmp_path, monkeypatch):
+    rng = np.random.default_rng(0)
+    embs = normalize_embeddings(rng.standard_normal((3, EMBEDDING_DIM)).astype(np.float32))
+    entries = make_entries(3)
+    job_queue.submit(entries, job_size=3)
+    job = job_queue.claim("w1")
+    result_file = str(tmp_path / "queue" / "results" / f"job_{job.id}.npz")
+    faces = [{"embedding": embs[0], "bbox": np.array([1, 2, 3, 4]), "det_score": 0.9, "frame_ts": None},
+             {"embedding": embs[1], "bbox": None, "det_score": None, "frame_ts": 1.5}]
+    # 没有人脸的文件也写入清单
+    write_result(result_file, [(entries[0], faces), (entries[1], [embs[2]]), (entries[2], [])])
+    assert job_queue.complete(job, "w1", result_file)
+
+    emb_dict, manifest_entries = read_result(result_file)
+    assert manifest_entries == entries
+    assert sorted(emb_dict) == [entries[0].path, entries[1].path]
+    assert emb_dict[entries[0].path][1]["frame_ts"] == 1.5
+
+    store = FaceStore(index_path=str(tmp_path / "index.faiss"), meta_db_path=str(tmp_path / "meta.db"),
+                      segment_dir=str(tmp_path / "segments"), shard_dir=str(tmp_path / "shards"),
+                      datameta_path=None, flush_interval=None, index_type="flat")
+    monkeypatch.setattr(core.ingest_queue, "get_face_store", lambda: store)
+    assert list(gen_merge_results(job_queue)) == [(1, 1)]
+    assert job_queue.status()["merged"] == 1
+    assert store.meta.face_count() == 3
+    assert sorted(store.meta.manifest_paths()) == [entry.path for entry in entries]
+    assert store.search([embs[1]], k=1)[0][1:] == (entries[0].path, 1.5)
+    # 合并后的文件可以重新提交
+    assert job_queue.submit(entries, job_size=3) == 1
+    store.close()
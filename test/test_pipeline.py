@@ -0,0 +1,65 @@
+# 入库流水线 run_pipeline: 结果完整、异常按文件返回、提前退出时线程结束
+import threading
+import time
+
+from core.pipeline import run_pipeline
+
+
+def square_all(values):
+    return [value * value for value in values]
+
+
+def test_all_items_returned():
+    results = list(run_pipeline(range(50), lambda item: item, square_all, decode_workers=4, infer_workers=2,
+                                batch_size=8, queue_size=4))
+    assert sorted(item for item, _, _ in results) == list(range(50))
+    assert all(result == item * item and error is None for item, result, error in results)
+
+
+def test_errors_reported_per_item():
+    def decode(item):
+        if item % 5 == 0:
+            raise ValueError(item)
+        return item
+
+    def infer(values):
+        if 7 in values:
+            raise RuntimeError("batch")
+        return square_all(values)
+
+    results = {item: (result, error) for item, result, error in
+               run_pipeline(range(20), decode, infer, decode_workers=2, infer_workers=1, batch_size=1, queue_size=2)}
+    assert sorted(results) == list(range(20))
+    assert isinstance(results[5][1], ValueError) and results[5][0] is None
+    assert isinstance(results[7][1], RuntimeError) and results[7][0] is None
+    assert results[3] == (9, None)
+
+
+def test_close_stops_decoding():
+    decoded = []
+
+    def decode(item):
+        decoded.append(item)
+        return item
+
+    before = threading.active_count()
+    results = run_pipeline(range(10000), decode, square_all, decode_workers=2, infer_workers=2, batch_size=4,
+                           queue_size=2)
+    for _ in range(5):
+        next(results)
+    results.close()
+
+    deadline = time.time() + 2
+    while threading.active_count() > before and time.time() < deadline:
+        time.sleep(0.05)
+    assert threading.active_count() == before
+    # 有界队列限制了提前解码的数量
+    assert len(decoded) < 100
+
+
+def test_result_count_mismatch_reported():
+    results = list(run_pipeline(range(6), lambda item: item, lambda values: square_all(values)[:-1],
+                                decode_workers=1, infer_workers=1, batch_size=3, queue_size=8))
+    # 结果数量不一致的批次中每个文件都返回异常, 不会被静默丢弃
+    assert sorted(item for item, _, _ in results) == list(range(6))
+    assert all(result is None and isinstance(error, ValueError) for _, result, error in results)
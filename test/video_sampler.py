@@ -0,0 +1,42 @@
+# 对比各抽帧方式每个视频经过解码器的帧数和耗时
+# 用法: python -m test.video_sampler [视频路径 ...], 不传路径时生成一个合成视频
+import os
+import sys
+import tempfile
+
+import cv2
+import numpy as np
+
+from core.video import iter_video_frames, new_sample_stats, SAMPLE_MODES
+
+
+def make_synthetic_video(video_path, seconds=60, fps=25, size=(640, 360)):
+    writer = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, size)
+    for i in range(seconds * fps):
+        frame = np.full((size[1], size[0], 3), i % 255, dtype=np.uint8)
+        cv2.putText(frame, str(i), (20, 200), cv2.FONT_HERSHEY_SIMPLEX, 3, (255, 255, 255), 5)
+        writer.write(frame)
+    writer.release()
+    return video_path
+
+
+def benchmark(video_paths, sample_fps=2):
+    print(f"{'mode':<10}{'decoded/video':>15}{'sampled/video':>15}{'seconds/video':>15}")
+    for mode in SAMPLE_MODES:
+        total = new_sample_stats()
+        for video_path in video_paths:
+            stats = new_sample_stats()
+            for _ in iter_video_frames(video_path, sample_fps=sample_fps, mode=mode, time_budget=None,
+                                       max_samples=None, stats=stats):
+                pass
+            for key in total:
+                total[key] += stats[key]
+        n = len(video_paths)
+        print(f"{mode:<10}{total['decoded'] / n:>15.1f}{total['sampled'] / n:>15.1f}{total['seconds'] / n:>15.3f}")
+
+
+if __name__ == '__main__':
+    paths = sys.argv[1:]
+    if not paths:
+        paths = [make_synthetic_video(os.path.join(tempfile.mkdtemp(), "synthetic.mp4"))]
+    benchmark(paths)
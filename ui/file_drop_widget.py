@@ -1,15 +1,22 @@
-import os
+import logging
 import sys
-import cv2
+import time
 
+from core.database import gen_remove_media, gen_purge_vanished
 from core.embedding import gen_embedding
-from core.search import search_function
+from core.models import registry, warmup
+from core.utils import setup_logging
 
 from PyQt5.QtWidgets import *
 from PyQt5.QtCore import Qt, pyqtSignal, QObject, QThread, QUrl
-from PyQt5.QtGui import QDragEnterEvent, QDropEvent, QPixmap, QDesktopServices, QImage
+from PyQt5.QtGui import QDragEnterEvent, QDropEvent, QDesktopServices
 
-from settings import ALLOWED_IMG_TYPES, ALLOWED_VIDEO_TYPES
+from settings import MIN_SCORE
+from ui.search_results import SearchWorker, SearchResultModel, ThumbnailDelegate, THUMBNAIL_SIZE, THUMBNAIL_COLUMN, \
+    ACTION_COLUMN
+from ui.stats_panel import StatsPanel
+
+logger = logging.getLogger(__name__)
 
 
 class FileDropWidget(QLabel):
@@ -40,12 +47,20 @@ class Worker(QObject):
         self.gen = gen
 
     def run(self):
-        for current, total in self.gen:
-            self.progress.emit(current, total)
-        self.finished.emit()
+        # 出错时同样发出 finished, 界面上的按钮才会恢复可用
+        try:
+            for current, total in self.gen:
+                self.progress.emit(current, total)
+        except Exception:
+            logger.exception("后台任务执行失败")
+        finally:
+            self.finished.emit()
 
 
 class MainWindow(QMainWindow):
+    # 后台预热完成, 参数为各组件的启动耗时
+    warmupFinished = pyqtSignal(dict)
+
     def __init__(self):
         super().__init__()
         self.setWindowTitle("人脸相似度检索")
@@ -65,6 +80,20 @@ class MainWindow(QMainWindow):
         self.init_tab1()
         self.init_tab2()
 
+        self.warmupFinished.connect(self.show_startup_timings)
+
+    def start_warmup(self):
+        """
+        窗口显示后在后台加载模型, 加载完成前开始检索或导入时会等待对应模型加载
+        """
+        self.statusBar().showMessage("正在后台加载模型...")
+        warmup(callback=self.warmupFinished.emit)
+
+    def show_startup_timings(self, timings):
+        report = registry.report()
+        logger.info(f"启动耗时 {report}")
+        self.statusBar().showMessage(f"模型加载完成 ({report})")
+
     def init_tab1(self):
         layout = QVBoxLayout()
 
@@ -78,16 +107,30 @@ class MainWindow(QMainWindow):
         self.progress1 = QProgressBar()
         self.progress1.setAlignment(Qt.AlignCenter)
 
+        # 库维护: 删除所选文件或文件夹, 清理磁盘上已经不存在的文件
+        maintain_layout = QHBoxLayout()
+        self.btn_remove1 = QPushButton("从库中删除所选")
+        self.btn_purge1 = QPushButton("清理已不存在的文件")
+        maintain_layout.addWidget(self.btn_remove1)
+        maintain_layout.addWidget(self.btn_purge1)
+
+        # 入库各阶段的实时统计
+        self.stats_panel1 = StatsPanel()
+
         # 布局
         layout.addWidget(self.drop_area1)
         layout.addWidget(btn_browse)
         layout.addWidget(self.btn_confirm1)
+        layout.addLayout(maintain_layout)
         layout.addWidget(self.progress1)
+        layout.addWidget(self.stats_panel1)
         self.tab1.setLayout(layout)
 
         # 信号连接
         self.drop_area1.filesDropped.connect(self.handle_files_tab1)
         self.btn_confirm1.clicked.connect(self.start_processing_tab1)
+        self.btn_remove1.clicked.connect(self.start_remove_tab1)
+        self.btn_purge1.clicked.connect(self.start_purge_tab1)
 
     def init_tab2(self):
         layout = QVBoxLayout()
@@ -102,19 +145,40 @@ class MainWindow(QMainWindow):
         self.top_k = QSpinBox()
         self.top_k.setRange(1, 1000)
         self.top_k.setValue(100)
-        self.min_score = QSpinBox()
-        self.min_score.setRange(0, 1000)
-        self.min_score.setValue(200)
+        # 分数为余弦相似度
+        self.min_score = QDoubleSpinBox()
+        self.min_score.setRange(-1, 1)
+        self.min_score.setDecimals(2)
+        self.min_score.setSingleStep(0.05)
+        self.min_score.setValue(MIN_SCORE)
 
         param_layout.addWidget(QLabel("Top-K:"))
         param_layout.addWidget(self.top_k)
         param_layout.addWidget(QLabel("MinScore:"))
         param_layout.addWidget(self.min_score)
 
-        # 结果展示
-        self.results_table = QTableWidget()
-        self.results_table.setColumnCount(4)
-        self.results_table.setHorizontalHeaderLabels(["分数", "文件路径", "文件内容", "操作"])
+        # 检索范围, 多个文件夹用 ; 分隔, 为空时检索整个库
+        scope_layout = QHBoxLayout()
+        self.scope_input = QLineEdit()
+        self.scope_input.setPlaceholderText("检索范围(文件夹, 多个用 ; 分隔), 为空时检索整个库")
+        btn_scope = QPushButton("选择文件夹")
+        btn_scope.clicked.connect(self.select_scope_tab2)
+        scope_layout.addWidget(QLabel("范围:"))
+        scope_layout.addWidget(self.scope_input)
+        scope_layout.addWidget(btn_scope)
+
+        # 结果展示, 只绘制可见行
+        self.results_model = SearchResultModel(self)
+        self.results_table = QTableView()
+        self.results_table.setModel(self.results_model)
+        self.results_table.setItemDelegateForColumn(THUMBNAIL_COLUMN, ThumbnailDelegate(self.results_table))
+        self.results_table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.results_table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.results_table.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.results_table.verticalHeader().setDefaultSectionSize(THUMBNAIL_SIZE)
+        self.results_table.setColumnWidth(1, 300)
+        self.results_table.setColumnWidth(THUMBNAIL_COLUMN, THUMBNAIL_SIZE)
+        self.search_status = QLabel()
 
         # 确认按钮
         self.btn_confirm2 = QPushButton("开始检索")
@@ -123,18 +187,28 @@ class MainWindow(QMainWindow):
         layout.addWidget(self.drop_area2)
         layout.addWidget(btn_browse)
         layout.addLayout(param_layout)
+        layout.addLayout(scope_layout)
         layout.addWidget(self.btn_confirm2)
+        layout.addWidget(self.search_status)
         layout.addWidget(self.results_table)
         self.tab2.setLayout(layout)
 
         # 信号连接
         self.drop_area2.filesDropped.connect(self.handle_file_tab2)
         self.btn_confirm2.clicked.connect(self.start_search_tab2)
+        self.results_table.clicked.connect(self.handle_result_clicked)
+        self.results_table.doubleClicked.connect(self.handle_result_double_clicked)
+
+        # 正在进行的检索, 取消后旧线程在推理结束前仍在运行, 需要保留引用
+        self.search_id = 0
+        self.search_worker = None
+        self.search_threads = {}
 
     # Tab1相关方法
     def select_files_tab1(self):
         files, _ = QFileDialog.getOpenFileNames(self, "选择文件", "", "媒体文件 (*.jpg *.jpeg *.png *.mp4 *.avi)")
         if files:
+            self.tab1_files = files
             self.drop_area1.setText("\n".join(files))
 
     def handle_files_tab1(self, paths):
@@ -144,10 +218,25 @@ class MainWindow(QMainWindow):
         if not hasattr(self, 'tab1_files'):
             QMessageBox.warning(self, "警告", "请先选择文件或文件夹")
             return
+        self.stats_panel1.start()
+        self.run_worker_tab1(gen_embedding(self.tab1_files))
+        self.thread.finished.connect(self.stats_panel1.stop)
+
+    def start_remove_tab1(self):
+        if not hasattr(self, 'tab1_files'):
+            QMessageBox.warning(self, "警告", "请先选择要删除的文件或文件夹")
+            return
+        answer = QMessageBox.question(self, "确认", "从库中删除所选文件及文件夹下的全部文件? 原文件不会被删除")
+        if answer == QMessageBox.Yes:
+            self.run_worker_tab1(gen_remove_media(self.tab1_files))
+
+    def start_purge_tab1(self):
+        self.run_worker_tab1(gen_purge_vanished())
 
+    def run_worker_tab1(self, gen):
         # 创建线程处理生成器
         self.thread = QThread()
-        self.worker = Worker(gen_embedding(self.tab1_files))  # 替换为实际生成器
+        self.worker = Worker(gen)
         self.worker.moveToThread(self.thread)
 
         # 连接信号
@@ -157,8 +246,9 @@ class MainWindow(QMainWindow):
         self.thread.start()
 
         # 禁用按钮
-        self.btn_confirm1.setEnabled(False)
-        self.thread.finished.connect(lambda: self.btn_confirm1.setEnabled(True))
+        for button in (self.btn_confirm1, self.btn_remove1, self.btn_purge1):
+            button.setEnabled(False)
+            self.thread.finished.connect(lambda button=button: button.setEnabled(True))
 
     def update_progress_tab1(self, current, total):
         self.progress1.setMaximum(total)
@@ -170,109 +260,74 @@ class MainWindow(QMainWindow):
         if file:
             self.drop_area2.setText(file)
 
+    def select_scope_tab2(self):
+        folder = QFileDialog.getExistingDirectory(self, "选择检索范围")
+        if folder:
+            scope = [f for f in self.scope_input.text().split(";") if f.strip()]
+            self.scope_input.setText(";".join(scope + [folder]))
+
     def handle_file_tab2(self, paths):
         if paths:
             self.tab2_file = paths[0]
             self.drop_area2.setText(self.tab2_file)
 
     def start_search_tab2(self):
+        if self.search_worker is not None:
+            self.cancel_search_tab2()
+            return
         if not hasattr(self, 'tab2_file'):
             QMessageBox.warning(self, "警告", "请先选择待检索文件")
             return
 
-        # 执行搜索回调
-        results = search_function(  # 替换为实际搜索函数
-            self.tab2_file,
-            self.top_k.value(),
-            self.min_score.value()
-        )
-
-        # 清空结果表格
-        self.results_table.setRowCount(len(results))
-
-        for row, (score, path) in enumerate(results):
-            # 更新分数和文件路径
-            self.results_table.setRowHeight(row, 200)
-            self.results_table.setColumnWidth(1, 300)
-            self.results_table.setItem(row, 0, QTableWidgetItem(str(score)))
-            self.results_table.setItem(row, 1, QTableWidgetItem(path))
-
-            label, media_type = self.get_media_row_label(path)
-            self.results_table.setCellWidget(row, 2, label)
-
-            media_button = QPushButton(media_type)
-            media_button.clicked.connect(lambda _, p=path: self.play_media(p))
-            self.results_table.setCellWidget(row, 3, media_button)
-
-    def get_media_row_label(self, path):
-        # 检查文件是否存在
-        if not os.path.exists(path):
-            error_label = QLabel("文件不存在")
-            error_label.setStyleSheet("color: red;")
-            return error_label, "未知"
-
-        # 根据文件类型展示内容
-        if path.lower().endswith(ALLOWED_IMG_TYPES):
-            # 显示图片
-            pixmap = QPixmap(path)
-            if pixmap.isNull():
-                error_label = QLabel("无法加载图片")
-                error_label.setStyleSheet("color: red;")
-                return error_label, "查看图片"
-            else:
-                label = QLabel()
-                label.setPixmap(pixmap.scaled(200, 200, Qt.KeepAspectRatio, Qt.SmoothTransformation))
-                label.setAlignment(Qt.AlignCenter)
-                label.setScaledContents(True)
-                return label, "查看图片"
-
-        elif path.lower().endswith(ALLOWED_VIDEO_TYPES):
-            # 使用 OpenCV 抽取视频缩略图
-            thumbnail = self.extract_video_thumbnail(path)
-            if thumbnail is None:
-                error_label = QLabel("无法加载视频缩略图")
-                error_label.setStyleSheet("color: red;")
-                return error_label, '播放视频'
-            else:
-                label = QLabel()
-                label.setPixmap(thumbnail.scaled(200, 200, Qt.KeepAspectRatio, Qt.SmoothTransformation))
-                label.setAlignment(Qt.AlignCenter)
-                label.setScaledContents(True)
-                return label, '播放视频'
-
-        else:
-            # 不支持的文件类型
-            unsupported_label = QLabel("不支持的文件类型")
-            unsupported_label.setStyleSheet("color: orange;")
-            return unsupported_label, "未知"
-
-    def extract_video_thumbnail(self, path):
-        """
-        使用 OpenCV 抽取视频的第一帧作为缩略图
-        """
-        cap = cv2.VideoCapture(path)
-        if not cap.isOpened():
-            return None
-
-        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        cap.set(cv2.CAP_PROP_POS_FRAMES, min(100, total_frames))
-
-        ret, frame = cap.read()
-        cap.release()
-
-        if not ret:
-            return None
-
-        # 将 BGR 格式的帧转换为 RGB 格式
-        frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-
-        # 将帧转换为 QPixmap
-        h, w, ch = frame_rgb.shape
-        bytes_per_line = ch * w
-        q_image = QImage(frame_rgb.data, w, h, bytes_per_line, QImage.Format_RGB888)
-        pixmap = QPixmap.fromImage(q_image)
-
-        return pixmap
+        # 检索在后台线程中执行, 结果分批追加到表格
+        self.search_id += 1
+        self.results_model.clear()
+        thread = QThread()
+        scope = [folder.strip() for folder in self.scope_input.text().split(";") if folder.strip()]
+        worker = SearchWorker(self.search_id, self.tab2_file, self.top_k.value(), self.min_score.value(), scope)
+        worker.moveToThread(thread)
+        worker.resultsReady.connect(self.append_search_results)
+        worker.failed.connect(self.handle_search_failed)
+        worker.finished.connect(self.handle_search_finished)
+        worker.finished.connect(thread.quit)
+        thread.started.connect(worker.run)
+        thread.finished.connect(lambda search_id=self.search_id: self.search_threads.pop(search_id, None))
+        self.search_threads[self.search_id] = (thread, worker)
+        self.search_worker = worker
+        thread.start()
+
+        self.btn_confirm2.setText("取消检索")
+        self.search_status.setText("正在检索...")
+
+    def cancel_search_tab2(self):
+        self.search_worker.cancel()
+        self.search_worker = None
+        self.btn_confirm2.setText("开始检索")
+        self.search_status.setText(f"已取消, 已显示 {self.results_model.rowCount()} 个结果")
+
+    def append_search_results(self, search_id, hits):
+        # 已取消或被新检索替换的结果直接丢弃
+        if search_id == self.search_id and self.search_worker is not None:
+            self.results_model.append_rows(hits)
+            self.search_status.setText(f"正在检索... 已显示 {self.results_model.rowCount()} 个结果")
+
+    def handle_search_failed(self, search_id, message):
+        if search_id == self.search_id and self.search_worker is not None:
+            QMessageBox.warning(self, "警告", f"检索失败: {message}")
+
+    def handle_search_finished(self, search_id, total):
+        if search_id == self.search_id and self.search_worker is not None:
+            self.search_worker = None
+            self.btn_confirm2.setText("开始检索")
+            self.search_status.setText(f"检索完成, 共 {total} 个文件")
+
+    def handle_result_clicked(self, index):
+        # 单击"操作"列或者双击任意列时打开文件
+        if index.column() == ACTION_COLUMN:
+            self.play_media(index.data(Qt.UserRole).path)
+
+    def handle_result_double_clicked(self, index):
+        self.play_media(index.data(Qt.UserRole).path)
 
     def play_media(self, path):
         """
@@ -284,7 +339,11 @@ class MainWindow(QMainWindow):
 
 
 if __name__ == "__main__":
+    setup_logging()
+    b = time.time()
     app = QApplication(sys.argv)
     window = MainWindow()
     window.show()
+    registry.record("ui", time.time() - b)
+    window.start_warmup()
     sys.exit(app.exec_())
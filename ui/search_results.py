@@ -0,0 +1,253 @@
+# 检索结果表格: 后台线程检索, 结果分批追加到 QAbstractTableModel, 缩略图由委托绘制, 在线程池中从磁盘缓存异步加载
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from PyQt5.QtCore import Qt, pyqtSignal, QObject, QAbstractTableModel, QModelIndex, QRunnable, QThreadPool, QRect
+from PyQt5.QtGui import QImage, QPixmap, QColor
+from PyQt5.QtWidgets import QStyledItemDelegate, QStyle
+
+from core.search import search_files, get_query_embeddings
+from core.thumbnails import get_thumbnail_cache
+from settings import ALLOWED_IMG_TYPES, ALLOWED_VIDEO_TYPES, THUMBNAIL_SIZE
+
+logger = logging.getLogger(__name__)
+
+# 每次追加到表格的行数
+RESULT_CHUNK_SIZE = 50
+# 内存中保留的缩略图数量
+THUMBNAIL_CACHE_SIZE = 500
+
+COLUMNS = ["分数", "文件路径", "时间", "命中数", "文件内容", "操作"]
+THUMBNAIL_COLUMN = 4
+ACTION_COLUMN = 5
+# 缩略图加载失败且文件已不存在, 由加载线程检查, 绘制时不访问磁盘
+MISSING_ROLE = Qt.UserRole + 1
+
+
+def format_frame_ts(frame_ts):
+    """
+    视频内的时间偏移格式化为 时:分:秒, 图片返回空字符串
+    """
+    if frame_ts is None:
+        return ""
+    seconds = int(frame_ts)
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def get_media_type(path):
+    if path.lower().endswith(ALLOWED_IMG_TYPES):
+        return "查看图片"
+    elif path.lower().endswith(ALLOWED_VIDEO_TYPES):
+        return "播放视频"
+    return "未知"
+
+
+def load_thumbnail(path, frame_ts=None) -> QImage | None:
+    """
+    从磁盘缓存读取缩略图, 未缓存时生成, 在工作线程中调用, 所以返回 QImage 而不是 QPixmap
+    """
+    cache_file = get_thumbnail_cache().ensure(path, frame_ts)
+    if cache_file is None:
+        return None
+    image = QImage(cache_file)
+    return None if image.isNull() else image
+
+
+class SearchWorker(QObject):
+    """
+    在后台线程中识别待检索文件并检索索引, 结果分批发出
+    cancel 之后不再发出结果; 正在进行的模型推理无法中断, 完成后直接丢弃
+    """
+    resultsReady = pyqtSignal(int, list)  # 检索序号, 一批 FileHit
+    failed = pyqtSignal(int, str)
+    finished = pyqtSignal(int, int)  # 检索序号, 结果总数
+
+    def __init__(self, search_id, file_path, top_k, min_score, scope=None):
+        super().__init__()
+        self.search_id = search_id
+        self.file_path = file_path
+        self.top_k = top_k
+        self.min_score = min_score
+        self.scope = scope
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def is_cancelled(self):
+        return self._cancelled.is_set()
+
+    def run(self):
+        results = []
+        try:
+            embs = get_query_embeddings(self.file_path)
+            if not self.is_cancelled():
+                results = search_files(embs, self.top_k, self.min_score, scope=self.scope)
+            for i in range(0, len(results), RESULT_CHUNK_SIZE):
+                if self.is_cancelled():
+                    break
+                self.resultsReady.emit(self.search_id, results[i:i + RESULT_CHUNK_SIZE])
+        except Exception as e:
+            logger.exception(f"检索出错: {self.file_path}")
+            self.failed.emit(self.search_id, str(e))
+        self.finished.emit(self.search_id, len(results))
+
+
+class _ThumbnailTask(QRunnable):
+    def __init__(self, loader, key):
+        super().__init__()
+        self.loader = loader
+        self.key = key
+
+    def run(self):
+        try:
+            image = load_thumbnail(*self.key)
+        except Exception as e:
+            logger.warning(f"缩略图加载失败, path: {self.key[0]}, {e}")
+            image = None
+        missing = image is None and not os.path.exists(self.key[0])
+        self.loader.loaded.emit(self.key, image if image is not None else QImage(), missing)
+
+
+class ThumbnailLoader(QObject):
+    """
+    在线程池中加载缩略图, 同一个 (path, frame_ts) 同时只加载一次
+    """
+    # key, 缩略图(失败时为空), 文件是否已不存在
+    loaded = pyqtSignal(object, QImage, bool)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(max(2, min(4, os.cpu_count() or 1)))
+        self._pending = set()
+        self.loaded.connect(lambda key, *_: self._pending.discard(key))
+
+    def request(self, key):
+        if key in self._pending:
+            return
+        self._pending.add(key)
+        self.pool.start(_ThumbnailTask(self, key))
+
+    def clear(self):
+        self.pool.clear()
+        self._pending.clear()
+
+
+class SearchResultModel(QAbstractTableModel):
+    """
+    检索结果表格模型, 视图只对可见行调用 data, 所以只有可见行会加载缩略图
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.rows = []
+        self._thumbnails = OrderedDict()
+        # 加载失败时文件已不存在的 (path, frame_ts)
+        self._missing = set()
+        self.loader = ThumbnailLoader(self)
+        self.loader.loaded.connect(self._on_thumbnail_loaded)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(COLUMNS)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return COLUMNS[section]
+        return super().headerData(section, orientation, role)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        hit, column = self.rows[index.row()], index.column()
+        if role == Qt.DisplayRole:
+            if column == 0:
+                return f"{hit.score:.4f}"
+            elif column == 1:
+                return f"{hit.path} (另有 {len(hit.duplicates)} 个重复文件)" if hit.duplicates else hit.path
+            elif column == 2:
+                return format_frame_ts(hit.frame_ts)
+            elif column == 3:
+                return str(hit.hits)
+            elif column == ACTION_COLUMN:
+                return get_media_type(hit.path)
+        elif role == Qt.ToolTipRole and column == 1 and hit.duplicates:
+            return "\n".join([hit.path, *hit.duplicates])
+        elif role == Qt.DecorationRole and column == THUMBNAIL_COLUMN:
+            return self.get_thumbnail(hit)
+        elif role == Qt.UserRole:
+            return hit
+        elif role == MISSING_ROLE:
+            return (hit.path, hit.frame_ts) in self._missing
+        return None
+
+    def get_thumbnail(self, hit):
+        """
+        :return: QPixmap, 正在加载时为 None, 加载失败时为空的 QPixmap
+        """
+        key = (hit.path, hit.frame_ts)
+        pixmap = self._thumbnails.get(key)
+        if pixmap is not None:
+            self._thumbnails.move_to_end(key)
+            return pixmap
+        self.loader.request(key)
+        return None
+
+    def _on_thumbnail_loaded(self, key, image, missing):
+        self._thumbnails[key] = QPixmap.fromImage(image)
+        if missing:
+            self._missing.add(key)
+        else:
+            self._missing.discard(key)
+        while len(self._thumbnails) > THUMBNAIL_CACHE_SIZE:
+            self._missing.discard(self._thumbnails.popitem(last=False)[0])
+        for row, hit in enumerate(self.rows):
+            if (hit.path, hit.frame_ts) == key:
+                index = self.index(row, THUMBNAIL_COLUMN)
+                self.dataChanged.emit(index, index, [Qt.DecorationRole])
+
+    def append_rows(self, hits):
+        if not hits:
+            return
+        self.beginInsertRows(QModelIndex(), len(self.rows), len(self.rows) + len(hits) - 1)
+        self.rows.extend(hits)
+        self.endInsertRows()
+
+    def clear(self):
+        self.loader.clear()
+        self.beginResetModel()
+        self.rows = []
+        self.endResetModel()
+
+
+class ThumbnailDelegate(QStyledItemDelegate):
+    """
+    直接在单元格中绘制缩略图, 代替每行一个 QLabel
+    """
+
+    def paint(self, painter, option, index):
+        if option.state & QStyle.State_Selected:
+            painter.fillRect(option.rect, option.palette.highlight())
+        pixmap = index.data(Qt.DecorationRole)
+        if pixmap is None or pixmap.isNull():
+            if pixmap is None:
+                text, color = "加载中...", QColor("gray")
+            elif index.data(MISSING_ROLE):
+                text, color = "文件不存在", QColor("red")
+            else:
+                text, color = "无法加载缩略图", QColor("red")
+            painter.save()
+            painter.setPen(color)
+            painter.drawText(option.rect, Qt.AlignCenter, text)
+            painter.restore()
+            return
+
+        size = pixmap.size().scaled(option.rect.size(), Qt.KeepAspectRatio)
+        rect = QRect(0, 0, size.width(), size.height())
+        rect.moveCenter(option.rect.center())
+        painter.drawPixmap(rect, pixmap)
@@ -0,0 +1,88 @@
+# 入库统计面板: 导入时定时读取 core.metrics 的快照, 显示各阶段的吞吐量和耗时分位数, 可以导出为 JSON
+import logging
+
+from PyQt5.QtCore import QTimer
+from PyQt5.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QLabel, QPushButton, QTableWidget, QTableWidgetItem, \
+    QHeaderView, QAbstractItemView, QFileDialog, QMessageBox
+
+from core.metrics import metrics, STAGES
+
+logger = logging.getLogger(__name__)
+
+# 刷新间隔(毫秒)
+STATS_REFRESH_MS = 1000
+
+COLUMNS = ["阶段", "次数", "数量/秒", "平均(ms)", "P95(ms)", "累计(s)"]
+# 界面上显示的计数器及名称
+COUNTERS = {"files_processed": "已处理", "files_no_face": "无人脸", "files_failed": "失败", "files_skipped": "跳过",
+            "files_duplicate": "重复", "faces_found": "人脸数"}
+
+
+class StatsPanel(QWidget):
+    """
+    start 时清空统计并开始定时刷新, stop 时停止刷新并显示最终结果
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.table = QTableWidget(0, len(COLUMNS))
+        self.table.setHorizontalHeaderLabels(COLUMNS)
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.table.verticalHeader().setVisible(False)
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
+        self.summary = QLabel()
+        btn_export = QPushButton("导出统计")
+        btn_export.clicked.connect(self.export)
+
+        summary_layout = QHBoxLayout()
+        summary_layout.addWidget(self.summary, 1)
+        summary_layout.addWidget(btn_export)
+        layout = QVBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.addLayout(summary_layout)
+        layout.addWidget(self.table)
+        self.setLayout(layout)
+
+        self.timer = QTimer(self)
+        self.timer.setInterval(STATS_REFRESH_MS)
+        self.timer.timeout.connect(self.refresh)
+
+    def start(self):
+        metrics.reset()
+        self.refresh()
+        self.timer.start()
+
+    def stop(self):
+        self.timer.stop()
+        self.refresh()
+
+    def refresh(self):
+        snapshot = metrics.snapshot()
+        stages = snapshot["stages"]
+        # 已知阶段按流水线顺序在前, 其他阶段按名称排在后面
+        names = [stage for stage in STAGES if stage in stages] + sorted(set(stages) - set(STAGES))
+        self.table.setRowCount(len(names))
+        for row, stage in enumerate(names):
+            stats = stages[stage]
+            values = [stage, str(stats["count"]), f"{stats['items_per_s']:.1f}", f"{stats['mean_ms']:.1f}",
+                      f"{stats['p95_ms']:.1f}", f"{stats['total_s']:.1f}"]
+            for column, value in enumerate(values):
+                self.table.setItem(row, column, QTableWidgetItem(value))
+
+        counters = snapshot["counters"]
+        text = [f"耗时: {snapshot['elapsed_s']:.0f}s"]
+        text += [f"{label}: {counters[name]}" for name, label in COUNTERS.items() if name in counters]
+        bottleneck = metrics.bottleneck()
+        if bottleneck is not None:
+            text.append(f"瓶颈: {bottleneck}")
+        self.summary.setText(", ".join(text))
+
+    def export(self):
+        path, _ = QFileDialog.getSaveFileName(self, "导出统计", "ingest_stats.json", "JSON (*.json)")
+        if not path:
+            return
+        try:
+            metrics.export_json(path)
+        except OSError as e:
+            logger.exception(f"导出统计失败: {path}")
+            QMessageBox.warning(self, "警告", f"导出统计失败: {e}")